@@ -0,0 +1,198 @@
+"""
+Request coalescing for the OCR model.
+
+The BatchScheduler collects the preprocessed line images submitted by concurrent requests
+into shared batches, runs them through a single predict function call and routes
+each transcription back to the request that submitted the corresponding line.
+"""
+
+import collections
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+class _PendingRequest:
+    """The line images submitted by a single request, and the results collected for them so far"""
+
+    def __init__(self, line_images, line_widths):
+        self.line_images = line_images
+        self.line_widths = line_widths
+        self.arrival_time = time.monotonic()
+
+        # index of the first line image that has not been dispatched to the model yet
+        self.next_index = 0
+
+        self.predictions = [None] * len(line_images)
+        self.probabilities = [None] * len(line_images)
+        self.remaining = len(line_images)
+
+        self.error = None
+        self.done = threading.Event()
+
+        # the (start, stop) ranges of the line images transcribed so far, in order of completion
+        # (None signals that the request failed)
+        self.completed_segments = queue.Queue()
+
+    @property
+    def pending_lines(self):
+        return len(self.line_images) - self.next_index
+
+
+class BatchScheduler:
+    """
+    Coalesces the line images of concurrent requests into shared batches.
+
+    A background thread waits until either max_batch_size line images are queued,
+    or the oldest queued request has waited for max_wait_time seconds;
+    it then runs predict_function on a batch of at most max_batch_size line images
+    (possibly coming from different requests) and hands each result back to its request.
+
+    predict_function must accept a numpy array of preprocessed line images and the numpy array of their content widths,
+    and return a pair (transcriptions, probabilities) with one entry per line image.
+    """
+
+    def __init__(self, predict_function, max_batch_size=64, max_wait_time=0.01):
+        self.predict_function = predict_function
+        self.max_batch_size = max_batch_size
+        self.max_wait_time = max_wait_time
+
+        self._queue = collections.deque()
+        self._queued_lines = 0
+        self._condition = threading.Condition()
+
+        self._worker = threading.Thread(target=self._run, name="ocr-batch-scheduler", daemon=True)
+        self._worker.start()
+
+    def submit(self, line_images, line_widths=None):
+        """
+        Queue the passed preprocessed line images and block until all of them are transcribed.
+
+        :param line_images: a numpy array of preprocessed line images
+        :param line_widths: the widths of the content of the line images (by default, their full width)
+        :return: the list of transcriptions and the list of probabilities, in the same order as line_images
+        """
+
+        if len(line_images) == 0:
+            return [], []
+
+        request = self._enqueue(line_images, line_widths)
+        request.done.wait()
+
+        if request.error is not None:
+            raise request.error
+
+        return request.predictions, request.probabilities
+
+    def submit_stream(self, line_images, line_widths=None):
+        """
+        Queue the passed preprocessed line images and yield their transcriptions batch by batch, as soon as they are ready.
+
+        :param line_images: a numpy array of preprocessed line images
+        :param line_widths: the widths of the content of the line images (by default, their full width)
+        :return: a generator of tuples (start, transcriptions, probabilities),
+                 with the results of the line images line_images[start:start + len(transcriptions)]
+        """
+
+        if len(line_images) == 0:
+            return
+
+        request = self._enqueue(line_images, line_widths)
+
+        received_lines = 0
+        while received_lines < len(line_images):
+            segment = request.completed_segments.get()
+            if segment is None:
+                raise request.error
+
+            start, stop = segment
+            received_lines += stop - start
+            yield start, request.predictions[start:stop], request.probabilities[start:stop]
+
+    def _enqueue(self, line_images, line_widths):
+        if line_widths is None:
+            line_widths = np.full(len(line_images), line_images.shape[1])
+
+        request = _PendingRequest(line_images, np.asarray(line_widths))
+
+        with self._condition:
+            self._queue.append(request)
+            self._queued_lines += len(line_images)
+            self._condition.notify()
+
+        return request
+
+    def _next_batch(self):
+        """
+        Wait until a batch is ready to be dispatched, and return it as a list of segments;
+        each segment is a tuple (request, start, stop) that selects the line images request.line_images[start:stop]
+        """
+
+        with self._condition:
+            while not self._queue:
+                self._condition.wait()
+
+            # wait for more lines to arrive, until the batch is full or the oldest request has waited long enough
+            deadline = self._queue[0].arrival_time + self.max_wait_time
+            while self._queued_lines < self.max_batch_size:
+                remaining_time = deadline - time.monotonic()
+                if remaining_time <= 0:
+                    break
+                self._condition.wait(remaining_time)
+
+            segments = []
+            batch_size = 0
+            while self._queue and batch_size < self.max_batch_size:
+                request = self._queue[0]
+                start = request.next_index
+                stop = start + min(self.max_batch_size - batch_size, request.pending_lines)
+
+                segments.append((request, start, stop))
+                request.next_index = stop
+                batch_size += stop - start
+
+                if request.pending_lines == 0:
+                    self._queue.popleft()
+
+            self._queued_lines -= batch_size
+            return segments
+
+    def _run(self):
+        while True:
+            segments = self._next_batch()
+
+            try:
+                batch = np.concatenate([request.line_images[start:stop] for request, start, stop in segments])
+                batch_widths = np.concatenate([request.line_widths[start:stop] for request, start, stop in segments])
+                predictions, probabilities = self.predict_function(batch, batch_widths)
+            except Exception as e:
+                self._fail(segments, e)
+                continue
+
+            offset = 0
+            for request, start, stop in segments:
+                count = stop - start
+                request.predictions[start:stop] = predictions[offset:offset + count]
+                request.probabilities[start:stop] = probabilities[offset:offset + count]
+                offset += count
+
+                request.completed_segments.put((start, stop))
+                request.remaining -= count
+                if request.remaining == 0:
+                    request.done.set()
+
+    def _fail(self, segments, error):
+        """Propagate the passed error to all the requests in a failed batch, and drop their queued lines"""
+
+        failed_requests = {id(request): request for request, _, _ in segments}
+
+        with self._condition:
+            for request in failed_requests.values():
+                if request in self._queue:
+                    self._queue.remove(request)
+                    self._queued_lines -= request.pending_lines
+                request.error = error
+                request.completed_segments.put(None)
+                request.done.set()
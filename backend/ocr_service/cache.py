@@ -0,0 +1,169 @@
+"""
+Line-level cache of the transcriptions computed by the OCR service.
+
+Each transcription is identified by the digest of the page image content, by the (rounded) bounding box of the line,
+and by the id of the model checkpoint and inference settings that transcribed it, so that replacing the checkpoint
+or changing the settings invalidates the cache.
+The cache has an in-memory LRU tier and an optional on-disk sqlite tier, that survives server restarts
+and is shared by the worker processes of the server: it keeps the most recently stored lines, and a failure
+of the database only makes the lines miss the cache.
+"""
+
+import collections
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+def model_checkpoint_id(model_path, settings=''):
+    """Compute an id for a model checkpoint, that changes whenever the checkpoint path or file changes,
+    or the inference settings that affect its transcriptions"""
+
+    model_path = os.path.abspath(model_path)
+    if os.path.exists(model_path):
+        stat = os.stat(model_path)
+        signature = f"{model_path}|{stat.st_size}|{stat.st_mtime_ns}"
+    else:
+        signature = model_path
+
+    signature = f"{signature}|{settings}"
+    return hashlib.sha1(signature.encode()).hexdigest()
+
+
+def page_digest(page_image):
+    """Compute the digest of the content of a page image"""
+
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(str(page_image.shape).encode())
+    digest.update(page_image.tobytes())
+    return digest.hexdigest()
+
+
+class TranscriptionCache:
+    """
+    Cache of the (transcription, probability) pairs of the lines of the transcribed pages.
+
+    :param model_path: the path of the model checkpoint that computes the cached transcriptions
+    :param max_entries: the maximum number of lines kept in the in-memory LRU tier
+    :param db_path: the path of the sqlite database of the on-disk tier; if None, only the in-memory tier is used
+    :param settings: the inference settings that affect the transcriptions (e.g., the width buckets)
+    :param max_db_entries: the maximum number of lines kept in the on-disk tier (the oldest lines are evicted)
+    :param db_timeout: how long a worker waits for the database to be unlocked by the other workers, in seconds
+    """
+
+    # the on-disk tier is trimmed to max_db_entries lines every PRUNE_INTERVAL lines stored by a worker
+    PRUNE_INTERVAL = 1000
+
+    def __init__(self, model_path, max_entries=10000, db_path=None, settings='', max_db_entries=1000000,
+                 db_timeout=5.0):
+        self.model_id = model_checkpoint_id(model_path, settings)
+        self.max_entries = max_entries
+        self.max_db_entries = max_db_entries
+
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self._db = None
+        self._stored_since_prune = 0
+        if db_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            try:
+                self._db = self._open_db(db_path, db_timeout)
+            except sqlite3.Error as e:
+                print(f'Cannot open the transcription cache {db_path} ({e}), only the in-memory cache is used')
+
+    def _open_db(self, db_path, timeout):
+        db = sqlite3.connect(db_path, timeout=timeout, check_same_thread=False)
+        # the workers read the database while another one writes to it
+        db.execute("PRAGMA journal_mode=WAL")
+
+        # the databases of the previous versions have no stored_at column
+        columns = [row[1] for row in db.execute("PRAGMA table_info(transcriptions)")]
+        if columns and "stored_at" not in columns:
+            db.execute("DROP TABLE transcriptions")
+
+        db.execute("CREATE TABLE IF NOT EXISTS transcriptions ("
+                   "line_key TEXT PRIMARY KEY, model_id TEXT, transcription TEXT, probability TEXT, stored_at REAL)")
+        db.execute("CREATE INDEX IF NOT EXISTS transcriptions_stored_at ON transcriptions (stored_at)")
+
+        # the transcriptions computed by other checkpoints are not valid anymore
+        db.execute("DELETE FROM transcriptions WHERE model_id != ?", (self.model_id,))
+        db.commit()
+        return db
+
+    @staticmethod
+    def _line_key(digest, box):
+        return digest + ":" + ",".join(str(int(round(v))) for v in box)
+
+    def get_many(self, digest, bounding_boxes):
+        """
+        Look up the lines with the passed bounding boxes in the page with the passed digest.
+
+        :return: a list with a (transcription, probability) pair for each cached line, and None for each missing line
+        """
+
+        keys = [self._line_key(digest, box) for box in bounding_boxes]
+        results = [None] * len(keys)
+        missing = []
+
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    results[i] = self._entries[key]
+                else:
+                    missing.append(i)
+
+            if self._db is not None and missing:
+                try:
+                    for i in missing:
+                        row = self._db.execute("SELECT transcription, probability FROM transcriptions "
+                                               "WHERE line_key = ? AND model_id = ?",
+                                               (keys[i], self.model_id)).fetchone()
+                        if row is not None:
+                            results[i] = row
+                            self._store(keys[i], row)
+                except sqlite3.Error as e:
+                    print(f'Cannot read the transcription cache ({e})')
+
+        return results
+
+    def put_many(self, digest, bounding_boxes, transcriptions, probabilities):
+        """Store the transcriptions and probabilities of the lines with the passed bounding boxes"""
+
+        stored_at = time.time()
+        rows = [(self._line_key(digest, box), self.model_id, transcription, probability, stored_at)
+                for box, transcription, probability in zip(bounding_boxes, transcriptions, probabilities)]
+
+        with self._lock:
+            for key, _, transcription, probability, _ in rows:
+                self._store(key, (transcription, probability))
+
+            if self._db is not None and rows:
+                try:
+                    # committed, or rolled back on error, at the end of the block
+                    with self._db:
+                        self._db.executemany("INSERT OR REPLACE INTO transcriptions VALUES (?, ?, ?, ?, ?)", rows)
+                        self._stored_since_prune += len(rows)
+                        if self._stored_since_prune >= self.PRUNE_INTERVAL:
+                            self._prune_db()
+                except sqlite3.Error as e:
+                    print(f'Cannot write to the transcription cache ({e})')
+
+    def _prune_db(self):
+        """Evict the oldest lines of the on-disk tier beyond max_db_entries"""
+
+        self._db.execute("DELETE FROM transcriptions WHERE rowid IN ("
+                         "SELECT rowid FROM transcriptions ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+                         (self.max_db_entries,))
+        self._stored_since_prune = 0
+
+    def _store(self, key, value):
+        """Add an entry to the in-memory tier, evicting the least recently used entries if it is full"""
+
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
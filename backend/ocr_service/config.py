@@ -13,3 +13,30 @@ OCR_INPUT_IMAGE_SHAPE = (1024, 128, 1)
 OCR_MAX_TEXT_LENGTH = 128
 
 CHARSET_BASE = string.printable[:95]
+
+# lines of concurrent OCR requests are transcribed together in batches of at most OCR_BATCH_SIZE lines;
+# a queued line waits at most OCR_BATCH_MAX_WAIT seconds for other lines to fill its batch
+OCR_BATCH_SIZE = 64
+OCR_BATCH_MAX_WAIT = 0.01
+
+# the lines of a batch are grouped by the narrowest of these widths (multiples of 4) that holds their content,
+# and each group goes through the model at that width instead of the full input width;
+# this requires a Keras checkpoint or a SavedModel exported by scripts/export_model.py, and can change
+# the transcriptions, since the model sees less padding (an empty tuple disables it, e.g. (256, 512, 1024) enables it)
+OCR_WIDTH_BUCKETS = ()
+
+# the transcriptions of up to OCR_CACHE_SIZE lines are cached in memory (0 disables the cache);
+# if OCR_CACHE_PATH is not None, they are also cached on disk in a sqlite database at that path,
+# shared by the server workers, which keeps the OCR_CACHE_DB_SIZE most recently transcribed lines
+OCR_CACHE_SIZE = 10000
+OCR_CACHE_PATH = None
+OCR_CACHE_DB_SIZE = 1000000
+
+# production serving with gunicorn (see gunicorn.conf.py):
+# number of worker processes (None: one worker every OCR_INTRA_OP_THREADS cores),
+# number of request threads of each worker, and size of the tensorflow thread pools of each worker
+OCR_SERVER_PORT = 5025
+OCR_WORKERS = None
+OCR_WORKER_THREADS = 8
+OCR_INTRA_OP_THREADS = 2
+OCR_INTER_OP_THREADS = 1
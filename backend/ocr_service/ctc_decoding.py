@@ -0,0 +1,185 @@
+"""
+Connectionist Temporal Classification (CTC) decoders for the output of the HTR model.
+
+All decoders take the log-probabilities output by the model, with shape (batch_size, time_steps, num_classes),
+where the CTC blank is the last class (as in tensorflow), and return:
+    - a (batch_size, max_decoded_length) int32 matrix with the decoded labels, padded with -1
+    - a (batch_size,) float32 vector with the log-probability of each decoded sequence
+
+Available decoders:
+    best_path_decode: batched greedy (best path) decoding, fully vectorized in numpy
+    prefix_beam_search_decode: prefix beam search with a configurable beam width, in numpy
+    tf_decode: the tensorflow greedy/beam search decoders (the default for beam search, being much faster than
+               the numpy prefix beam search)
+"""
+
+import numpy as np
+
+DECODER_BACKENDS = ["numpy", "tf"]
+
+
+def ctc_decode(log_probabilities, greedy=True, beam_width=10, backend=None, sequence_lengths=None):
+    """
+    Decode a batch of model outputs, selecting the decoder based on the passed parameters.
+
+    :param log_probabilities: the (batch_size, time_steps, num_classes) log-probabilities output by the model
+    :param greedy: if True, use best path decoding; otherwise use beam search
+    :param beam_width: the beam width of beam search (beam search with beam_width <= 1 is best path decoding)
+    :param backend: "numpy" or "tf"; by default, numpy for best path decoding and tf for beam search
+    :param sequence_lengths: optional (batch_size,) number of valid time steps of each sample;
+                             if None, all the time steps of each sample are decoded
+    """
+
+    if backend is None:
+        backend = "numpy" if greedy or beam_width <= 1 else "tf"
+
+    if backend not in DECODER_BACKENDS:
+        raise ValueError("Unknown CTC decoder backend: " + str(backend))
+
+    log_probabilities = np.asarray(log_probabilities, dtype=np.float32)
+
+    if backend == "tf":
+        return tf_decode(log_probabilities, greedy=greedy, beam_width=beam_width, sequence_lengths=sequence_lengths)
+
+    if greedy or beam_width <= 1:
+        return best_path_decode(log_probabilities, sequence_lengths=sequence_lengths)
+
+    return prefix_beam_search_decode(log_probabilities, beam_width=beam_width, sequence_lengths=sequence_lengths)
+
+
+def _valid_steps_mask(batch_size, time_steps, sequence_lengths):
+    """Build a (batch_size, time_steps) boolean mask of the time steps to decode"""
+
+    if sequence_lengths is None:
+        return np.ones((batch_size, time_steps), dtype=bool)
+
+    sequence_lengths = np.minimum(np.asarray(sequence_lengths), time_steps)
+    return np.arange(time_steps)[np.newaxis, :] < sequence_lengths[:, np.newaxis]
+
+
+def _pad_sequences(sequences):
+    """Stack a list of label sequences in a matrix padded with -1"""
+
+    max_length = max([len(sequence) for sequence in sequences] + [1])
+    decoded = np.full((len(sequences), max_length), -1, dtype=np.int32)
+    for i, sequence in enumerate(sequences):
+        decoded[i, :len(sequence)] = sequence
+
+    return decoded
+
+
+def best_path_decode(log_probabilities, sequence_lengths=None):
+    """
+    Best path decoding: take the most probable class of each time step,
+    then merge the repeated labels and remove the blanks.
+    """
+
+    batch_size, time_steps, num_classes = log_probabilities.shape
+    blank = num_classes - 1
+
+    best_classes = np.argmax(log_probabilities, axis=-1)
+    best_log_probabilities = np.take_along_axis(log_probabilities, best_classes[..., np.newaxis], axis=-1)[..., 0]
+
+    valid = _valid_steps_mask(batch_size, time_steps, sequence_lengths)
+
+    # keep a label if it is not blank and it is different from the label of the previous time step
+    keep = valid & (best_classes != blank)
+    keep[:, 1:] &= best_classes[:, 1:] != best_classes[:, :-1]
+
+    lengths = keep.sum(axis=1)
+    decoded = np.full((batch_size, max(int(lengths.max(initial=0)), 1)), -1, dtype=np.int32)
+    decoded[np.arange(decoded.shape[1])[np.newaxis, :] < lengths[:, np.newaxis]] = best_classes[keep]
+
+    scores = np.where(valid, best_log_probabilities, 0).sum(axis=1).astype(np.float32)
+
+    return decoded, scores
+
+
+def prefix_beam_search_decode(log_probabilities, beam_width=10, sequence_lengths=None, candidates_per_step=None):
+    """
+    Prefix beam search decoding:
+        A. Y. Hannun, A. L. Maas, D. Jurafsky and A. Y. Ng,
+        First-pass large vocabulary continuous speech recognition using bi-directional recurrent DNNs, 2014.
+
+    For each prefix, the log-probabilities of the paths ending in blank and in non-blank are tracked separately.
+    At each time step only the candidates_per_step most probable classes (by default, beam_width)
+    are used to extend the prefixes, which makes the search practical on large vocabularies.
+    """
+
+    batch_size, time_steps, num_classes = log_probabilities.shape
+    blank = num_classes - 1
+    candidates_per_step = min(candidates_per_step or beam_width, num_classes)
+
+    if sequence_lengths is None:
+        sequence_lengths = np.full(batch_size, time_steps)
+    sequence_lengths = np.minimum(np.asarray(sequence_lengths), time_steps)
+
+    # the most probable classes of each time step, for the whole batch at once
+    candidates = np.argpartition(-log_probabilities, candidates_per_step - 1, axis=-1)[..., :candidates_per_step]
+
+    sequences, scores = [], []
+
+    for i in range(batch_size):
+        # prefix -> (log-probability of the paths ending in blank, log-probability of the paths ending in non-blank)
+        beams = {(): (0.0, -np.inf)}
+
+        for t in range(sequence_lengths[i]):
+            step = log_probabilities[i, t]
+            next_beams = {}
+
+            def add(prefix, blank_score, non_blank_score):
+                old_blank, old_non_blank = next_beams.get(prefix, (-np.inf, -np.inf))
+                next_beams[prefix] = (np.logaddexp(old_blank, blank_score),
+                                      np.logaddexp(old_non_blank, non_blank_score))
+
+            for prefix, (blank_score, non_blank_score) in beams.items():
+                prefix_score = np.logaddexp(blank_score, non_blank_score)
+
+                for c in candidates[i, t]:
+                    c = int(c)
+                    if c == blank:
+                        add(prefix, prefix_score + step[blank], -np.inf)
+                        continue
+
+                    extended = prefix + (c,)
+                    if prefix and prefix[-1] == c:
+                        # a repeated label extends the prefix only when separated by a blank,
+                        # otherwise it collapses on the last label of the prefix
+                        add(extended, -np.inf, blank_score + step[c])
+                        add(prefix, -np.inf, non_blank_score + step[c])
+                    else:
+                        add(extended, -np.inf, prefix_score + step[c])
+
+            beams = dict(sorted(next_beams.items(), key=lambda item: -np.logaddexp(*item[1]))[:beam_width])
+
+        best_prefix, (blank_score, non_blank_score) = max(beams.items(), key=lambda item: np.logaddexp(*item[1]))
+        sequences.append(best_prefix)
+        scores.append(np.logaddexp(blank_score, non_blank_score))
+
+    return _pad_sequences(sequences), np.asarray(scores, dtype=np.float32)
+
+
+def tf_decode(log_probabilities, greedy=True, beam_width=10, sequence_lengths=None):
+    """Decode with tf.nn.ctc_greedy_decoder or tf.nn.ctc_beam_search_decoder"""
+
+    import tensorflow as tf
+
+    batch_size, time_steps, _ = log_probabilities.shape
+    if sequence_lengths is None:
+        sequence_lengths = np.full(batch_size, time_steps)
+    sequence_lengths = np.minimum(np.asarray(sequence_lengths), time_steps).astype(np.int32)
+
+    inputs = tf.transpose(log_probabilities, perm=[1, 0, 2])
+
+    if greedy or beam_width <= 1:
+        decoded, neg_sum_logits = tf.nn.ctc_greedy_decoder(inputs, sequence_lengths)
+        scores = -neg_sum_logits.numpy()[:, 0]
+    else:
+        decoded, log_probability = tf.nn.ctc_beam_search_decoder(inputs, sequence_lengths, beam_width=beam_width)
+        scores = log_probability.numpy()[:, 0]
+
+    decoded = tf.sparse.to_dense(decoded[0], default_value=-1).numpy().astype(np.int32)
+    if decoded.shape[1] == 0:
+        decoded = np.full((batch_size, 1), -1, dtype=np.int32)
+
+    return decoded, scores.astype(np.float32)
@@ -1,5 +1,6 @@
 import h5py
 import numpy as np
+import tensorflow as tf
 from h5py import File
 from tensorflow.keras.utils import Sequence
 import os
@@ -13,33 +14,43 @@ import backend.ocr_service.image_processing as image_processing
 
 
 class HDF5Dataset:
-    def __init__(self, source_path, charset, max_text_length, batch_size, stream=False):
+    def __init__(self, source_path, charset, max_text_length, batch_size, stream=False, shuffle_buffer_size=1024):
         self.source_path = source_path
         self.tokenizer = Tokenizer(charset, max_text_length)
         self.training_batch_size = batch_size
 
+        # the number of training samples that the streaming generator and the tf.data pipeline shuffle in memory
+        self.shuffle_buffer_size = shuffle_buffer_size
+
         if not stream:
             with h5py.File(self.source_path, "r") as source:
+                train_labels, valid_labels, test_labels = (encoded_labels(source[partition], self.tokenizer)
+                                                           for partition in ("train", "valid", "test"))
+
                 self.training_data_generator = TrainingDataGenerator(samples=np.array(source["train"]['dt']),
                                                                      labels=np.array(source["train"]['gt']),
                                                                      batch_size=batch_size,
-                                                                     tokenizer=self.tokenizer)
+                                                                     tokenizer=self.tokenizer,
+                                                                     encoded_labels=train_labels)
 
                 self.valid_data_generator = DataGenerator(samples=np.array(source["valid"]['dt']),
                                                           batch_size=batch_size,
                                                           labels=np.array(source["valid"]['gt']),
-                                                          tokenizer=self.tokenizer)
+                                                          tokenizer=self.tokenizer,
+                                                          encoded_labels=valid_labels)
 
                 self.test_data_generator = DataGenerator(samples=np.array(source["test"]['dt']),
                                                          batch_size=batch_size,
                                                          labels=np.array(source["test"]['gt']),
-                                                         tokenizer=self.tokenizer)
+                                                         tokenizer=self.tokenizer,
+                                                         encoded_labels=test_labels)
 
         else:
             source_dataset = h5py.File(self.source_path)
             self.training_data_generator = StreamingTrainingDataGenerator(source=source_dataset['train'],
                                                                           batch_size=batch_size,
-                                                                          tokenizer=self.tokenizer)
+                                                                          tokenizer=self.tokenizer,
+                                                                          shuffle_buffer_size=shuffle_buffer_size)
 
             self.valid_data_generator = StreamingDataGenerator(source=source_dataset["valid"],
                                                                batch_size=batch_size,
@@ -53,6 +64,92 @@ class HDF5Dataset:
         self.valid_set_size = self.valid_data_generator.size
         self.test_set_size = self.test_data_generator.size
 
+    def tf_dataset(self,
+                   partition,
+                   training=False,
+                   cache_path=None,
+                   shuffle_buffer_size=None,
+                   seed=42):
+        """
+        Build a tf.data pipeline that yields the (x, y) batches of a partition of the HDF5 file,
+        as an alternative to the Keras Sequence generators.
+
+        The labels are read pre-encoded from the HDF5 file (or encoded once, when the pipeline is built, for the files
+        that only have their texts); the line images are read chunk by chunk
+        from the HDF5 file and, if cache_path is passed, cached un-augmented in files with that prefix
+        (the first epoch writes the cache, the next ones read it instead of the HDF5 file).
+        If training is True, the samples are shuffled and augmented in parallel, each one with its own seed
+        drawn from a random sequence that is derived from seed and changes at each epoch,
+        so that two runs with the same seed are identical.
+        The batches are prefetched while the model trains on the previous ones.
+
+        :param partition: the partition to read ("train", "valid" or "test")
+        :param training: whether to shuffle and augment the samples
+        :param cache_path: the optional path prefix of the on-disk cache of the un-augmented samples
+        :param shuffle_buffer_size: the number of samples the shuffle draws from (by default, the shuffle_buffer_size
+                                    of the dataset)
+        :param seed: the seed of the shuffle and of the augmentation
+        :return: a tf.data.Dataset of (x, y) batches of training_batch_size samples
+        """
+
+        with h5py.File(self.source_path, "r") as source:
+            sample_shape = source[partition]["dt"].shape[1:]
+            read_size = source[partition]["dt"].chunks[0] if source[partition]["dt"].chunks else 1024
+            labels = encoded_labels(source[partition], self.tokenizer)
+            if labels is None:
+                labels, _ = self.tokenizer.encode_batch(source[partition]["gt"][:])
+
+        def read_samples():
+            with h5py.File(self.source_path, "r") as hdf5_source:
+                samples = hdf5_source[partition]["dt"]
+                for start in range(0, samples.shape[0], read_size):
+                    yield from samples[start:start + read_size]
+
+        samples = tf.data.Dataset.from_generator(read_samples,
+                                                 output_signature=tf.TensorSpec(shape=sample_shape, dtype=tf.uint8))
+        dataset = tf.data.Dataset.zip((samples, tf.data.Dataset.from_tensor_slices(labels)))
+
+        if cache_path is not None:
+            dataset = dataset.cache(cache_path)
+
+        if training:
+            if shuffle_buffer_size is None:
+                shuffle_buffer_size = self.shuffle_buffer_size
+            dataset = dataset.shuffle(shuffle_buffer_size, seed=seed, reshuffle_each_iteration=True)
+
+            def augment(sample_seed, sample_and_label):
+                sample, label = sample_and_label
+                sample = tf.numpy_function(image_processing.augment, [sample, sample_seed], tf.float32, stateful=False)
+                return tf.ensure_shape(sample, sample_shape), label
+
+            # a new sequence of augmentation seeds at each iteration of the dataset, i.e. at each epoch
+            sample_seeds = tf.data.Dataset.random(seed=seed, rerandomize_each_iteration=True)
+            dataset = tf.data.Dataset.zip((sample_seeds, dataset))
+            dataset = dataset.map(augment, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+
+        # same normalization as image_processing.normalize
+        dataset = dataset.map(lambda x, y: (tf.expand_dims(tf.cast(x, tf.float32) / 255, axis=-1), y),
+                              num_parallel_calls=tf.data.AUTOTUNE)
+
+        return dataset.batch(self.training_batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+def encoded_labels(source, tokenizer, stream=False):
+    """
+    Return the labels of an HDF5 partition pre-encoded by create_dataset.py, as a (N, max_text_length) int16 matrix
+    (as an HDF5 dataset that is read lazily if stream is True), or None if the partition only has the "gt" texts
+    or its labels were encoded with a different charset or max text length than the passed tokenizer.
+    """
+
+    if "labels" not in source:
+        return None
+
+    if source.attrs.get("charset") != tokenizer.chars or source.attrs.get("max_text_length") != tokenizer.maxlen:
+        print(f"The labels of {source.name} were encoded with other tokenizer settings, they are encoded on the fly")
+        return None
+
+    return source["labels"] if stream else np.array(source["labels"])
+
 
 class DataGenerator(Sequence):
 
@@ -60,11 +157,15 @@ class DataGenerator(Sequence):
                  samples: np.array,
                  labels: np.array,
                  batch_size: int,
-                 tokenizer: Tokenizer):
+                 tokenizer: Tokenizer,
+                 encoded_labels: np.array = None):
         self.samples = samples
         self.labels = labels
         self.tokenizer = tokenizer
 
+        # the labels are sliced from the pre-encoded ones if they are available, and encoded on the fly otherwise
+        self.encoded_labels = encoded_labels
+
         self.batch_size = batch_size
         self.current_epoch = 0
 
@@ -85,13 +186,19 @@ class DataGenerator(Sequence):
         x_valid = self.samples[index * self.batch_size:(index + 1) * self.batch_size]
         x_valid = image_processing.normalize(x_valid)
 
-        y_valid = self.labels[index * self.batch_size:(index + 1) * self.batch_size]
-        y_valid = [self.tokenizer.encode(y) for y in y_valid]
-        y_valid = [np.pad(y, (0, self.tokenizer.maxlen - len(y))) for y in y_valid]
-        y_valid = np.asarray(y_valid, dtype=np.int16)
+        y_valid = self.batch_labels(slice(index * self.batch_size, (index + 1) * self.batch_size))
 
         return x_valid, y_valid
 
+    def batch_labels(self, indices):
+        """
+        Return the encoded labels of the passed indices (a slice or a sorted index array).
+        """
+        if self.encoded_labels is not None:
+            return self.encoded_labels[indices]
+
+        return self.tokenizer.encode_batch(self.labels[indices])[0]
+
     def on_epoch_end(self):
         """
         Update indexes after each epoch
@@ -105,14 +212,16 @@ class TrainingDataGenerator(DataGenerator):
                  samples: np.array,
                  labels: np.array,
                  batch_size: int,
-                 tokenizer: Tokenizer):
+                 tokenizer: Tokenizer,
+                 encoded_labels: np.array = None):
         # the DataGenerator initializer will save and initialize
-        # samples, labels, tokenizer, batch_size, current_epoch, size and step_number
+        # samples, labels, encoded_labels, tokenizer, batch_size, current_epoch, size and step_number
 
         super().__init__(samples=samples,
                          labels=labels,
                          batch_size=batch_size,
-                         tokenizer=tokenizer)
+                         tokenizer=tokenizer,
+                         encoded_labels=encoded_labels)
 
         # this will be useful to shuffle the samples and labels at the end of each epoch
         self.arange = np.arange(len(self.labels))
@@ -124,24 +233,24 @@ class TrainingDataGenerator(DataGenerator):
         Generate the next batch of training data.
         Augment the X
         """
-        x_train = self.samples[index * self.batch_size:(index + 1) * self.batch_size]
-        y_train = self.labels[index * self.batch_size:(index + 1) * self.batch_size]
-
-        x_train = image_processing.manual_augmentation(x_train,
-                                                       rotation_range=0.5,
-                                                       scale_range=0.02,
-                                                       height_shift_range=0.02,
-                                                       width_shift_range=0.01,
-                                                       erode_range=3,
-                                                       dilate_range=3)
-        x_train = image_processing.albumentations_augmentation(x_train)
-        x_train = image_processing.normalize(x_train)
+        # the samples are shuffled through their indices, so only the current batch is copied
+        batch_indices = np.sort(self.arange[index * self.batch_size:(index + 1) * self.batch_size])
+        x_train = self.samples[batch_indices]
+        y_train = self.batch_labels(batch_indices)
 
-        y_train = [self.tokenizer.encode(y) for y in y_train]
-        y_train = [np.pad(y, (0, self.tokenizer.maxlen - len(y))) for y in y_train]
-        y_train = np.asarray(y_train, dtype=np.int16)
+        return self.augment(x_train), y_train
 
-        return x_train, y_train
+    def augment(self, x_train):
+        """
+        Augment and normalize a batch of training line images,
+        with the same augmentation as the tf.data pipeline (image_processing.augment).
+        """
+        # one seed for each image, drawn from the global numpy generator (seeded in __init__)
+        seeds = np.random.randint(np.iinfo(np.int64).max, size=len(x_train), dtype=np.int64)
+        x_train = [image_processing.augment(x, seed) for x, seed in zip(x_train, seeds)]
+        x_train = image_processing.normalize(x_train)
+
+        return x_train
 
     # override the DataGenerator on_epoch_end method to shuffle the samples and labels
     def on_epoch_end(self):
@@ -151,8 +260,6 @@ class TrainingDataGenerator(DataGenerator):
         self.current_epoch += 1
 
         np.random.shuffle(self.arange)
-        self.samples = self.samples[self.arange]
-        self.labels = self.labels[self.arange]
 
 
 class StreamingDataGenerator(DataGenerator):
@@ -164,7 +271,8 @@ class StreamingDataGenerator(DataGenerator):
 
         # note: accessing source["dt"] and source["gt"] here does NOT load their contents in memory!
         # The source contents will only be loaded in memory in __getitem__
-        super().__init__(source["dt"], source["gt"], batch_size, tokenizer)
+        super().__init__(source["dt"], source["gt"], batch_size, tokenizer,
+                         encoded_labels(source, tokenizer, stream=True))
 
         # update these values in a way that is suitable for the Streaming approach
         self.size = self.labels[:].shape[0]     # this does NOT load the data in memory
@@ -172,23 +280,117 @@ class StreamingDataGenerator(DataGenerator):
 
 
 class StreamingTrainingDataGenerator(TrainingDataGenerator):
+    """
+    Training generator that reads the samples from the HDF5 file batch by batch, and still shuffles them at each epoch.
+
+    Each epoch, the HDF5 chunks of the samples are shuffled and grouped into shuffle buffers
+    of about shuffle_buffer_size samples; the chunks of a buffer are read whole, in file order,
+    and its samples are served in a random order before moving to the next buffer.
+    Only one shuffle buffer is held in memory at a time, so the batches must be requested in order
+    (HTRModel.fit does not shuffle the batches of this generator, see sequential_access).
+    """
+
+    # the batches already are in a random order, and requesting them out of order would reload a buffer for each one
+    sequential_access = True
 
     def __init__(self,
                  source: File,
                  batch_size: int,
-                 tokenizer: Tokenizer):
+                 tokenizer: Tokenizer,
+                 shuffle_buffer_size: int = 1024):
 
         # note: accessing source["dt"] and source["gt"] here does NOT load their contents in memory!
         # The source contents will only be loaded in memory in __getitem__
-        super().__init__(samples=source['dt'], labels=source['gt'], batch_size=batch_size, tokenizer=tokenizer)
+        super().__init__(samples=source['dt'], labels=source['gt'], batch_size=batch_size, tokenizer=tokenizer,
+                         encoded_labels=encoded_labels(source, tokenizer, stream=True))
 
         # update these values in a way that is suitable for the Streaming approach
         self.size = self.labels[:].shape[0]  # this does NOT load the data in memory
         self.steps_number = int(np.ceil(self.size / self.batch_size))
 
-    # override the TrainingDataGenerator on_epoch_end: when using the Streaming class you cannot shuffle the values
+        # the samples are read one whole HDF5 chunk at a time (or one batch at a time, if the dataset is not chunked)
+        self.chunk_size = self.samples.chunks[0] if self.samples.chunks is not None else self.batch_size
+        self.chunk_starts = np.arange(0, self.size, self.chunk_size)
+        self.buffer_chunks = max(1, shuffle_buffer_size // self.chunk_size)
+
+        # the samples of the loaded shuffle buffer are read straight into this array, allocated once
+        self.buffer_samples = np.empty((min(self.buffer_chunks * self.chunk_size, self.size),) + self.samples.shape[1:],
+                                       dtype=self.samples.dtype)
+
+        self._shuffle()
+
+    def _shuffle(self):
+        """
+        Shuffle the chunks into shuffle buffers, and the samples within each buffer.
+        """
+        chunk_order = np.random.permutation(len(self.chunk_starts))
+
+        # the chunks of each buffer, in file order, so that they are read contiguously
+        self.buffers = [np.sort(chunk_order[i:i + self.buffer_chunks])
+                        for i in range(0, len(chunk_order), self.buffer_chunks)]
+
+        # for each position of the epoch, the buffer of its sample and the row of the sample in the loaded buffer
+        self.position_buffers = [np.empty(0, dtype=int)]
+        self.position_rows = [np.empty(0, dtype=int)]
+        for buffer_index, chunks in enumerate(self.buffers):
+            buffer_size = sum(min(self.chunk_size, self.size - self.chunk_starts[chunk]) for chunk in chunks)
+            self.position_buffers.append(np.full(buffer_size, buffer_index))
+            self.position_rows.append(np.random.permutation(buffer_size))
+        self.position_buffers = np.concatenate(self.position_buffers)
+        self.position_rows = np.concatenate(self.position_rows)
+
+        self.loaded_buffer_index = None
+        self.loaded_samples = None
+        self.loaded_labels = None
+
+    def _load_buffer(self, buffer_index):
+        """
+        Read the chunks of the passed shuffle buffer, unless it is already in memory.
+        """
+        if self.loaded_buffer_index == buffer_index:
+            return
+
+        chunk_starts = self.chunk_starts[self.buffers[buffer_index]]
+
+        # the chunks are read one after the other into the preallocated buffer, without intermediate copies
+        buffer_size = 0
+        for start in chunk_starts:
+            chunk_size = min(self.chunk_size, self.size - start)
+            self.samples.read_direct(self.buffer_samples,
+                                     source_sel=np.s_[start:start + chunk_size],
+                                     dest_sel=np.s_[buffer_size:buffer_size + chunk_size])
+            buffer_size += chunk_size
+
+        self.loaded_samples = self.buffer_samples[:buffer_size]
+        self.loaded_labels = np.concatenate([self.batch_labels(slice(start, start + self.chunk_size))
+                                             for start in chunk_starts])
+        self.loaded_buffer_index = buffer_index
+
+    # override the TrainingDataGenerator __getitem__ to serve the samples of the shuffle buffers
+    def __getitem__(self, index):
+        """
+        Generate the next batch of training data.
+        Augment the X
+        """
+        batch_buffers = self.position_buffers[index * self.batch_size:(index + 1) * self.batch_size]
+        batch_rows = self.position_rows[index * self.batch_size:(index + 1) * self.batch_size]
+
+        # a batch may span the end of a shuffle buffer and the start of the next one
+        x_train = []
+        y_train = []
+        for buffer_index in np.unique(batch_buffers):
+            self._load_buffer(buffer_index)
+            rows = batch_rows[batch_buffers == buffer_index]
+            x_train.append(self.loaded_samples[rows])
+            y_train.append(self.loaded_labels[rows])
+
+        return self.augment(np.concatenate(x_train)), np.concatenate(y_train)
+
+    # override the TrainingDataGenerator on_epoch_end to shuffle the chunks and the shuffle buffers
     def on_epoch_end(self):
         """
         Update indexes after each epoch
         """
         self.current_epoch += 1
+
+        self._shuffle()
@@ -1,46 +1,231 @@
 """
 Tool to metrics calculation through data and label (string and string).
- * Calculation from Optical Character Recognition (OCR) metrics with editdistance.
+ * Calculation from Optical Character Recognition (OCR) metrics:
+   Character Error Rate (CER), Word Error Rate (WER) and Sequence Error Rate (SER).
+
+The edit distances are computed for batches of pairs at once, as a dynamic programming over padded
+numpy matrices that also counts the substitutions, insertions and deletions of an optimal alignment;
+the batches are spread over a pool of processes (see evaluate_ocr).
 """
 
+import multiprocessing
 import string
 import unicodedata
-import editdistance
 import numpy as np
 
+PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
+
+# separator used to normalize all the texts with a single call of each string function
+TEXT_SEPARATOR = "\0"
 
-def ocr_metrics(predicts, ground_truth, norm_accentuation=False, norm_punctuation=False):
+
+def ocr_metrics(predicts, ground_truth, norm_accentuation=False, norm_punctuation=False, processes=None):
     """Calculate Character Error Rate (CER), Word Error Rate (WER) and Sequence Error Rate (SER)"""
 
     if len(predicts) == 0 or len(ground_truth) == 0:
         return (1, 1, 1)
 
-    cer, wer, ser = [], [], []
+    # as the pairs were zipped, the texts without a counterpart in the other list are ignored
+    size = min(len(predicts), len(ground_truth))
+
+    report = evaluate_ocr(predicts[:size], ground_truth[:size],
+                          norm_accentuation=norm_accentuation,
+                          norm_punctuation=norm_punctuation,
+                          processes=processes)
+
+    return np.array([report["cer"], report["wer"], report["ser"]])
+
+
+def evaluate_ocr(predicts, ground_truth, norm_accentuation=False, norm_punctuation=False,
+                 processes=None, chunk_size=1024):
+    """
+    Calculate CER, WER and SER, with the breakdown of the character and word errors
+    into substitutions, insertions and deletions, for each sample and for the whole set.
+
+    As in ocr_metrics, the CER and WER of a sample are its edit distance divided by the length of the longer
+    of the two texts, and the CER, WER and SER of the set are the means of those of its samples.
+
+    :param predicts: the predicted texts
+    :param ground_truth: the ground truth texts, in the same order as predicts
+    :param norm_accentuation: whether to remove the accents before comparing the texts
+    :param norm_punctuation: whether to remove the punctuation before comparing the texts
+    :param processes: the number of processes computing the edit distances (by default, one per core)
+    :param chunk_size: the number of pairs of texts in each batch
+    :return: a dict with the "cer", "wer" and "ser" of the set, the total "characters" and "words" errors
+             (dicts of "substitutions", "insertions", "deletions" and "reference_length"),
+             and the per-sample arrays in "samples"
+    """
+
+    if len(predicts) != len(ground_truth):
+        raise ValueError(f"{len(predicts)} predicted texts for {len(ground_truth)} ground truth texts")
+
+    predicts = normalize_texts(predicts, norm_accentuation, norm_punctuation)
+    ground_truth = normalize_texts(ground_truth, norm_accentuation, norm_punctuation)
+
+    # characters are compared by code point, and words by an id shared by predictions and ground truth
+    word_ids = {}
+    predicted_words = _split([[word_ids.setdefault(word, len(word_ids)) for word in text.split()] for text in predicts])
+    true_words = _split([[word_ids.setdefault(word, len(word_ids)) for word in text.split()] for text in ground_truth])
+
+    character_errors = edit_operations(_character_codes(ground_truth), _character_codes(predicts),
+                                       processes=processes, chunk_size=chunk_size)
+    word_errors = edit_operations(true_words, predicted_words, processes=processes, chunk_size=chunk_size)
+
+    # SER only needs to know whether the two texts are equal
+    sequence_errors = np.array([pd != gt for pd, gt in zip(predicts, ground_truth)], dtype=np.float64)
+
+    character_lengths = np.maximum([len(text) for text in predicts], [len(text) for text in ground_truth])
+    word_lengths = np.maximum([len(words) for words in predicted_words], [len(words) for words in true_words])
+
+    samples = {"cer": _error_rates(character_errors, character_lengths),
+               "wer": _error_rates(word_errors, word_lengths),
+               "ser": sequence_errors}
+    for name, errors in (("char", character_errors), ("word", word_errors)):
+        for operation, counts in zip(("substitutions", "insertions", "deletions"), errors):
+            samples[f"{name}_{operation}"] = counts
+
+    return {"cer": samples["cer"].mean(),
+            "wer": samples["wer"].mean(),
+            "ser": sequence_errors.mean(),
+            "characters": _error_totals(character_errors, [len(text) for text in ground_truth]),
+            "words": _error_totals(word_errors, [len(words) for words in true_words]),
+            "samples": samples}
+
+
+def normalize_texts(texts, norm_accentuation=False, norm_punctuation=False):
+    """Lowercase a list of texts, and optionally remove their accents and punctuation, all at once"""
+
+    text = TEXT_SEPARATOR.join(texts).lower()
+
+    if norm_accentuation:
+        text = unicodedata.normalize("NFKD", text).encode("ASCII", "ignore").decode("ASCII")
+
+    if norm_punctuation:
+        text = text.translate(PUNCTUATION_TABLE)
+
+    return text.split(TEXT_SEPARATOR) if len(texts) > 0 else []
+
+
+def _character_codes(texts):
+    """Convert each text to the array of the code points of its characters, all at once"""
+
+    lengths = [len(text) for text in texts]
+    codes = np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32).astype(np.int64)
+
+    return np.split(codes, np.cumsum(lengths)[:-1]) if len(texts) > 0 else []
+
+
+def _split(sequences):
+    """Convert each list of integers to an array, all at once"""
+
+    lengths = [len(sequence) for sequence in sequences]
+    values = np.fromiter((value for sequence in sequences for value in sequence), dtype=np.int64, count=sum(lengths))
+
+    return np.split(values, np.cumsum(lengths)[:-1]) if len(sequences) > 0 else []
+
+
+def edit_operations(references, hypotheses, processes=None, chunk_size=1024):
+    """
+    Count the substitutions, insertions and deletions that turn each reference sequence into its hypothesis,
+    along an optimal (i.e., minimum edit distance) alignment.
+
+    :param references: a list of integer numpy arrays
+    :param hypotheses: a list of integer numpy arrays, in the same order as references
+    :param processes: the number of processes computing the batches (by default, one per core)
+    :param chunk_size: the number of pairs of sequences in each batch
+    :return: the (substitutions, insertions, deletions) arrays, with one entry for each pair
+    """
+
+    reference_lengths = np.array([len(sequence) for sequence in references], dtype=np.int64)
+    hypothesis_lengths = np.array([len(sequence) for sequence in hypotheses], dtype=np.int64)
+
+    # batch together pairs of similar lengths, so that little padding is computed
+    order = np.argsort(np.maximum(reference_lengths, hypothesis_lengths), kind="stable")
+    chunks = [([references[i] for i in indices], [hypotheses[i] for i in indices])
+              for indices in np.array_split(order, max(1, int(np.ceil(len(order) / chunk_size))))]
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    if processes > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(min(processes, len(chunks))) as pool:
+            results = pool.starmap(_batch_edit_operations, chunks)
+    else:
+        results = [_batch_edit_operations(*chunk) for chunk in chunks]
+
+    operations = np.zeros((3, len(order)), dtype=np.int64)
+    if len(order) > 0:
+        operations[:, order] = np.concatenate(results, axis=1)
+
+    return operations
+
+
+def _batch_edit_operations(references, hypotheses):
+    """Count the edit operations of a batch of pairs of sequences (see edit_operations)"""
+
+    reference_lengths = np.array([len(sequence) for sequence in references], dtype=np.int64)
+    hypothesis_lengths = np.array([len(sequence) for sequence in hypotheses], dtype=np.int64)
+    reference = _pad(references, reference_lengths, -1)
+    hypothesis = _pad(hypotheses, hypothesis_lengths, -2)
+
+    # each cell of the table packs its cost, insertions and deletions into a single integer
+    # cost * base^2 + insertions * base + deletions, so that a single minimum picks the cheapest alignment
+    # (and, among those, the one with fewer insertions and deletions) and carries its operation counts along
+    base = max(reference.shape[1], hypothesis.shape[1]) + 1
+    substitution, deletion, insertion = base ** 2, base ** 2 + 1, base ** 2 + base
+    dtype = np.int32 if 2 * base ** 3 < np.iinfo(np.int32).max else np.int64
+
+    # the first row of the table: the first j hypothesis items are all insertions
+    insertion_steps = np.arange(hypothesis.shape[1] + 1, dtype=dtype) * insertion
+    cells = np.tile(insertion_steps, (len(references), 1))
+
+    # the packed cell of each pair is read in the row of its reference length, at the column of its hypothesis length
+    result = np.empty(len(references), dtype=np.int64)
+    rows = np.arange(len(references))
+    done = reference_lengths == 0
+    result[done] = cells[rows[done], hypothesis_lengths[done]]
+
+    for i in range(1, reference.shape[1] + 1):
+        next_cells = np.empty_like(cells)
+        next_cells[:, 0] = i * deletion
+
+        # best of the substitution (or match) from the previous diagonal and the deletion from above
+        mismatch = (reference[:, i - 1:i] != hypothesis).astype(dtype)
+        np.minimum(cells[:, :-1] + mismatch * substitution, cells[:, 1:] + deletion, out=next_cells[:, 1:])
+
+        # then, the insertions from the left: cell[j] = min over k <= j of next_cell[k] + (j - k) insertions
+        next_cells -= insertion_steps
+        cells = np.minimum.accumulate(next_cells, axis=1) + insertion_steps
+
+        done = reference_lengths == i
+        result[done] = cells[rows[done], hypothesis_lengths[done]]
+
+    costs, insertions, deletions = result // base ** 2, result // base % base, result % base
+    return np.stack([costs - insertions - deletions, insertions, deletions])
+
+
+def _pad(sequences, lengths, pad):
+    """Stack a list of integer arrays into a matrix, padded with pad"""
 
-    for (pd, gt) in zip(predicts, ground_truth):
-        pd, gt = pd.lower(), gt.lower()
+    padded = np.full((len(sequences), max(lengths, default=0)), pad, dtype=np.int64)
+    padded[np.arange(padded.shape[1]) < lengths[:, np.newaxis]] = np.concatenate(
+        list(sequences) + [np.zeros(0, dtype=np.int64)])
 
-        if norm_accentuation:
-            pd = unicodedata.normalize("NFKD", pd).encode("ASCII", "ignore").decode("ASCII")
-            gt = unicodedata.normalize("NFKD", gt).encode("ASCII", "ignore").decode("ASCII")
+    return padded
 
-        if norm_punctuation:
-            pd = pd.translate(str.maketrans("", "", string.punctuation))
-            gt = gt.translate(str.maketrans("", "", string.punctuation))
 
-        pd_cer, gt_cer = list(pd), list(gt)
-        dist = editdistance.eval(pd_cer, gt_cer)
-        cer.append(dist / (max(len(pd_cer), len(gt_cer))))
+def _error_rates(operations, lengths):
+    """Divide the edit distance of each sample by its length (0 for the samples with two empty texts)"""
 
-        pd_wer, gt_wer = pd.split(), gt.split()
-        dist = editdistance.eval(pd_wer, gt_wer)
-        wer.append(dist / (max(len(pd_wer), len(gt_wer))))
+    distances = operations.sum(axis=0)
+    return np.divide(distances, lengths, out=np.zeros(len(lengths)), where=lengths > 0)
 
-        pd_ser, gt_ser = [pd], [gt]
-        dist = editdistance.eval(pd_ser, gt_ser)
-        ser.append(dist / (max(len(pd_ser), len(gt_ser))))
 
-    metrics = [cer, wer, ser]
-    metrics = np.mean(metrics, axis=1)
+def _error_totals(operations, reference_lengths):
+    """Sum the edit operations of all the samples"""
 
-    return metrics
+    substitutions, insertions, deletions = operations.sum(axis=1)
+    return {"substitutions": int(substitutions),
+            "insertions": int(insertions),
+            "deletions": int(deletions),
+            "reference_length": int(np.sum(reference_lengths))}
@@ -0,0 +1,49 @@
+"""
+Gunicorn configuration for serving the OCR service in production.
+Run it from the ocr_service folder with:
+
+    gunicorn -c gunicorn.conf.py server:app
+
+The server forks a pool of worker processes. Each worker pins the size of its tensorflow thread pools
+(so that the workers together do not oversubscribe the CPU cores), then loads the model and serves the requests
+with several threads, whose lines are batched together by the transcriptor.
+TFLite model files are read once before forking, and their content is shared by all the workers;
+the other model formats initialize the tensorflow runtime when loaded, so each worker loads them after the fork.
+"""
+
+import multiprocessing
+import os
+
+from config import MODEL_PATH, OCR_SERVER_PORT, OCR_WORKERS, OCR_WORKER_THREADS, \
+    OCR_INTRA_OP_THREADS, OCR_INTER_OP_THREADS
+
+bind = f"0.0.0.0:{OCR_SERVER_PORT}"
+workers = OCR_WORKERS or max(1, multiprocessing.cpu_count() // OCR_INTRA_OP_THREADS)
+worker_class = "gthread"
+threads = OCR_WORKER_THREADS
+
+# loading the model can take a while, and so can transcribing a dense page
+timeout = 300
+
+# content of the model file, read by the master process before forking the workers (if it is safe to do so)
+preloaded_model_content = None
+
+
+def on_starting(server):
+    global preloaded_model_content
+
+    if MODEL_PATH.endswith(".tflite"):
+        with open(MODEL_PATH, "rb") as model_file:
+            preloaded_model_content = model_file.read()
+
+
+def post_fork(server, worker):
+    # the thread pools must be configured before tensorflow is initialized in the worker
+    os.environ["OMP_NUM_THREADS"] = str(OCR_INTRA_OP_THREADS)
+
+    from runtime import configure_threads
+    configure_threads(OCR_INTRA_OP_THREADS, OCR_INTER_OP_THREADS)
+
+    # import the application here, so that the worker is ready before it accepts any request
+    import server as ocr_server
+    ocr_server.init_transcriptor(model_content=preloaded_model_content, num_threads=OCR_INTRA_OP_THREADS)
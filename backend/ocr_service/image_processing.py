@@ -2,32 +2,23 @@
 Image processing functions:
     adjust_to_see: adjust an image to better visualize it (rotate and transpose)
     augmentation: apply variations to a list of images
+    augment: apply the training variations to a single image, with a given seed
     normalization: apply normalization and variations on images (if required)
     preprocess: main function for image preprocessing before
+    preprocess_batch: preprocess all the lines of a page into a single buffer
     text_standardize: preprocess and standardize sentence
 """
 
 import cv2
 import numpy as np
-import albumentations
 
-AUGMENTATIONS_TRAIN = albumentations.Compose([
-
-    albumentations.OneOf([
-        # A.Rotate(limit=[1,1],interpolation=cv2.INTER_NEAREST,border_mode=cv2.BORDER_CONSTANT),
-        # A.RandomBrightnessContrast(),
-        # A.IAAAdditiveGaussianNoise(),
-        # A.GaussNoise(),
-        # JpegCompression(quality_lower=99, quality_upper=100, always_apply=False),
-
-        albumentations.Cutout(num_holes=5, max_h_size=4, max_w_size=4),
-        albumentations.Cutout(num_holes=20, max_h_size=1, max_w_size=1)
-        #albumentations.CoarseDropout(max_holes=5, min_holes=5, max_height=4, max_width=4),
-        #albumentations.CoarseDropout(max_holes=20, min_holes=20, max_height=4, max_width=4)
-
-        # ShiftScaleRotate(shift_limit=0.05, scale_limit=0.06,rotate_limit=1.6, border_mode=BORDER_CONSTANT),
-    ], p=1),
-])
+# the parameters of manual_augmentation used for training, by both the Keras generators and the tf.data pipeline
+TRAINING_AUGMENTATION = dict(rotation_range=0.5,
+                             scale_range=0.02,
+                             height_shift_range=0.02,
+                             width_shift_range=0.01,
+                             erode_range=3,
+                             dilate_range=3)
 
 
 def manual_augmentation(imgs,
@@ -36,18 +27,23 @@ def manual_augmentation(imgs,
                         height_shift_range=0,
                         width_shift_range=0,
                         dilate_range=1,
-                        erode_range=1):
-    """Apply variations to a list of images (rotate, width and height shift, scale, erode, dilate)"""
+                        erode_range=1,
+                        rng=None):
+    """Apply variations to a list of images (rotate, width and height shift, scale, erode, dilate);
+    the variations are drawn from the passed numpy random generator (by default, the global numpy one)"""
+
+    if rng is None:
+        rng = np.random
 
     imgs = imgs.astype(np.float32)
     _, h, w = imgs.shape
 
-    dilate_kernel = np.ones((int(np.random.uniform(1, dilate_range)),), np.uint8)
-    erode_kernel = np.ones((int(np.random.uniform(1, erode_range)),), np.uint8)
-    height_shift = np.random.uniform(-height_shift_range, height_shift_range)
-    rotation = np.random.uniform(-rotation_range, rotation_range)
-    scale = np.random.uniform(1 - scale_range, 1)
-    width_shift = np.random.uniform(-width_shift_range, width_shift_range)
+    dilate_kernel = np.ones((int(rng.uniform(1, dilate_range)),), np.uint8)
+    erode_kernel = np.ones((int(rng.uniform(1, erode_range)),), np.uint8)
+    height_shift = rng.uniform(-height_shift_range, height_shift_range)
+    rotation = rng.uniform(-rotation_range, rotation_range)
+    scale = rng.uniform(1 - scale_range, 1)
+    width_shift = rng.uniform(-width_shift_range, width_shift_range)
 
     trans_map = np.float32([[1, 0, width_shift * w], [0, 1, height_shift * h]])
     rot_map = cv2.getRotationMatrix2D((w // 2, h // 2), rotation, scale)
@@ -64,15 +60,30 @@ def manual_augmentation(imgs,
     return imgs
 
 
-def albumentations_augmentation(x_train):
-    transform = AUGMENTATIONS_TRAIN
-    batch = []
-    for x in x_train:
-        x_transformed = transform(image=x)
-        x_transformed = x_transformed["image"]
-        batch.append(np.array(x_transformed))
+def cutout_augmentation(image, rng):
+    """Fill either 5 holes of 4x4 pixels or 20 holes of 1x1 pixels of a single image with black,
+    drawing them from the passed numpy random generator"""
+
+    num_holes, hole_size = (5, 4) if rng.uniform() < 0.5 else (20, 1)
+    h, w = image.shape[:2]
+
+    image = image.copy()
+    for y, x in zip(rng.integers(0, h, num_holes), rng.integers(0, w, num_holes)):
+        y1, x1 = max(0, y - hole_size // 2), max(0, x - hole_size // 2)
+        image[y1:y1 + hole_size, x1:x1 + hole_size] = 0
+
+    return image
 
-    return np.array(batch)
+
+def augment(image, seed):
+    """Apply the training augmentation (manual_augmentation with TRAINING_AUGMENTATION followed by a cutout)
+    to a single line image; the same seed always produces the same variations,
+    regardless of the thread that runs the augmentation"""
+
+    rng = np.random.default_rng(seed)
+    image = manual_augmentation(image[np.newaxis], rng=rng, **TRAINING_AUGMENTATION)[0]
+
+    return cutout_augmentation(image, rng)
 
 
 def adjust_to_see(img):
@@ -101,12 +112,30 @@ def normalize(images: list):
     """Normalize a list of images
     (typically a batch of images of lines to transcribe)"""
 
-    normalized_images = np.asarray(images).astype(np.float32)
-    normalized_images = np.expand_dims(normalized_images / 255, axis=-1)
+    images = np.asarray(images)
+
+    # divide directly into a float32 buffer with a trailing channel axis, without intermediate copies
+    normalized_images = np.empty(images.shape + (1,), dtype=np.float32)
+    np.divide(images, np.float32(255), out=normalized_images[..., 0])
 
     return normalized_images
 
 
+def background_color(image):
+    """Find the background color of a grayscale uint8 image as its most frequent pixel value"""
+
+    return int(np.argmax(np.bincount(np.asarray(image).ravel(), minlength=256)))
+
+
+def _fit_size(image_shape, input_size):
+    """Compute the size (width, height) that an image must be resized to in order to fit the input size"""
+
+    wt, ht, _ = input_size
+    h, w = image_shape
+    f = max((w / wt), (h / ht))
+    return max(min(wt, int(w / f)), 1), max(min(ht, int(h / f)), 1)
+
+
 def preprocess(image, input_size):
     """
     Preprocess methodology based on:
@@ -119,14 +148,11 @@ def preprocess(image, input_size):
     """
 
     # extract the background color
-    u, i = np.unique(np.array(image).flatten(), return_inverse=True)
-    background = int(u[np.argmax(np.bincount(i))])
+    background = background_color(image)
 
     # resize the image so that its can be "encased" in a rectangle of tne input size
     wt, ht, _ = input_size
-    h, w = np.asarray(image).shape
-    f = max((w / wt), (h / ht))
-    new_size = (max(min(wt, int(w / f)), 1), max(min(ht, int(h / f)), 1))
+    new_size = _fit_size(np.asarray(image).shape, input_size)
     resized_image = cv2.resize(image, new_size)
 
     # create a "background rectangle" of the target input size, homogeneously colored with the background color
@@ -140,3 +166,37 @@ def preprocess(image, input_size):
     output_image = cv2.transpose(output_image)
 
     return output_image
+
+
+def preprocess_batch(page_image, bounding_boxes, input_size, out=None, return_widths=False):
+    """
+    Crop and preprocess the lines of a page, writing all of them into a single (N, width, height) uint8 buffer.
+    Each line is processed as in preprocess, and it is already transposed when written into the buffer.
+
+    :param page_image: the grayscale image of a page
+    :param bounding_boxes: the N bounding boxes (x, y, width, height) of the lines to preprocess
+    :param input_size: the (width, height, channels) input size of the model
+    :param out: an optional preallocated (N, width, height) uint8 buffer to write the lines into
+    :param return_widths: if True, also return the widths of the resized lines (i.e., the columns of each line
+                          in the buffer that hold its content, rather than background padding)
+    :return: the buffer with the preprocessed lines (use normalize to feed it to the model),
+             and the (N,) int array of the widths of the resized lines if return_widths is True
+    """
+
+    wt, ht, _ = input_size
+    if out is None:
+        out = np.empty((len(bounding_boxes), wt, ht), dtype=np.uint8)
+    widths = np.empty(len(bounding_boxes), dtype=np.int32)
+
+    for i, (x, y, w, h) in enumerate(bounding_boxes):
+        line_image = page_image[y:y + h, x:x + w]
+        new_width, new_height = _fit_size(line_image.shape, input_size)
+
+        # fill the line with the background color, then paste the transposed resized line in its top left corner
+        out[i].fill(background_color(line_image))
+        out[i, :new_width, :new_height] = cv2.resize(line_image, (new_width, new_height)).T
+        widths[i] = new_width
+
+    if return_widths:
+        return out, widths
+    return out
@@ -17,13 +17,16 @@ from tensorflow.keras import backend as keras_backend
 from tensorflow.keras import Model
 
 from tensorflow.keras.callbacks import CSVLogger, TensorBoard, ModelCheckpoint
-from tensorflow.keras.callbacks import EarlyStopping, ReduceLROnPlateau
+from tensorflow.keras.callbacks import EarlyStopping, ReduceLROnPlateau, Callback
 from tensorflow.keras.constraints import MaxNorm
 
-from tensorflow.keras.layers import Bidirectional, LSTM, Dense, Conv2D, Multiply, Activation
+from tensorflow.keras.layers import Bidirectional, LSTM, Dense, Conv2D, Activation
 from tensorflow.keras.layers import Dropout, BatchNormalization, PReLU
 from tensorflow.keras.layers import Input, MaxPooling2D, Reshape
 
+import ctc_decoding
+import evaluation
+
 
 class HTRModel:
     """
@@ -47,13 +50,16 @@ class HTRModel:
                  top_paths=1,
                  stop_tolerance=20,
                  reduce_tolerance=15,
-                 cooldown=0):
+                 cooldown=0,
+                 decoder=None):
         """
         Initialization of a HTR Model.
 
         :param
             greedy, beam_width, top_paths: Parameters of the CTC decoding
             (see ctc decoding tensorflow for more details)
+            decoder: the CTC decoder backend, "numpy" or "tf"
+            (by default, numpy for greedy decoding and tf for beam search, see ctc_decoding)
         """
 
         self.input_size = input_size
@@ -63,6 +69,7 @@ class HTRModel:
         self.greedy = greedy
         self.beam_width = beam_width
         self.top_paths = max(1, top_paths)
+        self.decoder = decoder
 
         self.stop_tolerance = stop_tolerance
         self.reduce_tolerance = reduce_tolerance
@@ -89,10 +96,49 @@ class HTRModel:
 
             self.model.load_weights(target)
 
-    def get_callbacks(self, logdir, checkpoint, monitor="val_loss", verbose=0):
-        """Setup the list of callbacks for the model"""
+    def build_inference_model(self, target=None, variable_width=False):
+        """
+        Build an inference-only Keras model of the flor architecture, that outputs log-probabilities,
+        without compiling it (i.e., with no optimizer, learning rate schedule and loss);
+        if a target checkpoint file is passed, load its weights in the built model.
+        If variable_width is True, the model accepts input images of any width (a multiple of 4)
+        and outputs width / 2 time steps for each of them; the weights are the same as the fixed-width model.
+        """
+
+        input_size = self.input_size
+        if variable_width:
+            input_size = (None,) + tuple(input_size[1:])
+
+        inputs, outputs = self.flor_architecture(input_size, self.vocabulary_size + 1, log_softmax=True)
+        inference_model = Model(inputs=inputs, outputs=outputs)
+
+        if target is not None:
+            inference_model.load_weights(target)
+
+        return inference_model
 
-        callbacks = [
+    def get_callbacks(self, logdir, checkpoint, monitor="val_loss", verbose=0,
+                      validation_data=None, tokenizer=None, validation_steps=None, validation_freq=1):
+        """
+        Setup the list of callbacks for the model.
+
+        If validation_data and tokenizer are passed, the CER and WER on (the first validation_steps batches of)
+        validation_data are computed every validation_freq epochs and logged as "val_cer" and "val_wer",
+        so that they can also be the monitor of the checkpoints, the early stopping and the learning rate reduction.
+        """
+
+        callbacks = []
+        if validation_data is not None and tokenizer is not None:
+            # this must come first, so that the following callbacks see the metrics it adds to the epoch logs
+            callbacks.append(
+                CERValidation(
+                    data=validation_data,
+                    tokenizer=tokenizer,
+                    steps=validation_steps,
+                    frequency=validation_freq,
+                    verbose=verbose))
+
+        callbacks += [
             CSVLogger(
                 filename=os.path.join(logdir, "epochs.log"),
                 separator=";",
@@ -127,9 +173,12 @@ class HTRModel:
 
         return callbacks
 
-    def flor_architecture(self, input_size, d_model):
+    def flor_architecture(self, input_size, d_model, log_softmax=False):
         """
         Gated Convolutional Recurrent Neural Network by Flor et al.
+
+        If log_softmax is True, the output layer computes the log-probabilities instead of the probabilities
+        (the weights of the network are the same in both cases).
         """
 
         input_data = Input(name="input", shape=input_size)
@@ -163,24 +212,43 @@ class HTRModel:
 
         cnn = MaxPooling2D(pool_size=(1, 2), strides=(1, 2), padding="valid")(cnn)
 
+        # the width axis is left to the reshape, so that the architecture also accepts
+        # input images of variable width (i.e., input_size with None as its width)
         shape = cnn.get_shape()
-        bgru = Reshape((shape[1] * 2, -1))(cnn)
+        bgru = Reshape((-1, shape[2] * shape[3] // 2))(cnn)
         rnn_size = 128
         bgru = Bidirectional(LSTM(units=rnn_size, return_sequences=True, dropout=0.1))(bgru)
         bgru = Dense(units=256)(bgru)
 
         bgru = Bidirectional(LSTM(units=rnn_size, return_sequences=True, dropout=0.3))(bgru)
-        output_data = Dense(units=d_model, activation="softmax")(bgru)
+
+        # the output layer always computes in float32 (also under a mixed precision policy), for a stable CTC loss
+        if log_softmax:
+            output_data = Dense(units=d_model, dtype="float32")(bgru)
+            output_data = Activation(tf.nn.log_softmax, name="log_softmax", dtype="float32")(output_data)
+        else:
+            output_data = Dense(units=d_model, activation="softmax", dtype="float32")(bgru)
 
         return input_data, output_data
 
-    def compile(self, learning_rate=None, initial_step=0):
+    def compile(self, learning_rate=None, initial_step=0, precision="float32", jit_compile=False):
         """
         Configures the HTR Model for training/predict.
+
+        precision is the Keras dtype policy of the model: "float32", or "mixed_float16" (GPU)
+        and "mixed_bfloat16" (CPU) to compute in half precision while keeping the weights (and the checkpoints)
+        in float32; with mixed_float16, the loss is scaled to avoid gradient underflows.
+        If jit_compile is True, the training step is compiled with XLA
+        (with the CTC loss of xla_ctc_loss_lambda_func instead of ctc_loss_lambda_func).
         """
 
-        # define inputs and outputs based on the flor architecture
-        inputs, outputs = self.flor_architecture(self.input_size, self.vocabulary_size + 1)
+        # define inputs and outputs based on the flor architecture, with the layers built under the passed policy
+        global_policy = tf.keras.mixed_precision.global_policy()
+        tf.keras.mixed_precision.set_global_policy(precision)
+        try:
+            inputs, outputs = self.flor_architecture(self.input_size, self.vocabulary_size + 1)
+        finally:
+            tf.keras.mixed_precision.set_global_policy(global_policy)
 
         # define the schedule for the Learning Rate
         if learning_rate is None:
@@ -191,10 +259,14 @@ class HTRModel:
 
         # define the optimizer based on the defined Learning Rate
         optimizer = tf.keras.optimizers.RMSprop(learning_rate=learning_rate)
+        if precision == "mixed_float16":
+            optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
 
         # create and compile
         self.model = Model(inputs=inputs, outputs=outputs)
-        self.model.compile(optimizer=optimizer, loss=self.ctc_loss_lambda_func)
+        # XLA cannot compile the CTCLoss op, so the XLA compiled training step computes the loss with plain tensor ops
+        loss = self.xla_ctc_loss_lambda_func if jit_compile else self.ctc_loss_lambda_func
+        self.model.compile(optimizer=optimizer, loss=loss, jit_compile=jit_compile)
 
     def fit(self,
             x=None,
@@ -230,6 +302,10 @@ class HTRModel:
         if callbacks and self.learning_schedule:
             callbacks = [x for x in callbacks if not isinstance(x, ReduceLROnPlateau)]
 
+        # the generators that shuffle the data themselves and read it sequentially must be iterated in order
+        if getattr(x, "sequential_access", False):
+            shuffle = False
+
         out = self.model.fit(x=x, y=y, batch_size=batch_size, epochs=epochs, verbose=verbose,
                              callbacks=callbacks, validation_split=validation_split,
                              validation_data=validation_data, shuffle=shuffle,
@@ -258,7 +334,8 @@ class HTRModel:
         Provide x parameter of the form: yielding [x].
 
         :param: See tensorflow.keras.Model.predict()
-        :return: raw data on `ctc_decode=False` or CTC decode on `ctc_decode=True` (both with probabilities)
+        :return: the log-probabilities on `ctc_decode=False`,
+                 or the decoded labels and their log-probabilities on `ctc_decode=True` (see ctc_decoding)
         """
 
         if verbose == 1:
@@ -276,10 +353,9 @@ class HTRModel:
 
         if verbose == 1:
             print("CTC Decode")
-            progbar = tf.keras.utils.Progbar(target=steps)
 
         start_time = datetime.datetime.now()
-        predicts, probabilities = self.ctc_decode_tf(out)
+        predicts, probabilities = self.ctc_decode(np.log(out.clip(min=1e-8)))
         end_time = datetime.datetime.now()
         print('CTC Decode time', end_time - start_time)
 
@@ -311,16 +387,145 @@ class HTRModel:
         return loss
 
     @staticmethod
-    def ctc_decode_tf(y_pred):
-        """Decodes the output of a softmax.
+    def xla_ctc_loss_lambda_func(y_true, y_pred):
+        """Function for computing the CTC loss of the XLA compiled training step
+
+        The loss is computed by ctc_log_likelihood with plain tensor ops, since XLA cannot compile the CTCLoss op
+        of keras_backend.ctc_batch_cost (used by ctc_loss_lambda_func, see compile).
         """
-        y_pred = np.log(y_pred)
-        input_shape = tf.shape(y_pred)
-        sequence_length = tf.fill([input_shape[0]], input_shape[1])
-        decoded, neg_sum_logits = tf.nn.ctc_beam_search_decoder(tf.transpose(y_pred, perm=[1, 0, 2]),
-                                                                sequence_length, 10)
 
-        return decoded, neg_sum_logits
+        if len(y_true.shape) > 2:
+            y_true = tf.squeeze(y_true)
+
+        # y_pred.shape = (batch_size, string_length, alphabet_size_1_hot_encoded)
+        # output of every model is softmax, and all of its time steps are used
+        log_probabilities = tf.math.log(y_pred + keras_backend.epsilon())
+
+        # y_true strings are padded with 0
+        # so the number of non-zero gives number of characters in this string
+        y_true = tf.cast(y_true, "int32")
+        label_length = tf.math.count_nonzero(y_true, axis=-1, dtype="int32")
+
+        loss = -ctc_log_likelihood(y_true, log_probabilities, label_length)
+
+        # average loss across all entries in the batch
+        loss = tf.reduce_mean(loss)
+
+        return loss
+
+    def ctc_decode(self, log_probabilities, sequence_lengths=None):
+        """Decodes the log-probabilities output by the model,
+        with the decoder selected by the greedy, beam_width and decoder parameters of the model.
+        """
+        return ctc_decoding.ctc_decode(log_probabilities,
+                                       greedy=self.greedy,
+                                       beam_width=self.beam_width,
+                                       backend=self.decoder,
+                                       sequence_lengths=sequence_lengths)
+
+
+def ctc_log_likelihood(labels, log_probabilities, label_length):
+    """
+    Compute the CTC log-likelihood of the labels of each sample given all the time steps of its log-probabilities
+    (batch_size, time_steps, num_classes), where the CTC blank is the last class (as in keras_backend.ctc_batch_cost).
+
+    This is the forward algorithm over the labels interleaved with blanks, in log space and with a static number
+    of states, so that it only uses tensor ops supported by XLA (and its gradients are computed by autodiff).
+    """
+
+    batch_size, num_classes = tf.shape(labels)[0], tf.shape(log_probabilities)[2]
+    blank = num_classes - 1
+
+    # the states: a blank, the first label, a blank, the second label, ..., a blank
+    blanks = tf.fill(tf.shape(labels), blank)
+    states = tf.reshape(tf.stack([blanks, labels], axis=-1), [batch_size, -1])
+    states = tf.concat([states, blanks[:, :1]], axis=-1)
+
+    # a path can skip the blank between two labels if they are different
+    can_skip = tf.logical_and(states[:, 2:] != blank, states[:, 2:] != states[:, :-2])
+    can_skip = tf.concat([tf.zeros_like(can_skip[:, :2]), can_skip], axis=-1)
+
+    # (time_steps, batch_size, states) log-probabilities of the state labels
+    state_log_probabilities = tf.transpose(tf.gather(log_probabilities, states, axis=2, batch_dims=1), [1, 0, 2])
+
+    # a large finite value instead of -inf, to keep the gradients of the unreachable states finite
+    impossible = tf.fill([batch_size, 1], tf.constant(-1e30, dtype=log_probabilities.dtype))
+
+    def step(previous, current):
+        stay = previous
+        advance = tf.concat([impossible, previous[:, :-1]], axis=-1)
+        skip = tf.where(can_skip, tf.concat([impossible, impossible, previous[:, :-2]], axis=-1), impossible)
+        return tf.reduce_logsumexp(tf.stack([stay, advance, skip]), axis=0) + current
+
+    # the paths start in the first blank or in the first label
+    first = state_log_probabilities[0]
+    initial = tf.where(tf.range(tf.shape(states)[1]) < 2, first, impossible)
+    last = tf.scan(step, state_log_probabilities[1:], initializer=initial)[-1]
+
+    # the paths end in the last blank or in the last label
+    final_blank = tf.gather(last, 2 * label_length, axis=1, batch_dims=1)
+    final_label = tf.gather(last, tf.maximum(2 * label_length - 1, 0), axis=1, batch_dims=1)
+    final_label = tf.where(label_length > 0, final_label, impossible[:, 0])
+
+    return tf.reduce_logsumexp(tf.stack([final_blank, final_label]), axis=0)
+
+
+class CERValidation(Callback):
+    """
+    Keras callback that computes the Character Error Rate (CER) and Word Error Rate (WER) of the model
+    on validation data at the end of every frequency epochs, and adds them to the epoch logs
+    as "val_cer" and "val_wer" (so that CSVLogger and TensorBoard record them).
+
+    The batches are transcribed one at a time with best path decoding, and the metrics are accumulated batch by batch,
+    so that no predictions of the whole validation set are held in memory.
+    """
+
+    def __init__(self, data, tokenizer, steps=None, frequency=1, verbose=0):
+        """
+        :param data: the validation data, as a Keras Sequence or a tf.data.Dataset of (x, y) batches
+        :param tokenizer: the tokenizer that encoded the labels y
+        :param steps: the number of batches to evaluate (by default, all of them)
+        :param frequency: the number of epochs between two evaluations
+        """
+        super(CERValidation, self).__init__()
+
+        self.data = data
+        self.tokenizer = tokenizer
+        self.steps = steps
+        self.frequency = frequency
+        self.verbose = verbose
+
+    def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.frequency != 0:
+            return
+
+        cer_sum, wer_sum, count = 0.0, 0.0, 0
+        for step, (x, y) in enumerate(self.data):
+            if self.steps is not None and step >= self.steps:
+                break
+
+            probabilities = np.asarray(self.model.predict_on_batch(x))
+            predictions, _ = ctc_decoding.best_path_decode(np.log(probabilities.clip(min=1e-8)))
+
+            report = evaluation.evaluate_ocr(self.tokenizer.decode_batch(predictions),
+                                             self.tokenizer.decode_batch(np.asarray(y)),
+                                             norm_accentuation=True,
+                                             norm_punctuation=True,
+                                             processes=1)
+
+            cer_sum += report["samples"]["cer"].sum()
+            wer_sum += report["samples"]["wer"].sum()
+            count += len(report["samples"]["cer"])
+
+        if count == 0:
+            return
+
+        logs = logs if logs is not None else {}
+        logs["val_cer"] = cer_sum / count
+        logs["val_wer"] = wer_sum / count
+
+        if self.verbose:
+            print(f"\nEpoch {epoch + 1}: val_cer {logs['val_cer']:.6f} - val_wer {logs['val_wer']:.6f}")
 
 
 class CustomSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
@@ -373,11 +578,11 @@ class FullGatedConv2D(Conv2D):
     def call(self, inputs):
         """Apply gated convolution"""
 
+        # plain tensor operations (rather than new Activation and Multiply layers at each call), that XLA can fuse
         output = super(FullGatedConv2D, self).call(inputs)
-        linear = Activation("linear")(output[:, :, :, :self.nb_filters])
-        sigmoid = Activation("sigmoid")(output[:, :, :, self.nb_filters:])
+        linear, gate = tf.split(output, 2, axis=-1)
 
-        return Multiply()([linear, sigmoid])
+        return linear * tf.sigmoid(gate)
 
     def compute_output_shape(self, input_shape):
         """Compute shape of layer output"""
@@ -0,0 +1,107 @@
+"""
+Lightweight inference runtimes for the HTR model.
+
+Each runtime only computes the log-probabilities of a batch of normalized line images:
+    KerasRuntime: builds the inference-only flor architecture and loads the weights of a Keras checkpoint
+    SavedModelRuntime: loads an inference SavedModel written by scripts/export_model.py
+    TFLiteRuntime: loads a TFLite model written by scripts/export_model.py
+
+Use load_runtime to pick the runtime that matches a model path.
+The variable_width attribute of a runtime tells whether it accepts batches of line images narrower than the input size.
+"""
+
+import os
+import numpy as np
+import tensorflow as tf
+
+from model import HTRModel
+
+# name of the input and output of the serving signature of the exported models
+INPUT_NAME = "input"
+OUTPUT_NAME = "log_probabilities"
+
+
+class KerasRuntime:
+    """Runs a Keras checkpoint (.hdf5) through the inference-only flor architecture"""
+
+    variable_width = True
+
+    def __init__(self, model_path, input_size, vocabulary_size):
+        htr_model = HTRModel(input_size=input_size, vocabulary_size=vocabulary_size)
+        self.model = htr_model.build_inference_model(target=model_path, variable_width=True)
+
+        # call the model directly in a compiled graph, skipping the Keras predict machinery
+        self._predict = tf.function(lambda x: self.model(x, training=False), reduce_retracing=True)
+
+    def predict(self, x):
+        return self._predict(tf.convert_to_tensor(x)).numpy()
+
+
+class SavedModelRuntime:
+    """Runs an exported inference SavedModel (a directory)"""
+
+    def __init__(self, model_path):
+        self.model = tf.saved_model.load(model_path)
+        self._signature = self.model.signatures["serving_default"]
+
+        # the models exported by older versions of scripts/export_model.py only accept the full input width
+        input_shape = self._signature.structured_input_signature[1][INPUT_NAME].shape
+        self.variable_width = input_shape[1] is None
+
+    def predict(self, x):
+        return self._signature(**{INPUT_NAME: tf.convert_to_tensor(x)})[OUTPUT_NAME].numpy()
+
+
+class TFLiteRuntime:
+    """Runs an exported TFLite model (.tflite)"""
+
+    variable_width = False
+
+    def __init__(self, model_path=None, model_content=None, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=model_path,
+                                               model_content=model_content,
+                                               num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self._input_index = self.interpreter.get_input_details()[0]["index"]
+        self._output_index = self.interpreter.get_output_details()[0]["index"]
+
+    def predict(self, x):
+        x = np.asarray(x, dtype=np.float32)
+
+        # the interpreter tensors must be resized when the batch size changes
+        if tuple(self.interpreter.get_input_details()[0]["shape"]) != x.shape:
+            self.interpreter.resize_tensor_input(self._input_index, x.shape)
+            self.interpreter.allocate_tensors()
+
+        self.interpreter.set_tensor(self._input_index, x)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self._output_index).copy()
+
+
+def configure_threads(intra_op_threads, inter_op_threads):
+    """
+    Pin the size of the tensorflow thread pools of the current process
+    (this must happen before the tensorflow runtime is initialized, i.e. before running any operation).
+    """
+
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+
+def load_runtime(model_path, input_size, vocabulary_size, model_content=None, num_threads=None):
+    """
+    Load the runtime that matches the passed model path:
+    a directory is an exported SavedModel, a .tflite file is an exported TFLite model,
+    and any other file is a Keras checkpoint.
+    The content of a TFLite model file can be passed as model_content, if it has already been read.
+    """
+
+    if os.path.isdir(model_path):
+        return SavedModelRuntime(model_path)
+
+    if model_path.endswith(".tflite"):
+        if model_content is not None:
+            return TFLiteRuntime(model_content=model_content, num_threads=num_threads)
+        return TFLiteRuntime(model_path=model_path, num_threads=num_threads)
+
+    return KerasRuntime(model_path, input_size=input_size, vocabulary_size=vocabulary_size)
@@ -0,0 +1,84 @@
+import argparse
+import sys
+import os
+import logging
+import time
+import h5py
+
+# the modules of the OCR service import each other by their flat names (as in server.py)
+sys.path.append(os.path.realpath(os.path.join(os.path.abspath(__file__), os.path.pardir, os.path.pardir)))
+
+from model import HTRModel
+from tokenization import Tokenizer
+from image_processing import normalize
+from config import OCR_INPUT_IMAGE_SHAPE, OCR_MAX_TEXT_LENGTH, CHARSET_BASE, data_path
+import ctc_decoding
+import evaluation
+
+try:
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
+    logging.disable(logging.WARNING)
+except AttributeError:
+    pass
+
+parser = argparse.ArgumentParser(
+    description="Compare throughput and CER of the CTC decoders on the test split of an HDF5 dataset"
+)
+
+parser.add_argument('--dataset',
+                    help="Name of the dataset to use, as an HDF5 file",
+                    required=True)
+
+parser.add_argument('--model_path',
+                    help="Path to the model checkpoint to load",
+                    required=True)
+
+parser.add_argument('--samples',
+                    default=1024,
+                    type=int,
+                    help="Number of test samples to decode")
+
+parser.add_argument('--beam_widths',
+                    default=[4, 10],
+                    type=int,
+                    nargs='+',
+                    help="Beam widths to benchmark for the beam search decoders")
+
+# parse the passed arguments
+args = parser.parse_args()
+dataset_path = os.path.join(os.path.abspath(data_path), args.dataset + ".hdf5")
+
+tokenizer = Tokenizer(CHARSET_BASE, OCR_MAX_TEXT_LENGTH)
+
+with h5py.File(dataset_path, "r") as source:
+    samples = source["test"]["dt"][:args.samples]
+    ground_truth = [x.decode() for x in source["test"]["gt"][:args.samples]]
+
+htr_model = HTRModel(input_size=OCR_INPUT_IMAGE_SHAPE,
+                     vocabulary_size=tokenizer.vocab_size)
+htr_model.compile(learning_rate=0.001)
+htr_model.load_checkpoint(target=args.model_path)
+
+# run the model once: all the decoders work on the same log-probabilities
+log_probabilities, _ = htr_model.predict(normalize(samples), batch_size=16, steps=None, ctc_decode=False)
+print(f"Test samples: {len(samples)}")
+
+decoders = [("numpy best path", dict(greedy=True, backend="numpy")),
+            ("tf greedy", dict(greedy=True, backend="tf"))]
+for beam_width in args.beam_widths:
+    decoders.append((f"numpy prefix beam ({beam_width})", dict(greedy=False, beam_width=beam_width, backend="numpy")))
+    decoders.append((f"tf beam search ({beam_width})", dict(greedy=False, beam_width=beam_width, backend="tf")))
+
+print(f"{'Decoder':<28}{'Lines/sec':>12}{'CER':>12}")
+for name, decoder_parameters in decoders:
+    start_time = time.perf_counter()
+    predicts, _ = ctc_decoding.ctc_decode(log_probabilities, **decoder_parameters)
+    elapsed_time = time.perf_counter() - start_time
+
+    predicts = tokenizer.decode_batch(predicts)
+    evaluate = evaluation.ocr_metrics(predicts,
+                                      ground_truth,
+                                      norm_accentuation=True,
+                                      norm_punctuation=True)
+
+    print(f"{name:<28}{len(log_probabilities) / elapsed_time:>12.1f}{evaluate[0]:>12.6f}")
@@ -0,0 +1,70 @@
+import argparse
+import sys
+import os
+import logging
+import time
+import numpy as np
+
+# the modules of the OCR service import each other by their flat names (as in server.py)
+sys.path.append(os.path.realpath(os.path.join(os.path.abspath(__file__), os.path.pardir, os.path.pardir)))
+
+from model import HTRModel
+from tokenization import Tokenizer
+from config import OCR_INPUT_IMAGE_SHAPE, OCR_MAX_TEXT_LENGTH, CHARSET_BASE
+
+try:
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
+    logging.disable(logging.WARNING)
+except AttributeError:
+    pass
+
+parser = argparse.ArgumentParser(
+    description="Compare the training step time of the OCR model with different precision policies and XLA"
+)
+
+parser.add_argument('--batch_size',
+                    default=16,
+                    type=int,
+                    help="Number of samples in each mini-batch")
+
+parser.add_argument('--steps',
+                    default=20,
+                    type=int,
+                    help="Number of timed training steps (after one warm-up step) for each configuration")
+
+parser.add_argument('--precisions',
+                    default=["float32", "mixed_bfloat16"],
+                    nargs='+',
+                    choices=["float32", "mixed_float16", "mixed_bfloat16"],
+                    help="Precision policies to benchmark (mixed_bfloat16 on CPU, mixed_float16 on GPU)")
+
+parser.add_argument('--no_xla',
+                    action="store_true",
+                    help="Only benchmark the configurations without XLA")
+
+# parse the passed arguments
+args = parser.parse_args()
+
+tokenizer = Tokenizer(CHARSET_BASE, OCR_MAX_TEXT_LENGTH)
+
+# random line images and labels: the step time does not depend on the actual contents
+x = np.random.uniform(size=(args.batch_size,) + OCR_INPUT_IMAGE_SHAPE).astype(np.float32)
+y = np.random.randint(2, tokenizer.vocab_size, size=(args.batch_size, OCR_MAX_TEXT_LENGTH // 2)).astype(np.int16)
+y = np.pad(y, ((0, 0), (0, OCR_MAX_TEXT_LENGTH - y.shape[1])))
+
+print(f"{'Precision':<18}{'XLA':>6}{'ms/step':>12}{'Lines/sec':>12}")
+for precision in args.precisions:
+    for jit_compile in (False,) if args.no_xla else (False, True):
+        htr_model = HTRModel(input_size=OCR_INPUT_IMAGE_SHAPE,
+                             vocabulary_size=tokenizer.vocab_size)
+        htr_model.compile(learning_rate=0.001, precision=precision, jit_compile=jit_compile)
+
+        # the first step traces and compiles the training function
+        htr_model.model.train_on_batch(x, y)
+
+        start_time = time.perf_counter()
+        for _ in range(args.steps):
+            htr_model.model.train_on_batch(x, y)
+        elapsed_time = (time.perf_counter() - start_time) / args.steps
+
+        print(f"{precision:<18}{str(jit_compile):>6}{elapsed_time * 1000:>12.1f}{args.batch_size / elapsed_time:>12.1f}")
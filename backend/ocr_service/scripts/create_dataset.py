@@ -5,7 +5,6 @@ import multiprocessing
 import os
 import re
 import string
-from functools import partial
 from pathlib import Path
 import cv2
 import h5py
@@ -146,10 +145,35 @@ if __name__ == '__main__':
                         help="Name of the dataset to create as an HDF5 file",
                         required=True)
 
+    parser.add_argument('--batch_size',
+                        default=16,
+                        type=int,
+                        help="Number of line images in each HDF5 chunk (use the training mini-batch size)")
+
+    parser.add_argument('--compression',
+                        default="lzf",
+                        choices=["lzf", "gzip", "none"],
+                        help="Compression filter of the line images")
+
+    parser.add_argument('--compression_level',
+                        default=4,
+                        type=int,
+                        help="Compression level, if the gzip compression filter is used")
+
+    parser.add_argument('--workers',
+                        default=multiprocessing.cpu_count(),
+                        type=int,
+                        help="Number of processes that read and preprocess the line images")
+
+    parser.add_argument('--resume',
+                        action="store_true",
+                        help="Resume the creation of a dataset that was interrupted, instead of starting over")
+
     # parse the passed arguments
     args = parser.parse_args()
     dataset_name = args.dataset_name
     source_path = args.source_path
+    batch_size = args.batch_size
     assert (os.path.isdir(source_path))
 
     # the path of the HDF5 dataset to create
@@ -200,43 +224,78 @@ if __name__ == '__main__':
                 continue
 
     os.makedirs(os.path.dirname(target_path), exist_ok=True)
-    total = 0
 
-    with h5py.File(target_path, "w") as hf:
+    compression = {"lzf": {"compression": "lzf"},
+                   "gzip": {"compression": "gzip", "compression_opts": args.compression_level},
+                   "none": {}}[args.compression]
+
+    resume = args.resume and os.path.isfile(target_path)
+
+    # the file is only opened once, and this process is its only writer:
+    # the worker processes just read and preprocess the line images, and send them back in order
+    with h5py.File(target_path, "a" if resume else "w") as hf, \
+            multiprocessing.Pool(args.workers) as pool:
+
+        # the transcriptions (and their encoded labels) are written right away, whereas the line images are written chunk by chunk;
+        # the "written" attribute of each partition counts its line images already stored,
+        # so that an interrupted run can be resumed from the first missing chunk
         for partition in partitions:
             size = (len(dataset[partition]['dt']),) + OCR_INPUT_IMAGE_SHAPE[:2]
-            total += size[0]
-
-            dummy_image = numpy.zeros(size, dtype=numpy.uint8)
-            dummy_sentence = [("c" * OCR_MAX_TEXT_LENGTH).encode()] * size[0]
             print("Size", size)
-            hf.create_dataset(f"{partition}/dt", data=dummy_image, compression="gzip", compression_opts=9)
-            hf.create_dataset(f"{partition}/gt", data=dummy_sentence, compression="gzip", compression_opts=9)
 
-    pbar = tqdm(total=total)
-    batch_size = 60
+            # the "written" attribute is set last, so a partition without it was not fully created
+            if resume and partition in hf and "written" in hf[partition].attrs:
+                if hf[f"{partition}/dt"].shape != size:
+                    raise Exception(f"Cannot resume {target_path}: the {partition} partition has a different size")
+                continue
+
+            # a partition whose creation was interrupted is created again
+            if partition in hf:
+                del hf[partition]
+
+            # the line images are chunked by batches; an empty partition cannot be chunked, so h5py picks its layout
+            chunk_size = min(batch_size, size[0])
+
+            # no dummy data is written: the chunks are only allocated when the line images are written
+            hf.create_dataset(f"{partition}/dt", shape=size, dtype=numpy.uint8,
+                              chunks=(chunk_size,) + size[1:] if chunk_size else None, **compression)
+            hf.create_dataset(f"{partition}/gt", data=numpy.array([s.encode() for s in dataset[partition]["gt"]], dtype=bytes), **compression)
+
+            # the labels are also stored already encoded, so that the training generators do not re-encode them
+            labels, label_lengths = tokenizer.encode_batch(dataset[partition]["gt"])
+            hf.create_dataset(f"{partition}/labels", data=labels,
+                              chunks=(chunk_size, OCR_MAX_TEXT_LENGTH) if chunk_size else None, **compression)
+            hf.create_dataset(f"{partition}/label_lengths", data=label_lengths)
+            # the tokenizer settings the labels were encoded with, checked by the generators before using them
+            hf[partition].attrs["charset"] = tokenizer.chars
+            hf[partition].attrs["max_text_length"] = tokenizer.maxlen
+            hf[partition].attrs["written"] = 0
+
+        written = {partition: int(hf[partition].attrs["written"]) for partition in partitions}
+        total = sum(len(dataset[partition]['dt']) - written[partition] for partition in partitions)
+        pbar = tqdm(total=total, unit="img")
+
+        # for each partition, read and preprocess the missing line images in the worker processes,
+        # and write them in the output dataset one chunk at a time
+        for partition in partitions:
+            image_paths = dataset[partition]['dt']
+            images = pool.imap(read_and_preprocess_image, image_paths[written[partition]:], chunksize=batch_size)
 
-    # for each partition, for each couple of line image and transcription
-    #   - read and preprocess the line images (in a multi-process fashion for better efficiency)
-    #   - write the images and transcriptions in the output dataset
-    for partition in partitions:
-        for batch in range(0, len(dataset[partition]['gt']), batch_size):
+            for batch in range(written[partition], len(image_paths), batch_size):
+                batch_images = [next(images) for _ in image_paths[batch:batch + batch_size]]
+                for image, image_path in zip(batch_images, image_paths[batch:batch + batch_size]):
+                    if image is None:
+                        raise Exception(f"Cannot read {image_path}: fix or remove it, then resume with --resume")
 
-            #with multiprocessing.Pool(multiprocessing.cpu_count()) as pool:
-            #    r = pool.map(partial(read_and_preprocess_image),
-            #                 dataset[partition]['dt'][batch:batch + batch_size])
-            #    images.append(r)
-            #    pool.close()
-            #    pool.join()
+                hf[f"{partition}/dt"][batch:batch + len(batch_images)] = batch_images
+                hf[partition].attrs["written"] = batch + len(batch_images)
+                hf.flush()
 
-            with h5py.File(target_path, "a") as hf:
-                hf[f"{partition}/dt"][batch:batch + batch_size] = [read_and_preprocess_image(im) for im in
-                                                                   dataset[partition]['dt'][batch:batch + batch_size]]
-                hf[f"{partition}/gt"][batch:batch + batch_size] = [s.encode() for s in
-                                                                   dataset[partition]['gt'][batch:batch + batch_size]]
+                pbar.update(len(batch_images))
 
-                pbar.update(batch_size)
+        pbar.close()
 
     total_time = datetime.datetime.now() - start_time
 
     print(total_time)
+    print(f"{total / max(total_time.total_seconds(), 1e-6):.1f} images/sec")
@@ -4,12 +4,13 @@ import os
 import logging
 import tensorflow as tf
 
-sys.path.append(os.path.realpath(os.path.join(os.path.abspath(__file__), os.path.pardir, os.path.pardir, os.path.pardir, os.path.pardir)))
+# the modules of the OCR service import each other by their flat names (as in server.py)
+sys.path.append(os.path.realpath(os.path.join(os.path.abspath(__file__), os.path.pardir, os.path.pardir)))
 
-from backend.ocr_service.dataset import HDF5Dataset
-from backend.ocr_service.model import HTRModel
-from backend.ocr_service.config import OCR_INPUT_IMAGE_SHAPE, OCR_MAX_TEXT_LENGTH, CHARSET_BASE, data_path
-import backend.ocr_service.evaluation as evaluation
+from dataset import HDF5Dataset
+from model import HTRModel
+from config import OCR_INPUT_IMAGE_SHAPE, OCR_MAX_TEXT_LENGTH, CHARSET_BASE, data_path
+import evaluation
 
 try:
     os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
@@ -65,27 +66,28 @@ htr_model.load_checkpoint(target=model_path)
 # predict() function will return the predicts with the probabilities
 predicts, prob = htr_model.predict(x=dataset.test_data_generator,
                                    batch_size=16,
-                                   steps=1,
+                                   steps=None,
                                    ctc_decode=True,
                                    verbose=1,
                                    use_multiprocessing=False)
 
-predicts = tf.sparse.to_dense(predicts[0]).numpy()
-prob = prob.numpy()
-
 # decode to string
-predicts = [dataset.tokenizer.decode(x) for x in predicts]
+predicts = dataset.tokenizer.decode_batch(predicts)
 ground_truth = [x.decode() for x in dataset.test_data_generator.labels]
-evaluate = evaluation.ocr_metrics(predicts,
-                                  ground_truth,
-                                  norm_accentuation=True,
-                                  norm_punctuation=True)
+report = evaluation.evaluate_ocr(predicts,
+                                 ground_truth,
+                                 norm_accentuation=True,
+                                 norm_punctuation=True)
 
 e_corpus = "\n".join([
     f"Metrics:",
-    f"Character Error Rate: {evaluate[0]:.8f}",
-    f"Word Error Rate:      {evaluate[1]:.8f}",
-    f"Sequence Error Rate:  {evaluate[2]:.8f}"
+    f"Character Error Rate: {report['cer']:.8f}",
+    f"Word Error Rate:      {report['wer']:.8f}",
+    f"Sequence Error Rate:  {report['ser']:.8f}",
+    f"Errors:",
+    *[f"{unit.capitalize():<10}   substitutions: {errors['substitutions']}, insertions: {errors['insertions']}, "
+      f"deletions: {errors['deletions']} (out of {errors['reference_length']})"
+      for unit, errors in (("characters", report["characters"]), ("words", report["words"]))]
 ])
 
 print(e_corpus)
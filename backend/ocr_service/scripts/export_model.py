@@ -0,0 +1,65 @@
+import argparse
+import sys
+import os
+import logging
+import tensorflow as tf
+
+# the modules of the OCR service import each other by their flat names (as in server.py)
+sys.path.append(os.path.realpath(os.path.join(os.path.abspath(__file__), os.path.pardir, os.path.pardir)))
+
+from model import HTRModel
+from tokenization import Tokenizer
+from runtime import INPUT_NAME, OUTPUT_NAME
+from config import OCR_INPUT_IMAGE_SHAPE, OCR_MAX_TEXT_LENGTH, CHARSET_BASE
+
+try:
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
+    logging.disable(logging.WARNING)
+except AttributeError:
+    pass
+
+parser = argparse.ArgumentParser(
+    description="Export an OCR model checkpoint as an inference-only SavedModel (and optionally as a TFLite model)"
+)
+
+parser.add_argument('--model_path',
+                    help="Path to the model checkpoint to export",
+                    required=True)
+
+parser.add_argument('--output_path',
+                    help="Path of the SavedModel directory to create",
+                    required=True)
+
+parser.add_argument('--tflite_path',
+                    help="Path of the dynamic-range quantized TFLite model to create (optional)",
+                    default=None)
+
+# parse the passed arguments
+args = parser.parse_args()
+
+tokenizer = Tokenizer(CHARSET_BASE, OCR_MAX_TEXT_LENGTH)
+
+# build the inference-only model: no optimizer, and the softmax and log fused in the output layer;
+# the SavedModel accepts line images of variable width, so that the server can batch them by width
+htr_model = HTRModel(input_size=OCR_INPUT_IMAGE_SHAPE,
+                     vocabulary_size=tokenizer.vocab_size)
+inference_model = htr_model.build_inference_model(target=args.model_path, variable_width=True)
+
+
+@tf.function(input_signature=[tf.TensorSpec(shape=(None, None) + OCR_INPUT_IMAGE_SHAPE[1:], dtype=tf.float32, name=INPUT_NAME)])
+def serve(x):
+    return {OUTPUT_NAME: inference_model(x, training=False)}
+
+
+tf.saved_model.save(inference_model, args.output_path, signatures={"serving_default": serve})
+print("SavedModel exported to", args.output_path)
+
+if args.tflite_path is not None:
+    converter = tf.lite.TFLiteConverter.from_saved_model(args.output_path)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    # the bidirectional LSTM layers may need TF ops that are not TFLite builtins
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+
+    with open(args.tflite_path, "wb") as tflite_output:
+        tflite_output.write(converter.convert())
+    print("TFLite model exported to", args.tflite_path)
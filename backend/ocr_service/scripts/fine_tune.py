@@ -6,13 +6,14 @@ import logging
 import tensorflow as tf
 import datetime
 
-sys.path.append(os.path.realpath(os.path.join(os.path.abspath(__file__), os.path.pardir, os.path.pardir, os.path.pardir, os.path.pardir)))
+# the modules of the OCR service import each other by their flat names (as in server.py)
+sys.path.append(os.path.realpath(os.path.join(os.path.abspath(__file__), os.path.pardir, os.path.pardir)))
 
-from backend.ocr_service.dataset import HDF5Dataset
-from backend.ocr_service.model import HTRModel
-from backend.ocr_service.config import STORED_MODELS_PATH, \
+from dataset import HDF5Dataset
+from model import HTRModel
+from config import STORED_MODELS_PATH, \
     OCR_INPUT_IMAGE_SHAPE, OCR_MAX_TEXT_LENGTH, CHARSET_BASE, data_path
-import backend.ocr_service.evaluation as evaluation
+import evaluation
 
 try:
     os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
@@ -64,8 +65,46 @@ parser.add_argument('--valid',
                     type=float,
                     help="Number of epochs before validation.")
 
+parser.add_argument('--tf_data',
+                    action="store_true",
+                    help="Feed the model with a tf.data pipeline (parallel augmentation and prefetch) "
+                         "instead of the Keras generators")
+
+parser.add_argument('--cache_path',
+                    default=None,
+                    help="Path prefix of the on-disk cache of the un-augmented samples (only with --tf_data)")
+
+parser.add_argument('--shuffle_buffer_size',
+                    default=1024,
+                    type=int,
+                    help="Number of training samples shuffled in memory (only with --tf_data)")
+
+parser.add_argument('--cer_steps',
+                    default=None,
+                    type=int,
+                    help="Compute the validation CER and WER at each validation, on this number of batches "
+                         "(-1 for the whole validation set)")
+
+parser.add_argument('--monitor',
+                    default="val_loss",
+                    choices=["val_loss", "val_cer"],
+                    help="Validation metric that selects the best checkpoint (val_cer requires --cer_steps)")
+
+parser.add_argument('--precision',
+                    default="float32",
+                    choices=["float32", "mixed_float16", "mixed_bfloat16"],
+                    help="Precision policy of the training (mixed_float16 on GPU, mixed_bfloat16 on CPU)")
+
+parser.add_argument('--jit_compile',
+                    action="store_true",
+                    help="Compile the training step with XLA")
+
 # parse the passed arguments
 args = parser.parse_args()
+
+# the validation CER is only computed (and logged for the checkpoints) if --cer_steps is passed
+if args.monitor == "val_cer" and args.cer_steps is None:
+    parser.error("--monitor val_cer requires --cer_steps")
 dataset_path = args.dataset_path
 base_model = args.base_model
 model_name = args.model_name
@@ -85,10 +124,13 @@ print("Output model folder: ", output_model_folder_path)
 # define input size, number max of characters per line and list of valid characters
 
 # load the dataset to use in training, validation and testing
+# (with --tf_data, the samples are streamed from the HDF5 file instead of being loaded in memory)
 dataset = HDF5Dataset(source_path=dataset_path,
                       batch_size=batch_size,
                       charset=CHARSET_BASE,
-                      max_text_length=OCR_MAX_TEXT_LENGTH)
+                      max_text_length=OCR_MAX_TEXT_LENGTH,
+                      stream=args.tf_data,
+                      shuffle_buffer_size=args.shuffle_buffer_size)
 print(f"Train images:      {dataset.training_set_size}")
 print(f"Validation images: {dataset.valid_set_size }")
 print(f"Test images:       {dataset.test_set_size}")
@@ -100,20 +142,32 @@ htr_model = HTRModel(input_size=OCR_INPUT_IMAGE_SHAPE,
                      stop_tolerance=25,
                      reduce_tolerance=20)
 
-htr_model.compile(learning_rate=learning_rate)
+htr_model.compile(learning_rate=learning_rate, precision=args.precision, jit_compile=args.jit_compile)
 htr_model.summary(output_model_folder_path, "summary.txt")
 
 htr_model.load_checkpoint(target=base_model)
+if args.tf_data:
+    training_data = dataset.tf_dataset("train", training=True, cache_path=args.cache_path)
+    validation_data = dataset.tf_dataset("valid")
+else:
+    training_data = dataset.training_data_generator
+    validation_data = dataset.valid_data_generator
+
 callbacks = htr_model.get_callbacks(logdir=output_model_folder_path,
                                     checkpoint=checkpoint_path,
-                                    verbose=1)
+                                    monitor=args.monitor,
+                                    verbose=1,
+                                    validation_data=validation_data if args.cer_steps is not None else None,
+                                    tokenizer=dataset.tokenizer,
+                                    validation_steps=args.cer_steps if args.cer_steps != -1 else None,
+                                    validation_freq=validation_interval)
 
 # to calculate total and average time per epoch
 start_time = datetime.datetime.now()
 
-htr_model_history = htr_model.fit(x=dataset.training_data_generator,
+htr_model_history = htr_model.fit(x=training_data,
                                   epochs=epochs,
-                                  validation_data=dataset.valid_data_generator,
+                                  validation_data=validation_data,
                                   validation_freq=validation_interval,
                                   callbacks=callbacks,
                                   verbose=1)
@@ -122,9 +176,10 @@ training_time = datetime.datetime.now() - start_time
 
 loss = htr_model_history.history['loss']
 val_loss = htr_model_history.history['val_loss']
+monitored = htr_model_history.history[args.monitor]
 
-min_val_loss = min(val_loss)
-min_val_loss_i = val_loss.index(min_val_loss)
+min_val_loss_i = monitored.index(min(monitored))
+min_val_loss = val_loss[min_val_loss_i]
 
 avg_epoch_time = (training_time / len(loss))
 best_epoch = (min_val_loss_i + 1) * validation_interval
@@ -153,18 +208,15 @@ htr_model.load_checkpoint(target=best_checkpoint_path)
 
 # predict() function will return the predicts with the probabilities
 predicts, prob = htr_model.predict(x=dataset.test_data_generator,
-                                   steps=1,
+                                   steps=None,
                                    ctc_decode=True,
                                    verbose=1,
                                    use_multiprocessing=False)
 
 print("--- %s seconds ---" % (time.time() - start_time))
 
-predicts = tf.sparse.to_dense(predicts[0]).numpy()
-prob = prob.numpy()
-
 # decode to string
-predicts = [dataset.tokenizer.decode(x) for x in predicts]
+predicts = dataset.tokenizer.decode_batch(predicts)
 ground_truth = [x.decode() for x in dataset.test_data_generator.labels]
 
 # mount predict corpus file
@@ -5,32 +5,65 @@ import flask
 from flask_cors import CORS
 import datetime
 import cv2
-from config import OCR_INPUT_IMAGE_SHAPE, CHARSET_BASE, OCR_MAX_TEXT_LENGTH, MODEL_PATH
+from config import OCR_INPUT_IMAGE_SHAPE, CHARSET_BASE, OCR_MAX_TEXT_LENGTH, MODEL_PATH, \
+    OCR_BATCH_SIZE, OCR_BATCH_MAX_WAIT, OCR_CACHE_SIZE, OCR_CACHE_PATH, \
+    OCR_CACHE_DB_SIZE, OCR_WIDTH_BUCKETS
 from transcriptor import Transcriptor
 
 app = flask.Flask(__name__)
 CORS(app, support_credentials=True)
 
-transcriptor = Transcriptor(model_path=MODEL_PATH,
-                            input_image_size=OCR_INPUT_IMAGE_SHAPE,
-                            max_text_length=OCR_MAX_TEXT_LENGTH,
-                            charset=CHARSET_BASE)
+# the transcriptor is created by init_transcriptor: when the server runs with multiple worker processes
+# (see gunicorn.conf.py) each worker creates its own transcriptor after it is forked
+transcriptor = None
 
 
-@app.route("/ocr", methods=["POST"])
-def ocr():
+def init_transcriptor(model_content=None, num_threads=None):
     """
-    This method exposes the service API to perform OCR on the lines of page image.
-    The API can be called by sending an HTTP POST request to the /ocr path of the exposed server address.
-    The following fields should be presentin the HTTP POST request:
-        - a 'file' field with the file containing the image of the page to perform OCR on
-        - a 'boxes' image with the list of coordinates for the bounding boxes of all the lines on the page
+    Create the transcriptor that serves the OCR requests.
+
+    :param model_content: the content of the model file, if it was already read (e.g., before forking the workers)
+    :param num_threads: the number of threads of the TFLite runtime (if used)
+    """
+    global transcriptor
+
+    transcriptor = Transcriptor(model_path=MODEL_PATH,
+                                input_image_size=OCR_INPUT_IMAGE_SHAPE,
+                                max_text_length=OCR_MAX_TEXT_LENGTH,
+                                charset=CHARSET_BASE,
+                                batch_size=OCR_BATCH_SIZE,
+                                max_batch_wait=OCR_BATCH_MAX_WAIT,
+                                cache_size=OCR_CACHE_SIZE,
+                                cache_path=OCR_CACHE_PATH,
+                                cache_db_size=OCR_CACHE_DB_SIZE,
+                                model_content=model_content,
+                                num_threads=num_threads,
+                                width_buckets=OCR_WIDTH_BUCKETS)
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    """Liveness probe: the server process is up"""
+    return flask.jsonify({'status': 'ok'}), 200
+
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    """Readiness probe: the model is loaded and the server can accept OCR requests"""
+    if transcriptor is None:
+        return flask.jsonify({'status': 'loading'}), 503
+    return flask.jsonify({'status': 'ready'}), 200
+
+
+def _read_ocr_request():
+    """
+    Extract from the current HTTP POST request the grayscale image of the page,
+    the cleaned coordinates (x, y, width, height) of the bounding boxes and the ids of the bounding boxes
+    (the 'id' field of each box, or its position in the list if it has no id).
     """
-    start_time = datetime.datetime.now()
 
     # the received HTTP POST request is accessible as flask.request
 
-    # TODO: move the preprocessing of the read files to separate private methods
     # TODO: add checks for file types and sizes
 
     # extract the file and boxes from the HTTP POST request
@@ -45,12 +78,33 @@ def ocr():
 
     # clean the coordinates of all the bounding boxes
     clean_boxes = []
-    for current_box in boxes:
+    box_ids = []
+    for i, current_box in enumerate(boxes):
         cur_box_x, cur_box_y, cur_box_w, cur_box_h = math.ceil(current_box['x']), \
                                                      math.ceil(current_box['y']), \
                                                      math.ceil(current_box['width']), \
                                                      math.ceil(current_box['height'])
         clean_boxes.append((cur_box_x, cur_box_y, cur_box_w, cur_box_h))
+        box_ids.append(current_box.get('id', i))
+
+    return page_image, clean_boxes, box_ids
+
+
+@app.route("/ocr", methods=["POST"])
+def ocr():
+    """
+    This method exposes the service API to perform OCR on the lines of page image.
+    The API can be called by sending an HTTP POST request to the /ocr path of the exposed server address.
+    The following fields should be presentin the HTTP POST request:
+        - a 'file' field with the file containing the image of the page to perform OCR on
+        - a 'boxes' image with the list of coordinates for the bounding boxes of all the lines on the page
+    """
+    start_time = datetime.datetime.now()
+
+    if transcriptor is None:
+        return flask.jsonify({'error': 'the OCR model is still loading'}), 503
+
+    page_image, clean_boxes, _ = _read_ocr_request()
 
     transcriptions, probabilities = transcriptor.transcribe(page_image, clean_boxes)
     end_time = datetime.datetime.now()
@@ -60,6 +114,31 @@ def ocr():
                           'probabilities': probabilities}), 200
 
 
+@app.route("/ocr/stream", methods=["POST"])
+def ocr_stream():
+    """
+    This method exposes the streaming variant of the /ocr API: it accepts the same fields,
+    but it answers with newline-delimited JSON (NDJSON) records {"box_id": ..., "text": ..., "probability": ...},
+    sent batch by batch as soon as the lines of each batch are transcribed (so not in the order of the boxes).
+    """
+
+    if transcriptor is None:
+        return flask.jsonify({'error': 'the OCR model is still loading'}), 503
+
+    page_image, clean_boxes, box_ids = _read_ocr_request()
+
+    def generate_records():
+        start_time = datetime.datetime.now()
+
+        for transcribed_lines in transcriptor.transcribe_stream(page_image, clean_boxes):
+            yield "".join(json.dumps({'box_id': box_ids[i], 'text': transcription, 'probability': probability}) + "\n"
+                          for i, transcription, probability in transcribed_lines)
+
+        print('Transcription time:', datetime.datetime.now() - start_time)
+
+    return flask.Response(flask.stream_with_context(generate_records()), mimetype='application/x-ndjson')
+
+
 '''
 @app.route('/ocr-polygon',methods=['POST'])
 def ocr_polygon():
@@ -148,6 +227,11 @@ def ocr_polygon():
 '''
 
 
-app.run(debug=True, port=5025)
-print('ocr server is running...')
+if __name__ == '__main__':
+    # development server; for production use gunicorn with gunicorn.conf.py
+    init_transcriptor()
+
+    # the server must be threaded, so that the lines of concurrent requests can be batched together
+    app.run(debug=True, port=5025, threaded=True)
+    print('ocr server is running...')
 
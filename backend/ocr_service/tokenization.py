@@ -1,6 +1,5 @@
 import unicodedata
 import numpy
-from itertools import groupby
 
 
 class Tokenizer:
@@ -16,36 +15,81 @@ class Tokenizer:
         self.vocab_size = len(self.chars)
         self.maxlen = max_text_length
 
-    def encode(self, text):
-        """Encode text to vector"""
+        # the encoded texts only contain ASCII characters (see normalize), so a 128-entry table maps them to tokens;
+        # as in str.find, a character that appears more than once in the charset maps to its first index
+        self.encoding_table = numpy.full(128, self.UNK, dtype=numpy.int16)
+        for index, char in reversed(list(enumerate(self.chars))):
+            if ord(char) < 128:
+                self.encoding_table[ord(char)] = index
+
+        # the tokens are decoded to their characters, except PAD and UNK that are removed
+        self.decoding_table = numpy.array(list(self.chars) + [""], dtype=object)
+        self.decoding_table[[self.PAD, self.UNK]] = ""
+
+    @staticmethod
+    def normalize(text):
+        """Normalize a text to ASCII, with single spaces between its words"""
 
         if isinstance(text, bytes):
             text = text.decode()
 
         text = unicodedata.normalize("NFKD", text).encode("ASCII", "ignore").decode("ASCII")
-        text = " ".join(text.split())
+        return " ".join(text.split())
+
+    def encode(self, text):
+        """Encode text to vector"""
 
-        groups = ["".join(group) for _, group in groupby(text)]
-        text = "".join([self.UNK_TK.join(list(x)) if len(x) > 1 else x for x in groups])
-        encoded = []
+        characters = numpy.frombuffer(self.normalize(text).encode("ASCII"), dtype=numpy.uint8)
 
-        for item in text:
-            index = self.chars.find(item)
+        # an UNK token separates each pair of consecutive equal characters, so that CTC can tell them apart
+        repeated = numpy.flatnonzero(characters[1:] == characters[:-1]) + 1
+        return numpy.insert(self.encoding_table[characters], repeated, self.UNK)
 
-            index = self.UNK if index == -1 else index
-            encoded.append(index)
+    def encode_batch(self, texts):
+        """Encode a list of texts to a (len(texts), maxlen) int16 matrix padded with PAD,
+        and return it with the (len(texts),) vector of the lengths of the encoded texts"""
 
-        return numpy.asarray(encoded)
+        texts = [self.normalize(text) for text in texts]
+        lengths = numpy.array([len(text) for text in texts], dtype=numpy.int64)
+
+        # encode the characters of all the texts at once
+        characters = numpy.frombuffer("".join(texts).encode("ASCII"), dtype=numpy.uint8)
+        text_indices = numpy.repeat(numpy.arange(len(texts)), lengths)
+
+        # consecutive equal characters are separated by an UNK token, but only within the same text
+        repeated = numpy.zeros(len(characters), dtype=bool)
+        repeated[1:] = (characters[1:] == characters[:-1]) & (text_indices[1:] == text_indices[:-1])
+        tokens = numpy.insert(self.encoding_table[characters], numpy.flatnonzero(repeated), self.UNK)
+        lengths += numpy.bincount(text_indices[repeated], minlength=len(texts))
+
+        # scatter the tokens of each text in its row, truncated to maxlen
+        rows = numpy.repeat(numpy.arange(len(texts)), lengths)
+        columns = numpy.arange(len(tokens)) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+        kept = columns < self.maxlen
+
+        encoded = numpy.full((len(texts), self.maxlen), self.PAD, dtype=numpy.int16)
+        encoded[rows[kept], columns[kept]] = tokens[kept]
+
+        return encoded, numpy.minimum(lengths, self.maxlen).astype(numpy.int16)
 
     def decode(self, text):
         """Decode vector to text"""
 
-        decoded = "".join([self.chars[int(x)] for x in text if x > -1])
-        decoded = self.remove_tokens(decoded)
+        text = numpy.asarray(text).astype(numpy.int64)
+        return "".join(self.decoding_table[text[text > -1]])
+
+    def decode_batch(self, texts):
+        """Decode a batch of vectors (a matrix padded with -1, or a list of vectors) to a list of texts"""
+
+        if isinstance(texts, numpy.ndarray) and texts.ndim == 2:
+            # the padding maps to the last entry of the decoding table, the empty string
+            texts = texts.astype(numpy.int64)
+            characters = self.decoding_table[numpy.where(texts > -1, texts, -1)]
+            return ["".join(row) for row in characters]
 
-        return decoded
+        return [self.decode(text) for text in texts]
 
     def remove_tokens(self, text):
         """Remove tokens (PAD) from text"""
 
-        return text.replace(self.PAD_TK, "").replace(self.UNK_TK, "")
\ No newline at end of file
+        return text.replace(self.PAD_TK, "").replace(self.UNK_TK, "")
@@ -1,9 +1,12 @@
-﻿import numpy as np
-import tensorflow as tf
+﻿import datetime
+import numpy as np
 import cv2
 from dataset import Tokenizer
-from image_processing import normalize, preprocess
-from model import HTRModel
+from image_processing import normalize, preprocess_batch
+from runtime import load_runtime
+from ctc_decoding import ctc_decode
+from batching import BatchScheduler
+from cache import TranscriptionCache, page_digest
 
 
 class Transcriptor:
@@ -12,7 +15,15 @@ class Transcriptor:
                  model_path: str,
                  input_image_size: tuple,
                  max_text_length: int,
-                 charset):
+                 charset,
+                 batch_size: int = 64,
+                 max_batch_wait: float = 0.01,
+                 cache_size: int = 0,
+                 cache_path: str = None,
+                 cache_db_size: int = 1000000,
+                 model_content: bytes = None,
+                 num_threads: int = None,
+                 width_buckets: tuple = ()):
 
         self.model_path = model_path
         self.input_image_size = input_image_size
@@ -23,65 +34,137 @@ class Transcriptor:
 
         self.model = self._load_model(input_size=input_image_size,
                                       vocabulary_size=self.tokenizer.vocab_size,
-                                      model_path=model_path)
-
-    def _load_model(self, input_size, vocabulary_size, model_path):
-        model = HTRModel(input_size=input_size,
-                         vocabulary_size=vocabulary_size,
-                         beam_width=0,
-                         greedy=True)
-
+                                      model_path=model_path,
+                                      model_content=model_content,
+                                      num_threads=num_threads)
+
+        # if the model accepts narrower inputs, each line only goes through the narrowest width bucket
+        # that holds its content, instead of the full input width (the last bucket is always the full width)
+        self.width_buckets = []
+        if len(width_buckets) > 0 and self.model.variable_width:
+            self.width_buckets = sorted(set(w for w in width_buckets if w < input_image_size[0])) + [input_image_size[0]]
+
+        # the lines of concurrent transcription requests are coalesced into shared batches of at most batch_size lines
+        self.scheduler = BatchScheduler(predict_function=self._predict_batch,
+                                        max_batch_size=batch_size,
+                                        max_wait_time=max_batch_wait)
+
+        # the transcriptions of the lines already seen by the loaded model are cached, unless cache_size is 0
+        self.cache = None
+        if cache_size > 0:
+            self.cache = TranscriptionCache(model_path=model_path, max_entries=cache_size, db_path=cache_path,
+                                            settings=f"width_buckets={self.width_buckets}",
+                                            max_db_entries=cache_db_size)
+
+    def _load_model(self, input_size, vocabulary_size, model_path, model_content=None, num_threads=None):
+        # the model path can be a Keras checkpoint, or an inference model exported by scripts/export_model.py
         print('Loading model from location ' + model_path, '...')
-        model.load_checkpoint(target=model_path)
+        model = load_runtime(model_path=model_path,
+                             input_size=input_size,
+                             vocabulary_size=vocabulary_size,
+                             model_content=model_content,
+                             num_threads=num_threads)
         print('Done.')
 
         return model
 
     def transcribe(self, page_image, bounding_boxes):
 
-        line_images = []
+        transcriptions = [None] * len(bounding_boxes)
+        probabilities = [None] * len(bounding_boxes)
+
+        for transcribed_lines in self.transcribe_stream(page_image, bounding_boxes):
+            for i, transcription, probability in transcribed_lines:
+                transcriptions[i] = transcription
+                probabilities[i] = probability
+
+        return transcriptions, probabilities
+
+    def transcribe_stream(self, page_image, bounding_boxes):
+        """
+        Transcribe the lines of a page, yielding the transcriptions batch by batch as soon as they are ready.
+        Each yielded item is a list of (box index, transcription, probability) tuples.
+        """
+
+        # look up the lines that have already been transcribed (e.g., when the same page is submitted again
+        # after editing some of its boxes): only the new or changed boxes must go through the model
+        if self.cache is not None:
+            digest = page_digest(page_image)
+            cached_lines = self.cache.get_many(digest, bounding_boxes)
+        else:
+            cached_lines = [None] * len(bounding_boxes)
+
+        missing_indices = [i for i, cached_line in enumerate(cached_lines) if cached_line is None]
+        missing_boxes = [bounding_boxes[i] for i in missing_indices]
+
+        print('Number of lines to transcribe: ' + str(len(missing_boxes)) +
+              ' (cached: ' + str(len(bounding_boxes) - len(missing_boxes)) + ')')
 
-        # for each passed bounding box (i.e., each line to transcribe), crop the corresponding line image:
-        for current_box in bounding_boxes:
-            cur_box_x, cur_box_y, cur_box_width, cur_box_height = current_box
+        if len(missing_boxes) < len(bounding_boxes):
+            yield [(i, cached_line[0], cached_line[1]) for i, cached_line in enumerate(cached_lines)
+                   if cached_line is not None]
 
-            # use the bounding box coordinates to extract the line image
-            line_image = page_image[cur_box_y:cur_box_y + cur_box_height, cur_box_x:cur_box_x + cur_box_width]
+        # crop and preprocess the line image of each missing bounding box (i.e., each line to transcribe)
+        # directly into a single buffer
+        line_images, line_widths = preprocess_batch(page_image, missing_boxes, self.input_image_size, return_widths=True)
 
-            # preprocess the line image
-            preprocessed_line_image = preprocess(line_image, self.input_image_size)
+        # this is where the actual transcription process takes place:
+        # the lines are transcribed in batches that may be shared with other concurrent requests
+        for start, new_transcriptions, new_probabilities in self.scheduler.submit_stream(line_images, line_widths):
+            stop = start + len(new_transcriptions)
 
-            # append the result to the list of line images
-            line_images.append(preprocessed_line_image)
+            if self.cache is not None:
+                self.cache.put_many(digest, missing_boxes[start:stop], new_transcriptions, new_probabilities)
 
-        # this is where the actual transcription process takes place
-        predictions = []
-        probabilities = []
-        print('Number of lines to transcribe: ' + str(len(line_images)))
+            yield list(zip(missing_indices[start:stop], new_transcriptions, new_probabilities))
+
+    def _predict_batch(self, line_images, line_widths):
+        """
+        Transcribe a batch of preprocessed line images with a single call of the loaded model
+        (or with one call for each width bucket, if the lines are bucketed by width)
+        """
+
+        if len(self.width_buckets) == 0:
+            return self._predict_lines(line_images)
+
+        transcriptions = [None] * len(line_images)
+        probabilities = [None] * len(line_images)
+
+        # group the lines by the narrowest bucket that holds their content
+        line_buckets = np.searchsorted(self.width_buckets, line_widths)
+        for bucket in np.unique(line_buckets):
+            indices = np.flatnonzero(line_buckets == bucket)
+            bucket_width = self.width_buckets[bucket]
+
+            # the model outputs 2 time steps every 4 columns: the steps past the content of a line are not decoded
+            sequence_lengths = (line_widths[indices] + 3) // 4 * 2
+            bucket_transcriptions, bucket_probabilities = self._predict_lines(line_images[indices, :bucket_width],
+                                                                              sequence_lengths)
+
+            for i, transcription, probability in zip(indices, bucket_transcriptions, bucket_probabilities):
+                transcriptions[i] = transcription
+                probabilities[i] = probability
+
+        return transcriptions, probabilities
 
-        # work in batches of 64 lines each;
-        # for each batch, run the predict method of the loaded model
-        # (which is defined in the outer scope of the file, so it is visible)
-        batch_start = 0
-        batch_size = 64
+    def _predict_lines(self, line_images, sequence_lengths=None):
+        """Transcribe preprocessed line images of the same width with a single call of the loaded model"""
 
-        while batch_start < len(line_images):
-            cur_batch = line_images[batch_start: min(batch_start + batch_size, len(line_images))]
+        predict_time_start = datetime.datetime.now()
+        log_probabilities = self.model.predict(normalize(line_images))
+        print('predict time', datetime.datetime.now() - predict_time_start)
 
-            cur_batch_predictions, cur_batch_probabilities = self.model.predict(normalize(cur_batch),
-                                                                                ctc_decode=True,
-                                                                                verbose=1, )
-            predictions.extend(cur_batch_predictions)
-            probabilities.extend(cur_batch_probabilities)
-            batch_start += batch_size
+        # use best path decoding
+        decode_time_start = datetime.datetime.now()
+        predictions, probabilities = ctc_decode(log_probabilities, greedy=True, beam_width=0,
+                                                sequence_lengths=sequence_lengths)
+        print('CTC Decode time', datetime.datetime.now() - decode_time_start)
 
-        # some post-processing
-        predictions = tf.sparse.to_dense(predictions[0]).numpy()
-        probabilities = [prob.numpy() for prob in probabilities]
-        probabilities = [str(np.exp(prob[0])) for prob in probabilities]
+        # some post-processing: the decoder returns the log-probabilities of the decoded sequences
+        probabilities = [str(np.exp(prob)) for prob in probabilities]
 
         # decode the predictions into actual string transcriptions
-        transcriptions = [self.tokenizer.decode(x) for x in predictions]
+        transcriptions = self.tokenizer.decode_batch(predictions)
 
         return transcriptions, probabilities
 
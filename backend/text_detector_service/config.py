@@ -2,6 +2,29 @@
 
 MODEL_PATH = 'stored_models/dbnet_model_1.h5'
 
+# the pages of a /corpus request are processed CORPUS_WINDOW_SIZE at a time: the pages of a window with similar
+# sizes (their short side rounded up to CORPUS_BUCKET_STEP pixels) are padded to a common shape and go through
+# the model CORPUS_BATCH_SIZE at a time, and POSTPROCESSING_THREADS threads decode and post-process the pages
+CORPUS_BATCH_SIZE = 4
+CORPUS_BUCKET_STEP = 256
+CORPUS_WINDOW_SIZE = 32
+POSTPROCESSING_THREADS = 4
+# the candidate polygons of the pages being post-processed are unclipped on a pool of UNCLIP_THREADS threads,
+# shared by the POSTPROCESSING_THREADS threads (0 unclips them in the post-processing threads)
+UNCLIP_THREADS = 4
+
+# the resolution at which the pages go through the model, one of the RESOLUTION_PRESETS of text_detection.py:
+# "long_side_2500", "short_side_736" or "full" (the resolution of the page)
+DETECTOR_PRESET = "long_side_2500"
+
+# if TILE_SIZE is not None, each page is resized to TILE_PRESET and goes through the model in overlapping tiles
+# of TILE_SIZE x TILE_SIZE pixels (multiples of 32), whose probability maps are merged by their "max"
+# or "blend"-ed in the TILE_OVERLAP pixels they share
+TILE_SIZE = None
+TILE_OVERLAP = 128
+TILE_STITCH = "max"
+TILE_PRESET = "full"
+
 class DBConfig(object):
 
     STEPS_PER_EPOCH = 1000
@@ -31,6 +54,23 @@ class DBConfig(object):
 
     TRAIN_DATA_PATH = 'datasets/data/train.json'
     VAL_DATA_PATH = 'datasets/data/val.json'
+    # the validation targets rendered once by script/generate.py or script/train.py (used if up to date, '' to disable)
+    VAL_CACHE_DIR = 'datasets/cache/val'
+
+    # the decoded images, stored once by script/generate.py or script/train.py (used if up to date, '' to disable)
+    IMAGE_STORE_DIR = 'datasets/cache/images'
+
+    # the photometric augmentations of the training images: "opencv" (aug_cv.py) or "tensorflow" (aug.py)
+    AUGMENTATION_BACKEND = "opencv"
+
+    # the batches are produced by DATA_WORKERS processes, up to PREFETCH_BATCHES ahead of the training
+    # (each batch takes BATCH_SIZE * IMAGE_SIZE ** 2 * 10 bytes of /dev/shm, about 33 MB with the defaults);
+    # the validation batches are produced by one process, up to VAL_PREFETCH_BATCHES ahead
+    DATA_WORKERS = 4
+    PREFETCH_BATCHES = 4
+    VAL_PREFETCH_BATCHES = 1
+    # the seed of the data loaders (None to draw a new one at each run, printed at the start of the training)
+    SEED = None
 
     IMAGE_SIZE = 640
     BATCH_SIZE = 8
@@ -0,0 +1,198 @@
+"""
+The photometric augmentations of aug.py, on uint8 NumPy images instead of TensorFlow tensors.
+
+Each transformation works in place on a BGR uint8 image (H, W, 3) or on a batch of images (N, H, W, 3),
+with its own random parameters for each image, and returns it. The pixel-wise transformations are applied
+with OpenCV lookup tables (cv2.LUT), computed for the whole batch at once, or with OpenCV color conversions;
+the random numbers come from the global numpy generator (seeded in each data loader worker,
+see generate.parallel_generate).
+"""
+
+import cv2
+import numpy as np
+from typing import List
+
+__all__ = ['Compose', 'RandomApply', 'ColorInversion', 'RandomBrightness', 'RandomContrast', 'RandomSaturation',
+           'RandomJpegQuality']
+
+# the values of the lookup tables, as the floats in [0, 1] of the TensorFlow backend
+VALUES = np.arange(256, dtype=np.float64) / 255
+
+# the weights of tf.image.rgb_to_grayscale, applied as in the TensorFlow backend to the channels in their order
+GRAY_WEIGHTS = np.array([[0.2989, 0.5870, 0.1140]])
+
+
+def batch_of(img: np.ndarray) -> np.ndarray:
+    """An image as a batch of one image (a view), or a batch as it is"""
+    return img[np.newaxis] if img.ndim == 3 else img
+
+
+def to_uint8(values: np.ndarray) -> np.ndarray:
+    """Convert floats in [0, 1] to uint8 as tf.image.convert_image_dtype does (with saturation)"""
+    return np.clip(values * 255.5, 0, 255).astype(np.uint8)
+
+
+class LUTTransformation:
+    """A transformation that maps the values of each image through its own lookup table"""
+
+    def luts(self, batch: np.ndarray) -> np.ndarray:
+        """The (N, 256, C) uint8 lookup tables of a batch, with C = 1 (the same for all the channels) or 3"""
+        raise NotImplementedError
+
+    def __call__(self, img: np.ndarray) -> np.ndarray:
+        batch = batch_of(img)
+        for image, lut in zip(batch, self.luts(batch)):
+            cv2.LUT(image, lut[np.newaxis], dst=image)
+        return img
+
+
+class Compose:
+    """Apply transformations sequentially
+    Args:
+        transforms: list of transformations
+    """
+
+    def __init__(self, transforms: List) -> None:
+        self.transforms = transforms
+
+    def __repr__(self) -> str:
+        return f"Compose({self.transforms})"
+
+    def __call__(self, img: np.ndarray) -> np.ndarray:
+        for t in self.transforms:
+            img = t(img)
+        return img
+
+
+class RandomApply:
+    """Apply with a probability p the input transformation (to each image of a batch independently)
+    Args:
+        transform: transformation to apply
+        p: probability to apply
+    """
+
+    def __init__(self, transform, p: float = .5) -> None:
+        self.transform = transform
+        self.p = p
+
+    def __repr__(self) -> str:
+        return f"RandomApply(transform={self.transform}, p={self.p})"
+
+    def __call__(self, img: np.ndarray) -> np.ndarray:
+        batch = batch_of(img)
+        applied = np.flatnonzero(np.random.random(len(batch)) < self.p)
+        if len(applied) == len(batch):
+            self.transform(batch)
+        elif len(applied) > 0:
+            batch[applied] = self.transform(batch[applied])
+        return img
+
+
+class ColorInversion:
+    """Convert to grayscale, colorize (scale each channel by a random factor in [min_val, 1]) and invert colors
+    Args:
+        min_val: range [min_val, 1] to colorize the channels
+    """
+
+    def __init__(self, min_val: float = 0.6) -> None:
+        self.min_val = min_val
+
+    def __repr__(self) -> str:
+        return f"ColorInversion(min_val={self.min_val})"
+
+    def __call__(self, img: np.ndarray) -> np.ndarray:
+        batch = batch_of(img)
+        shifts = np.random.uniform(self.min_val, 1, size=(len(batch), 1, 3))
+        luts = 255 - (np.arange(256, dtype=np.float64)[:, np.newaxis] * shifts).astype(np.uint8)
+
+        for image, lut in zip(batch, luts):
+            gray = cv2.transform(image, GRAY_WEIGHTS)
+            cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR, dst=image)
+            cv2.LUT(image, lut[np.newaxis], dst=image)
+        return img
+
+
+class RandomBrightness(LUTTransformation):
+    """Randomly adjust brightness by adding a delta to all pixels
+    Args:
+        max_delta: offset to add to each pixel is randomly picked in [-max_delta, max_delta]
+    """
+
+    def __init__(self, max_delta: float = 0.3) -> None:
+        self.max_delta = max_delta
+
+    def __repr__(self) -> str:
+        return f"RandomBrightness(max_delta={self.max_delta})"
+
+    def luts(self, batch: np.ndarray) -> np.ndarray:
+        deltas = np.random.uniform(-self.max_delta, self.max_delta, size=(len(batch), 1))
+        return to_uint8(VALUES + deltas)[..., np.newaxis]
+
+
+class RandomContrast(LUTTransformation):
+    """Randomly adjust contrast by adjusting each pixel: (img - mean) * contrast_factor + mean,
+    with the mean of each channel
+    Args:
+        delta: multiplicative factor is picked in [1-delta, 1/(1-delta)] (reduce contrast if factor<1)
+    """
+
+    def __init__(self, delta: float = .3) -> None:
+        self.delta = delta
+
+    def __repr__(self) -> str:
+        return f"RandomContrast(delta={self.delta})"
+
+    def luts(self, batch: np.ndarray) -> np.ndarray:
+        factors = np.random.uniform(1 - self.delta, 1 / (1 - self.delta), size=(len(batch), 1, 1))
+        means = np.array([cv2.mean(image)[:3] for image in batch])[:, np.newaxis, :] / 255
+        return to_uint8((VALUES[:, np.newaxis] - means) * factors + means)
+
+
+class RandomSaturation:
+    """Randomly adjust saturation by converting to HSV and multiplying the saturation by a factor
+    (in float32 HSV rather than through a lookup table: the uint8 HSV conversions would change the colors
+    even with a factor of 1)
+    Args:
+        delta: multiplicative factor is picked in [1-delta, 1+delta] (reduce saturation if factor<1)
+    """
+
+    def __init__(self, delta: float = .5) -> None:
+        self.delta = delta
+
+    def __repr__(self) -> str:
+        return f"RandomSaturation(delta={self.delta})"
+
+    def __call__(self, img: np.ndarray) -> np.ndarray:
+        batch = batch_of(img)
+        factors = np.random.uniform(1 - self.delta, 1 + self.delta, size=len(batch))
+
+        for image, factor in zip(batch, factors):
+            hsv = cv2.cvtColor(image.astype(np.float32) * (1 / 255), cv2.COLOR_BGR2HSV)
+            cv2.multiply(hsv, (1, factor, 1, 0), dst=hsv)
+            np.minimum(hsv[..., 1], 1, out=hsv[..., 1])
+            cv2.convertScaleAbs(cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR), dst=image, alpha=255)
+        return img
+
+
+class RandomJpegQuality:
+    """Randomly compress an image as a JPEG of a quality in [min_quality, max_quality)
+    Args:
+        min_quality: int between [0, 100]
+        max_quality: int between [0, 100]
+    """
+
+    def __init__(self, min_quality: int = 60, max_quality: int = 100) -> None:
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+
+    def __repr__(self) -> str:
+        return f"RandomJpegQuality(min_quality={self.min_quality})"
+
+    def __call__(self, img: np.ndarray) -> np.ndarray:
+        batch = batch_of(img)
+        qualities = np.random.randint(self.min_quality, self.max_quality, size=len(batch))
+
+        for image, quality in zip(batch, qualities):
+            _, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+            image[...] = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+        return img
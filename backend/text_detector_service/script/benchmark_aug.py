@@ -0,0 +1,90 @@
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+import aug_cv
+
+parser = argparse.ArgumentParser(
+    description="Compare the per-sample cost of the photometric augmentation backends of the DBNet training"
+)
+
+parser.add_argument('--image',
+                    default=None,
+                    help="Path of the page to augment (by default, a random 1024x768 image)")
+
+parser.add_argument('--batch_size',
+                    default=8,
+                    type=int,
+                    help="Number of images of the batched opencv variant")
+
+parser.add_argument('--steps',
+                    default=20,
+                    type=int,
+                    help="Number of timed runs (after one warm-up run) for each backend")
+
+parser.add_argument('--backends',
+                    default=["opencv", "opencv_batch", "tensorflow"],
+                    nargs='+',
+                    choices=["opencv", "opencv_batch", "tensorflow"],
+                    help="Augmentation backends to benchmark")
+
+# parse the passed arguments
+args = parser.parse_args()
+
+if args.image is not None:
+    image = cv2.imread(args.image)
+else:
+    image = np.random.randint(0, 256, size=(1024, 768, 3), dtype=np.uint8)
+
+
+def opencv_compose():
+    # the augmentations of generate.py
+    return aug_cv.Compose([
+        aug_cv.RandomApply(aug_cv.ColorInversion(), .1),
+        aug_cv.RandomJpegQuality(60),
+        aug_cv.RandomSaturation(.3),
+        aug_cv.RandomContrast(.3),
+        aug_cv.RandomBrightness(.3),
+    ])
+
+
+def tensorflow_compose():
+    # imported only if benchmarked, as it needs TensorFlow
+    import aug
+    transforms = aug.Compose([
+        aug.RandomApply(aug.ColorInversion(), .1),
+        aug.RandomJpegQuality(60),
+        aug.RandomSaturation(.3),
+        aug.RandomContrast(.3),
+        aug.RandomBrightness(.3),
+    ])
+    # as in generate.py, each sample is converted back to a numpy array
+    return lambda x: transforms(x).numpy()
+
+
+def run(backend, transforms):
+    """Augment a copy of the image once (or a batch of copies of it, for opencv_batch); return the number of samples"""
+    if backend == "opencv_batch":
+        transforms(np.repeat(image[np.newaxis], args.batch_size, axis=0))
+        return args.batch_size
+    transforms(image.copy())
+    return 1
+
+
+print(f"Image: {image.shape[1]}x{image.shape[0]}")
+print(f"{'Backend':<16}{'ms/sample':>12}{'Samples/sec':>14}")
+for backend in args.backends:
+    transforms = tensorflow_compose() if backend == "tensorflow" else opencv_compose()
+
+    # the first run warms up the backend
+    run(backend, transforms)
+
+    samples = 0
+    start_time = time.perf_counter()
+    for _ in range(args.steps):
+        samples += run(backend, transforms)
+    elapsed_time = (time.perf_counter() - start_time) / samples
+
+    print(f"{backend:<16}{elapsed_time * 1000:>12.2f}{1 / elapsed_time:>14.1f}")
@@ -5,17 +5,26 @@
 # @File    : generate.py
 import math
 import json
+import multiprocessing
+import os
 import os.path as osp
+import queue
+import random
+import shutil
+from multiprocessing import shared_memory
 
 import cv2
 import numpy as np
 import pyclipper
+import tensorflow as tf
 from shapely.geometry import Polygon
+import imgaug
 import imgaug.augmenters as iaa
 
 from transform import transform, crop, resize
 from backend.text_detector_service.config import DBConfig
 from aug import LambdaTransformation, Resize, RandomApply, RandomJpegQuality, RandomSaturation, RandomContrast, RandomBrightness, ColorInversion, Compose
+import aug_cv
 
 aug = Compose([
             # LambdaTransformation(lambda x: x / 255),
@@ -28,6 +37,15 @@ aug = Compose([
             RandomBrightness(.3),
         ])
 
+# the same augmentations on uint8 numpy arrays, in place (see aug_cv.py)
+aug_opencv = aug_cv.Compose([
+            aug_cv.RandomApply(aug_cv.ColorInversion(), .1),
+            aug_cv.RandomJpegQuality(60),
+            aug_cv.RandomSaturation(.3),
+            aug_cv.RandomContrast(.3),
+            aug_cv.RandomBrightness(.3),
+        ])
+
 mean = [103.939, 116.779, 123.68]
 
 
@@ -44,7 +62,14 @@ def show_polys(image, anns, window_name):
 
 
 def draw_thresh_map(polygon, canvas, mask, shrink_ratio=0.4):
-    polygon = np.array(polygon)
+    """
+    Draw the threshold map of a polygon onto canvas (in place), and its padded polygon onto mask.
+
+    Only the bounding box window of the padded polygon is computed: the squared distances of its pixels from
+    the edges of the polygon are reduced with a running minimum, one edge at a time, and a single square root
+    is taken at the end (see compute_distance for the distance of a pixel from an edge).
+    """
+    polygon = np.array(polygon, dtype=np.float64)
     assert polygon.ndim == 2
     assert polygon.shape[1] == 2
 
@@ -60,60 +85,53 @@ def draw_thresh_map(polygon, canvas, mask, shrink_ratio=0.4):
     xmax = padded_polygon[:, 0].max()
     ymin = padded_polygon[:, 1].min()
     ymax = padded_polygon[:, 1].max()
-    width = xmax - xmin + 1
-    height = ymax - ymin + 1
+
+    # the part of the window inside the canvas (as before, without its last row and column)
+    xmin_valid = min(max(0, xmin), canvas.shape[1] - 1)
+    xmax_valid = min(max(0, xmax), canvas.shape[1] - 1)
+    ymin_valid = min(max(0, ymin), canvas.shape[0] - 1)
+    ymax_valid = min(max(0, ymax), canvas.shape[0] - 1)
+    if xmax_valid <= xmin_valid or ymax_valid <= ymin_valid:
+        return
 
     polygon[:, 0] = polygon[:, 0] - xmin
     polygon[:, 1] = polygon[:, 1] - ymin
 
-    xs = np.broadcast_to(np.linspace(0, width - 1, num=width).reshape(1, width), (height, width))
-    ys = np.broadcast_to(np.linspace(0, height - 1, num=height).reshape(height, 1), (height, width))
+    xs = np.arange(xmin_valid - xmin, xmax_valid - xmin, dtype=np.float32).reshape(1, -1)
+    ys = np.arange(ymin_valid - ymin, ymax_valid - ymin, dtype=np.float32).reshape(-1, 1)
 
-    distance_map = np.zeros((polygon.shape[0], height, width), dtype=np.float32)
+    square_distances = [np.square(xs - x) + np.square(ys - y) for x, y in polygon]
+    min_square_distance = np.full((ys.shape[0], xs.shape[1]), np.inf, dtype=np.float32)
     for i in range(polygon.shape[0]):
         j = (i + 1) % polygon.shape[0]
-        absolute_distance = compute_distance(xs, ys, polygon[i], polygon[j])
-        distance_map[i] = np.clip(absolute_distance / distance, 0, 1)
-    distance_map = np.min(distance_map, axis=0)
-
-    xmin_valid = min(max(0, xmin), canvas.shape[1] - 1)
-    xmax_valid = min(max(0, xmax), canvas.shape[1] - 1)
-    ymin_valid = min(max(0, ymin), canvas.shape[0] - 1)
-    ymax_valid = min(max(0, ymax), canvas.shape[0] - 1)
-    canvas[ymin_valid:ymax_valid, xmin_valid:xmax_valid] = np.fmax(
-        1 - distance_map[
-            ymin_valid - ymin:ymax_valid - ymin,
-            xmin_valid - xmin:xmax_valid - xmin],
-        canvas[ymin_valid:ymax_valid, xmin_valid:xmax_valid])
+        square_distance = compute_distance(xs, ys, polygon[i], polygon[j], square_distances[i], square_distances[j])
+        np.fmin(min_square_distance, square_distance, out=min_square_distance)
 
+    distance_map = np.clip(np.sqrt(min_square_distance) / distance, 0, 1)
 
-def compute_distance(xs, ys, point_1, point_2):
-    square_distance_1 = np.square(xs - point_1[0]) + np.square(ys - point_1[1])
-    square_distance_2 = np.square(xs - point_2[0]) + np.square(ys - point_2[1])
-    square_distance = np.square(point_1[0] - point_2[0]) + np.square(point_1[1] - point_2[1])
+    window = canvas[ymin_valid:ymax_valid, xmin_valid:xmax_valid]
+    np.fmax(1 - distance_map, window, out=window)
 
-    cosin = (square_distance - square_distance_1 - square_distance_2) / \
-            (2 * np.sqrt(square_distance_1 * square_distance_2) + 1e-6)
-    square_sin = 1 - np.square(cosin)
-    square_sin = np.nan_to_num(square_sin)
-    result = np.sqrt(square_distance_1 * square_distance_2 * square_sin / (square_distance + 1e-6))
 
-    result[cosin < 0] = np.sqrt(np.fmin(square_distance_1, square_distance_2))[cosin < 0]
-    return result
+def compute_distance(xs, ys, point_1, point_2, square_distance_1, square_distance_2):
+    """
+    The squared distance of the pixels (xs, ys) from the edge from point_1 to point_2, whose squared distances
+    from the pixels are square_distance_1 and square_distance_2: the distance from the line of the edge
+    if the edge subtends an obtuse angle at the pixel, else the distance from the closest of its points.
+    """
+    square_length = np.square(point_1[0] - point_2[0]) + np.square(point_1[1] - point_2[1])
 
+    # the distance from the line is the cross product of the edge and the pixel, over the length of the edge
+    cross = (point_2[0] - point_1[0]) * (ys - point_1[1]) - (point_2[1] - point_1[1]) * (xs - point_1[0])
+    result = np.square(cross) / (square_length + 1e-6)
 
-def generate(cfg, train_or_val='train'):
-    def init_input():
-        batch_images = np.zeros([cfg.BATCH_SIZE, cfg.IMAGE_SIZE, cfg.IMAGE_SIZE, 3], dtype=np.float32)
-        batch_gts = np.zeros([cfg.BATCH_SIZE, cfg.IMAGE_SIZE, cfg.IMAGE_SIZE], dtype=np.float32)
-        batch_masks = np.zeros([cfg.BATCH_SIZE, cfg.IMAGE_SIZE, cfg.IMAGE_SIZE], dtype=np.float32)
-        batch_thresh_maps = np.zeros([cfg.BATCH_SIZE, cfg.IMAGE_SIZE, cfg.IMAGE_SIZE], dtype=np.float32)
-        batch_thresh_masks = np.zeros([cfg.BATCH_SIZE, cfg.IMAGE_SIZE, cfg.IMAGE_SIZE], dtype=np.float32)
-        # batch_loss = np.zeros([cfg.BATCH_SIZE, ], dtype=np.float32)
-        return [batch_images, batch_gts, batch_masks, batch_thresh_maps, batch_thresh_masks]
+    acute = square_distance_1 + square_distance_2 > square_length
+    result[acute] = np.fmin(square_distance_1, square_distance_2)[acute]
+    return result
 
-    data_path = cfg.TRAIN_DATA_PATH if train_or_val=='train' else cfg.VAL_DATA_PATH
 
+def load_annotations(data_path):
+    """Read the image paths and the polygon annotations of a dataset json"""
     with open(data_path, encoding='utf8') as f:
         data = json.load(f)
 
@@ -139,88 +157,420 @@ def generate(cfg, train_or_val='train'):
         image_paths.append(osp.join(data_root_dir, img_name))
         all_anns.append(anns)
 
-    transform_aug = iaa.Sequential([iaa.Affine(rotate=(-10, 10)), iaa.Resize((0.5, 3.0))])
-    dataset_size = len(image_paths)
-    indices = np.arange(dataset_size)
-    if train_or_val=='train':
-        np.random.shuffle(indices)
+    return image_paths, all_anns
 
-    current_idx = 0
-    b = 0
-    while True:
-        if current_idx >= dataset_size:
-            if train_or_val=='train':
-                np.random.shuffle(indices)
-            current_idx = 0
-        if b == 0:
-            batch_images, batch_gts, batch_masks, batch_thresh_maps, batch_thresh_masks = init_input()
-        i = indices[current_idx]
-        image_path = image_paths[i]
-        anns = all_anns[i]
-        """
-        [{'text': 'chinese', 'poly': [[17.86985870232934, 29.2253341902275], [18.465581783660582, 7.2334012599376365], [525.2796724953414, 20.9621104524324], [524.6839494140104, 42.954043382722375]]},
-        {'text': 'chinese', 'poly': [[9.746362138723043, 329.1153286941807], [10.667025082598343, 295.12779598373265], [589.454714475228, 310.8061443514931], [588.5340515313526, 344.79367706194114]]}]
-        """
-        image = cv2.imread(image_path)
-        # show_polys(image.copy(), anns, 'before_aug')
-        if train_or_val=='train':
-            transform_aug = transform_aug.to_deterministic()
-            image, anns = transform(transform_aug, image, anns)
-            image, anns = crop(image, anns)
-            image = aug(image)
-            image = image.numpy()
 
-        image, anns = resize(cfg.IMAGE_SIZE, image, anns)
-        # show_polys(image.copy(), anns, 'after_aug')
-        # cv2.waitKey(0)
-        anns = [ann for ann in anns if Polygon(ann['poly']).is_valid]
-        gt = np.zeros((cfg.IMAGE_SIZE, cfg.IMAGE_SIZE), dtype=np.float32)
-        mask = np.ones((cfg.IMAGE_SIZE, cfg.IMAGE_SIZE), dtype=np.float32)
-        thresh_map = np.zeros((cfg.IMAGE_SIZE, cfg.IMAGE_SIZE), dtype=np.float32)
-        thresh_mask = np.zeros((cfg.IMAGE_SIZE, cfg.IMAGE_SIZE), dtype=np.float32)
-        for ann in anns:
-            poly = np.array(ann['poly'])
-            height = max(poly[:, 1]) - min(poly[:, 1])
-            width = max(poly[:, 0]) - min(poly[:, 0])
-            polygon = Polygon(poly)
-            # generate gt and mask
-            if polygon.area < 1 or min(height, width) < cfg.MIN_TEXT_SIZE or ann['text'] in cfg.IGNORE_TEXT:
+def make_targets(cfg, anns):
+    """Render the training targets of the annotations of a resized image: gt, mask, thresh_map and thresh_mask"""
+    anns = [ann for ann in anns if Polygon(ann['poly']).is_valid]
+    gt = np.zeros((cfg.IMAGE_SIZE, cfg.IMAGE_SIZE), dtype=np.float32)
+    mask = np.ones((cfg.IMAGE_SIZE, cfg.IMAGE_SIZE), dtype=np.float32)
+    thresh_map = np.zeros((cfg.IMAGE_SIZE, cfg.IMAGE_SIZE), dtype=np.float32)
+    thresh_mask = np.zeros((cfg.IMAGE_SIZE, cfg.IMAGE_SIZE), dtype=np.float32)
+    for ann in anns:
+        poly = np.array(ann['poly'])
+        height = max(poly[:, 1]) - min(poly[:, 1])
+        width = max(poly[:, 0]) - min(poly[:, 0])
+        polygon = Polygon(poly)
+        # generate gt and mask
+        if polygon.area < 1 or min(height, width) < cfg.MIN_TEXT_SIZE or ann['text'] in cfg.IGNORE_TEXT:
+            cv2.fillPoly(mask, poly.astype(np.int32)[np.newaxis, :, :], 0)
+            continue
+        else:
+            distance = polygon.area * (1 - np.power(cfg.SHRINK_RATIO, 2)) / polygon.length
+            subject = [tuple(l) for l in ann['poly']]
+            padding = pyclipper.PyclipperOffset()
+            padding.AddPath(subject, pyclipper.JT_ROUND, pyclipper.ET_CLOSEDPOLYGON)
+            shrinked = padding.Execute(-distance)
+            if len(shrinked) == 0:
                 cv2.fillPoly(mask, poly.astype(np.int32)[np.newaxis, :, :], 0)
                 continue
             else:
-                distance = polygon.area * (1 - np.power(cfg.SHRINK_RATIO, 2)) / polygon.length
-                subject = [tuple(l) for l in ann['poly']]
-                padding = pyclipper.PyclipperOffset()
-                padding.AddPath(subject, pyclipper.JT_ROUND, pyclipper.ET_CLOSEDPOLYGON)
-                shrinked = padding.Execute(-distance)
-                if len(shrinked) == 0:
+                shrinked = np.array(shrinked[0]).reshape(-1, 2)
+                if shrinked.shape[0] > 2 and Polygon(shrinked).is_valid:
+                    cv2.fillPoly(gt, [shrinked.astype(np.int32)], 1)
+                else:
                     cv2.fillPoly(mask, poly.astype(np.int32)[np.newaxis, :, :], 0)
                     continue
-                else:
-                    shrinked = np.array(shrinked[0]).reshape(-1, 2)
-                    if shrinked.shape[0] > 2 and Polygon(shrinked).is_valid:
-                        cv2.fillPoly(gt, [shrinked.astype(np.int32)], 1)
-                    else:
-                        cv2.fillPoly(mask, poly.astype(np.int32)[np.newaxis, :, :], 0)
-                        continue
-            # generate thresh map and thresh mask
-            draw_thresh_map(ann['poly'], thresh_map, thresh_mask, shrink_ratio=cfg.SHRINK_RATIO)
-        thresh_map = thresh_map * (cfg.THRESH_MAX - cfg.THRESH_MIN) + cfg.THRESH_MIN
-
-        image = image.astype(np.float32)
-        image -= mean
-        batch_images[b] = image
-        batch_gts[b] = gt
-        batch_masks[b] = mask
-        batch_thresh_maps[b] = thresh_map
-        batch_thresh_masks[b] = thresh_mask
-
-        b += 1
-        current_idx += 1
-        if b == cfg.BATCH_SIZE:
-            inputs = [batch_images, batch_gts, batch_masks, batch_thresh_maps, batch_thresh_masks]
-            # outputs = batch_loss
+        # generate thresh map and thresh mask
+        draw_thresh_map(ann['poly'], thresh_map, thresh_mask, shrink_ratio=cfg.SHRINK_RATIO)
+    thresh_map = thresh_map * (cfg.THRESH_MAX - cfg.THRESH_MIN) + cfg.THRESH_MIN
+
+    return gt, mask, thresh_map, thresh_mask
+
+
+def cache_metadata(cfg, data_path, image_paths):
+    """The settings and files the cached targets depend on: the cache is rebuilt if any of them changes"""
+    return {'data_path': osp.abspath(data_path),
+            'data_mtime_ns': os.stat(data_path).st_mtime_ns,
+            'data_size': os.stat(data_path).st_size,
+            'images': ImageStore.metadata(image_paths),
+            'image_size': cfg.IMAGE_SIZE,
+            'min_text_size': cfg.MIN_TEXT_SIZE,
+            'shrink_ratio': cfg.SHRINK_RATIO,
+            'thresh_min': cfg.THRESH_MIN,
+            'thresh_max': cfg.THRESH_MAX,
+            'ignore_text': list(cfg.IGNORE_TEXT)}
+
+
+def cached_targets(cfg, data_path, image_paths):
+    """Whether the validation targets of data_path are cached in cfg.VAL_CACHE_DIR and up to date
+    (the configs without a VAL_CACHE_DIR do not use the cache)"""
+    cache_dir = getattr(cfg, 'VAL_CACHE_DIR', '')
+    meta_path = osp.join(cache_dir, 'meta.json')
+    if not cache_dir or not osp.exists(meta_path):
+        return False
+
+    with open(meta_path, encoding='utf8') as f:
+        return json.load(f) == cache_metadata(cfg, data_path, image_paths)
+
+
+class ImageStore:
+    """
+    The decoded images of a dataset, stored once as the raw BGR uint8 pixels of a memory-mapped file,
+    so that reading an image is a copy from the page cache (shared by all the data loader workers)
+    instead of the decoding of a full resolution JPEG.
+    """
+
+    def __init__(self, pixels_path, index):
+        self.pixels = np.memmap(pixels_path, dtype=np.uint8, mode='r')
+        self.offsets = index['offsets']
+        self.shapes = [tuple(shape) for shape in index['shapes']]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        offset, shape = self.offsets[i], self.shapes[i]
+        return np.array(self.pixels[offset:offset + int(np.prod(shape))]).reshape(shape)
+
+    @staticmethod
+    def paths(store_dir, data_path):
+        """The pixels and index files of the store of a dataset json"""
+        name = osp.splitext(osp.basename(data_path))[0]
+        return osp.join(store_dir, f'{name}.pixels'), osp.join(store_dir, f'{name}.json')
+
+    @staticmethod
+    def metadata(image_paths):
+        """The images the store depends on: it is rebuilt if any of them changes"""
+        return [[osp.abspath(path), os.stat(path).st_mtime_ns, os.stat(path).st_size] for path in image_paths]
+
+    @classmethod
+    def build(cls, store_dir, data_path):
+        """Decode the images of a dataset json once, and store their pixels in store_dir"""
+        image_paths, _ = load_annotations(data_path)
+        pixels_path, index_path = cls.paths(store_dir, data_path)
+        os.makedirs(store_dir, exist_ok=True)
+
+        offsets, shapes = [], []
+        offset = 0
+        with open(pixels_path, 'wb') as f:
+            for image_path in image_paths:
+                image = cv2.imread(image_path)
+                if image is None:
+                    raise ValueError(f'Cannot read {image_path}: fix or remove it, then build the store again')
+                f.write(image.tobytes())
+                offsets.append(offset)
+                shapes.append(image.shape)
+                offset += image.size
+
+        # written last, so that an interrupted run leaves no valid store
+        with open(index_path, 'w', encoding='utf8') as f:
+            json.dump({'images': cls.metadata(image_paths), 'offsets': offsets, 'shapes': shapes}, f)
+
+        print(f'{len(image_paths)} images ({offset / 2 ** 30:.2f} GiB) stored in {pixels_path}')
+
+    @classmethod
+    def up_to_date(cls, store_dir, data_path, image_paths):
+        """Whether the store of a dataset json was built, and its images did not change since"""
+        _, index_path = cls.paths(store_dir, data_path)
+        if not store_dir or not osp.exists(index_path):
+            return False
+
+        with open(index_path, encoding='utf8') as f:
+            return json.load(f)['images'] == cls.metadata(image_paths)
+
+    @classmethod
+    def open(cls, store_dir, data_path, image_paths):
+        """The store of a dataset json, or None if it was not built or its images changed since"""
+        pixels_path, index_path = cls.paths(store_dir, data_path)
+        if not store_dir:
+            return None
+        if not osp.exists(index_path):
+            print(f'{pixels_path} was not built, the images are decoded on the fly')
+            return None
+
+        with open(index_path, encoding='utf8') as f:
+            index = json.load(f)
+        if index['images'] != cls.metadata(image_paths):
+            print(f'{pixels_path} is out of date, the images are decoded on the fly')
+            return None
+
+        return cls(pixels_path, index)
+
+
+def read_image(image_paths, i, store=None):
+    """The i-th image of a dataset, from its ImageStore if there is one"""
+    return store[i] if store is not None else cv2.imread(image_paths[i])
+
+
+def cache_targets(cfg):
+    """
+    Render the validation images and targets once, and store each sample in cfg.VAL_CACHE_DIR as a compressed
+    .npz file (the resized uint8 image, gt, mask and thresh_mask as uint8, and thresh_map as float32),
+    so that the validation steps of generate() only read them.
+    """
+    image_paths, all_anns = load_annotations(cfg.VAL_DATA_PATH)
+    store = ImageStore.open(cfg.IMAGE_STORE_DIR, cfg.VAL_DATA_PATH, image_paths)
+    os.makedirs(cfg.VAL_CACHE_DIR, exist_ok=True)
+
+    for i, anns in enumerate(all_anns):
+        image, anns = resize(cfg.IMAGE_SIZE, read_image(image_paths, i, store), anns)
+        gt, mask, thresh_map, thresh_mask = make_targets(cfg, anns)
+        np.savez_compressed(osp.join(cfg.VAL_CACHE_DIR, f'{i:06d}.npz'),
+                            image=image.astype(np.uint8),
+                            gt=gt.astype(np.uint8),
+                            mask=mask.astype(np.uint8),
+                            thresh_map=thresh_map,
+                            thresh_mask=thresh_mask.astype(np.uint8))
+
+    # written last, so that an interrupted run leaves no valid cache
+    with open(osp.join(cfg.VAL_CACHE_DIR, 'meta.json'), 'w', encoding='utf8') as f:
+        json.dump(cache_metadata(cfg, cfg.VAL_DATA_PATH, image_paths), f)
+
+    print(f'{len(image_paths)} validation samples cached in {cfg.VAL_CACHE_DIR}')
+
+
+def prepare_data(cfg):
+    """
+    Store the decoded training and validation images of cfg in an ImageStore, then render its validation targets
+    with cache_targets(), unless they are up to date (or cfg.IMAGE_STORE_DIR / cfg.VAL_CACHE_DIR is '').
+    The training script calls it with its own config before starting the data loaders.
+    """
+    if cfg.IMAGE_STORE_DIR:
+        for data_path in (cfg.TRAIN_DATA_PATH, cfg.VAL_DATA_PATH):
+            if not ImageStore.up_to_date(cfg.IMAGE_STORE_DIR, data_path, load_annotations(data_path)[0]):
+                ImageStore.build(cfg.IMAGE_STORE_DIR, data_path)
+
+    if cfg.VAL_CACHE_DIR and not cached_targets(cfg, cfg.VAL_DATA_PATH, load_annotations(cfg.VAL_DATA_PATH)[0]):
+        cache_targets(cfg)
+
+
+def make_sample(cfg, image, anns, train_or_val='train', transform_aug=None):
+    """Augment an image (for training) and resize it; return it with its targets"""
+    # show_polys(image.copy(), anns, 'before_aug')
+    if train_or_val=='train':
+        transform_aug = transform_aug.to_deterministic()
+        image, anns = transform(transform_aug, image, anns)
+        image, anns = crop(image, anns)
+        if cfg.AUGMENTATION_BACKEND == 'tensorflow':
+            image = aug(image)
+            image = image.numpy()
+        else:
+            image = aug_opencv(image)
+
+    image, anns = resize(cfg.IMAGE_SIZE, image, anns)
+    # show_polys(image.copy(), anns, 'after_aug')
+    # cv2.waitKey(0)
+    return (image,) + make_targets(cfg, anns)
+
+
+def load_cached_sample(cfg, i):
+    """Read a validation image and its targets from the cache of cache_targets()"""
+    cached = np.load(osp.join(cfg.VAL_CACHE_DIR, f'{i:06d}.npz'))
+    return tuple(cached[name] for name in ('image', 'gt', 'mask', 'thresh_map', 'thresh_mask'))
+
+
+def generate_samples(cfg, train_or_val='train', worker_id=0, workers=1):
+    """
+    Yield the (image, gt, mask, thresh_map, thresh_mask) samples of a dataset, one epoch after the other
+    (shuffled, for training). With several workers, each of them only yields its own shard of the dataset.
+    """
+    data_path = cfg.TRAIN_DATA_PATH if train_or_val=='train' else cfg.VAL_DATA_PATH
+    image_paths, all_anns = load_annotations(data_path)
+
+    # the validation samples are read from the cache of cache_targets(), if it is up to date
+    use_cache = train_or_val != 'train' and cached_targets(cfg, data_path, image_paths)
+    if train_or_val != 'train' and getattr(cfg, 'VAL_CACHE_DIR', '') and not use_cache:
+        print(f'No up to date validation targets in {cfg.VAL_CACHE_DIR}, the targets are rendered on the fly')
+    store = ImageStore.open(cfg.IMAGE_STORE_DIR, data_path, image_paths) if not use_cache else None
+
+    transform_aug = iaa.Sequential([iaa.Affine(rotate=(-10, 10)), iaa.Resize((0.5, 3.0))])
+    indices = np.arange(len(image_paths))[worker_id::workers]
+
+    while True:
+        if train_or_val=='train':
+            np.random.shuffle(indices)
+        for i in indices:
+            """
+            [{'text': 'chinese', 'poly': [[17.86985870232934, 29.2253341902275], [18.465581783660582, 7.2334012599376365], [525.2796724953414, 20.9621104524324], [524.6839494140104, 42.954043382722375]]},
+            {'text': 'chinese', 'poly': [[9.746362138723043, 329.1153286941807], [10.667025082598343, 295.12779598373265], [589.454714475228, 310.8061443514931], [588.5340515313526, 344.79367706194114]]}]
+            """
+            if use_cache:
+                yield load_cached_sample(cfg, i)
+            else:
+                yield make_sample(cfg, read_image(image_paths, i, store), all_anns[i], train_or_val, transform_aug)
+
+
+def fill_batch(batch, samples):
+    """Write the next samples into the [images, gts, masks, thresh_maps, thresh_masks] arrays of a batch,
+    as they are (the mean color is subtracted from the images by the caller)"""
+    for b in range(len(batch[0])):
+        for array, value in zip(batch, next(samples)):
+            array[b] = value
+
+
+def batch_shapes(cfg):
+    """The shapes of the [images, gts, masks, thresh_maps, thresh_masks] arrays of a batch"""
+    maps_shape = (cfg.BATCH_SIZE, cfg.IMAGE_SIZE, cfg.IMAGE_SIZE)
+    return [maps_shape + (3,)] + [maps_shape] * 4
+
+
+# the types of the [images, gts, masks, thresh_maps, thresh_masks] arrays of a batch in shared memory:
+# the images and the binary maps fit in uint8, and are converted to float32 by batch_inputs
+BATCH_DTYPES = [np.uint8, np.uint8, np.uint8, np.float32, np.uint8]
+
+
+def batch_inputs(batch):
+    """The float32 model inputs of the arrays of a batch of BATCH_DTYPES, with the mean color subtracted
+    from the images"""
+    images = np.subtract(batch[0], np.float32(mean), dtype=np.float32)
+    return [images] + [array.astype(np.float32) for array in batch[1:]]
+
+
+def generate(cfg, train_or_val='train'):
+    def init_input():
+        batch_images = np.zeros([cfg.BATCH_SIZE, cfg.IMAGE_SIZE, cfg.IMAGE_SIZE, 3], dtype=np.float32)
+        batch_gts = np.zeros([cfg.BATCH_SIZE, cfg.IMAGE_SIZE, cfg.IMAGE_SIZE], dtype=np.float32)
+        batch_masks = np.zeros([cfg.BATCH_SIZE, cfg.IMAGE_SIZE, cfg.IMAGE_SIZE], dtype=np.float32)
+        batch_thresh_maps = np.zeros([cfg.BATCH_SIZE, cfg.IMAGE_SIZE, cfg.IMAGE_SIZE], dtype=np.float32)
+        batch_thresh_masks = np.zeros([cfg.BATCH_SIZE, cfg.IMAGE_SIZE, cfg.IMAGE_SIZE], dtype=np.float32)
+        # batch_loss = np.zeros([cfg.BATCH_SIZE, ], dtype=np.float32)
+        return [batch_images, batch_gts, batch_masks, batch_thresh_maps, batch_thresh_masks]
+
+    samples = generate_samples(cfg, train_or_val)
+    while True:
+        inputs = init_input()
+        fill_batch(inputs, samples)
+        np.subtract(inputs[0], mean, out=inputs[0])
+        # outputs = batch_loss
+        outputs = []
+        yield inputs, outputs
+
+
+def _produce_batches(cfg, train_or_val, worker_id, workers, seed, memory_names, slots, free_slots, ready_slots):
+    """The loop of a worker process of parallel_generate: fill the free slots of the shared batch buffers"""
+    # the GPU is left to the training process: a worker running the tensorflow augmentations on it
+    # would create its own CUDA context and reserve most of its memory
+    tf.config.set_visible_devices([], 'GPU')
+
+    random.seed(seed)
+    np.random.seed(seed)
+    imgaug.seed(seed)
+    tf.random.set_seed(seed)
+
+    memories = [shared_memory.SharedMemory(name=name) for name in memory_names]
+    buffers = [np.ndarray((slots,) + shape, dtype=dtype, buffer=memory.buf)
+               for shape, dtype, memory in zip(batch_shapes(cfg), BATCH_DTYPES, memories)]
+
+    samples = generate_samples(cfg, train_or_val, worker_id, workers)
+    for slot in iter(free_slots.get, None):
+        fill_batch([buffer[slot] for buffer in buffers], samples)
+        ready_slots.put(slot)
+
+
+def parallel_generate(cfg, train_or_val='train', workers=4, prefetch=4, seed=None):
+    """
+    Like generate(), with the batches produced by worker processes.
+
+    Each worker (at most one per image of the dataset) produces whole batches from its own shard of the dataset,
+    with its own random generators (numpy, random, imgaug and TensorFlow, seeded from seed, the partition and
+    its index; if seed is None, a random seed is drawn and printed, so that a run can be reproduced), and writes them
+    into its own slots of the batch buffers in shared memory (as BATCH_DTYPES). Each worker has
+    1 + ceil(prefetch / workers) slots, which bounds the number of batches produced ahead of the training;
+    each batch is copied out of its slot (as float32, see batch_inputs) when it is yielded, so that the slot
+    can be refilled while the model trains on it.
+    The batches are yielded from the workers in turn, so that the same seed always gives the same sequence of batches,
+    whatever the speed of the workers.
+
+    The workers are started with the spawn method (TensorFlow, imported by the training script and used by
+    the tensorflow augmentation backend, is not fork-safe), so the main code of the training script must be guarded
+    by if __name__ == '__main__'.
+    """
+    # each worker needs at least one image in its shard, or it would loop forever without producing any batch
+    data_path = cfg.TRAIN_DATA_PATH if train_or_val=='train' else cfg.VAL_DATA_PATH
+    dataset_size = len(load_annotations(data_path)[0])
+    if dataset_size == 0:
+        raise ValueError(f'{data_path} has no images')
+    workers = min(workers, dataset_size)
+
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    print(f'{train_or_val} data loader seed: {seed}')
+
+    # the training and validation loaders of the same seed get different generators
+    seed_sequence = np.random.SeedSequence([seed, int(train_or_val != 'train')])
+    worker_seeds = [int(worker_sequence.generate_state(1)[0]) for worker_sequence in seed_sequence.spawn(workers)]
+
+    context = multiprocessing.get_context('spawn')
+    worker_slots = 1 + math.ceil(prefetch / workers)
+    slots = workers * worker_slots
+
+    shapes = batch_shapes(cfg)
+    sizes = [slots * int(np.prod(shape)) * np.dtype(dtype).itemsize for shape, dtype in zip(shapes, BATCH_DTYPES)]
+
+    # a worker writing to a full /dev/shm would be killed by a SIGBUS
+    free_memory = shutil.disk_usage('/dev/shm').free if osp.isdir('/dev/shm') else None
+    if free_memory is not None and free_memory < sum(sizes):
+        raise RuntimeError(f'The {train_or_val} data loader needs {sum(sizes) / 2 ** 20:.0f} MiB of shared memory, '
+                           f'but only {free_memory / 2 ** 20:.0f} MiB are free in /dev/shm: '
+                           f'reduce the batch size, the workers or the prefetched batches, or enlarge /dev/shm')
+
+    memories = [shared_memory.SharedMemory(create=True, size=size) for size in sizes]
+    buffers = [np.ndarray((slots,) + shape, dtype=dtype, buffer=memory.buf)
+               for shape, dtype, memory in zip(shapes, BATCH_DTYPES, memories)]
+
+    # each worker fills its own slots, worker_id * worker_slots to (worker_id + 1) * worker_slots - 1
+    free_slots = [context.Queue() for _ in range(workers)]
+    ready_slots = [context.Queue() for _ in range(workers)]
+    for slot in range(slots):
+        free_slots[slot // worker_slots].put(slot)
+
+    processes = [context.Process(target=_produce_batches,
+                                 args=(cfg, train_or_val, worker_id, workers, worker_seeds[worker_id],
+                                       [memory.name for memory in memories], slots,
+                                       free_slots[worker_id], ready_slots[worker_id]),
+                                 daemon=True)
+                 for worker_id in range(workers)]
+    for process in processes:
+        process.start()
+
+    try:
+        worker_id = 0
+        while True:
+            try:
+                slot = ready_slots[worker_id].get(timeout=1)
+            except queue.Empty:
+                if not all(process.is_alive() for process in processes):
+                    raise RuntimeError('A data loader worker exited unexpectedly')
+                continue
+
+            inputs = batch_inputs([buffer[slot] for buffer in buffers])
+            free_slots[worker_id].put(slot)
+            worker_id = (worker_id + 1) % workers
             outputs = []
             yield inputs, outputs
-            b = 0
-
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+        del buffers
+        for memory in memories:
+            memory.close()
+            memory.unlink()
+
+
+if __name__ == '__main__':
+    # decode the training and validation images once (see ImageStore), then render the validation targets
+    # once (see cache_targets); script/train.py does the same with its own config
+    prepare_data(cfg)
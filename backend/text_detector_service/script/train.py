@@ -7,34 +7,10 @@ import datetime
 from tensorflow.keras import callbacks
 from tensorflow.keras import optimizers
 from backend.text_detector_service.model import DBNet
-from generate import generate
+from generate import parallel_generate, prepare_data
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 
-# TODO: Path with train examples
-training_set_path = ''
-
-r, g, b = 0, 0, 0
-
-files = glob.glob(training_set_path + '/*.jpg', recursive=True)
-
-# Get List of all images
-for e in files:
-    image = cv2.imread(e)
-    r_mean = np.mean(np.reshape(image[:, :, 0], -1))
-    g_mean = np.mean(np.reshape(image[:, :, 1], -1))
-    b_mean = np.mean(np.reshape(image[:, :, 2], -1))
-    r += r_mean
-    g += g_mean
-    b += b_mean
-
-r = r//len(files)
-b = b//len(files)
-g = g//len(files)
-
-print(r, g, b)
-
-
 # Dovrebbe essere lo stesso di text-detector/text_detector/config.py tranne che per la variabile MEAN
 class DBConfig(object):
 
@@ -64,6 +40,25 @@ class DBConfig(object):
 
     TRAIN_DATA_PATH = 'text_detector_dataset/data/train.json'
     VAL_DATA_PATH = 'text_detector_dataset/data/val.json'
+    # the validation targets rendered once by generate.py or at the start of the training (used if up to date,
+    # '' to disable)
+    VAL_CACHE_DIR = 'text_detector_dataset/cache/val'
+
+    # the decoded images, stored once by generate.py or at the start of the training (used if up to date,
+    # '' to disable)
+    IMAGE_STORE_DIR = 'text_detector_dataset/cache/images'
+
+    # the photometric augmentations of the training images: "opencv" (aug_cv.py) or "tensorflow" (aug.py)
+    AUGMENTATION_BACKEND = "opencv"
+
+    # the batches are produced by DATA_WORKERS processes, up to PREFETCH_BATCHES ahead of the training
+    # (each batch takes BATCH_SIZE * IMAGE_SIZE ** 2 * 10 bytes of /dev/shm, about 33 MB with the defaults);
+    # the validation batches are produced by one process, up to VAL_PREFETCH_BATCHES ahead
+    DATA_WORKERS = 4
+    PREFETCH_BATCHES = 4
+    VAL_PREFETCH_BATCHES = 1
+    # the seed of the data loaders (None to draw a new one at each run, printed at the start of the training)
+    SEED = None
 
     IMAGE_SIZE = 640
     BATCH_SIZE = 8
@@ -81,56 +76,92 @@ class DBConfig(object):
             os.makedirs(self.LOG_DIR)
 
 
-cfg = DBConfig()
+# the data loader workers are spawned processes, which import this script: the training only runs in the main process
+if __name__ == '__main__':
+    # TODO: Path with train examples
+    training_set_path = ''
+
+    r, g, b = 0, 0, 0
+
+    files = glob.glob(training_set_path + '/*.jpg', recursive=True)
+
+    # Get List of all images
+    for e in files:
+        image = cv2.imread(e)
+        r_mean = np.mean(np.reshape(image[:, :, 0], -1))
+        g_mean = np.mean(np.reshape(image[:, :, 1], -1))
+        b_mean = np.mean(np.reshape(image[:, :, 2], -1))
+        r += r_mean
+        g += g_mean
+        b += b_mean
+
+    r = r//len(files)
+    b = b//len(files)
+    g = g//len(files)
+
+    print(r, g, b)
+
+
+    cfg = DBConfig()
+
+    print('Start Training DBNet')
+    print('dataset path:', cfg.TRAIN_DATA_PATH)
+    print('pixels mean:', cfg.MEAN)
 
-print('Start Training DBNet')
-print('dataset path:', cfg.TRAIN_DATA_PATH)
-print('pixels mean:', cfg.MEAN)
+    # the images are decoded and the validation targets rendered once for this config,
+    # and the data loaders read them from then on
+    prepare_data(cfg)
 
-train_generator = generate(cfg, 'train')
-val_generator = generate(cfg, 'val')
+    train_generator = parallel_generate(cfg, 'train', workers=cfg.DATA_WORKERS, prefetch=cfg.PREFETCH_BATCHES,
+                                        seed=cfg.SEED)
+    val_generator = parallel_generate(cfg, 'val', workers=1, prefetch=cfg.VAL_PREFETCH_BATCHES, seed=cfg.SEED)
 
-model = DBNet(cfg, model='training')
+    model = DBNet(cfg, model='training')
 
-print('pretrained:', cfg.PRETRAINED_MODEL_PATH)
-print('output path:', cfg.CHECKPOINT_DIR)
+    print('pretrained:', cfg.PRETRAINED_MODEL_PATH)
+    print('output path:', cfg.CHECKPOINT_DIR)
 
-load_weights_path = cfg.PRETRAINED_MODEL_PATH
-if load_weights_path:
-    print('loading pretrained weights..')
-    model.load_weights(cfg.PRETRAINED_MODEL_PATH, by_name=True, skip_mismatch=True)
+    load_weights_path = cfg.PRETRAINED_MODEL_PATH
+    if load_weights_path:
+        print('loading pretrained weights..')
+        model.load_weights(cfg.PRETRAINED_MODEL_PATH, by_name=True, skip_mismatch=True)
 
-model.compile(optimizer=optimizers.Adam(learning_rate=cfg.LEARNING_RATE),
-              loss=[None] * len(model.output.shape))
+    model.compile(optimizer=optimizers.Adam(learning_rate=cfg.LEARNING_RATE),
+                  loss=[None] * len(model.output.shape))
 
-model.summary()
+    model.summary()
 
 
-checkpoint_callback = callbacks.ModelCheckpoint(
-                filepath=cfg.CHECKPOINT_DIR,
-                monitor="val_loss",
-                save_best_only=True,
-                save_weights_only=True,
-                verbose=1),
-reduce_lr = callbacks.ReduceLROnPlateau(
-                monitor="val_loss",
-                min_delta=1e-8,
-                factor=0.2,
-                patience=10,
-                verbose=1)
-callbacks = [checkpoint_callback, reduce_lr]
+    checkpoint_callback = callbacks.ModelCheckpoint(
+                    filepath=cfg.CHECKPOINT_DIR,
+                    monitor="val_loss",
+                    save_best_only=True,
+                    save_weights_only=True,
+                    verbose=1),
+    reduce_lr = callbacks.ReduceLROnPlateau(
+                    monitor="val_loss",
+                    min_delta=1e-8,
+                    factor=0.2,
+                    patience=10,
+                    verbose=1)
+    callbacks = [checkpoint_callback, reduce_lr]
 
 
-model.fit(
-    x=train_generator,
-    steps_per_epoch=cfg.STEPS_PER_EPOCH,
-    initial_epoch=cfg.INITIAL_EPOCH,
-    epochs=cfg.EPOCHS,
-    verbose=1,
-    callbacks=callbacks,
-    validation_data=val_generator,
-    validation_steps=cfg.VALIDATION_STEPS
-)
+    # closing the loaders stops their workers and releases their shared memory
+    try:
+        model.fit(
+            x=train_generator,
+            steps_per_epoch=cfg.STEPS_PER_EPOCH,
+            initial_epoch=cfg.INITIAL_EPOCH,
+            epochs=cfg.EPOCHS,
+            verbose=1,
+            callbacks=callbacks,
+            validation_data=val_generator,
+            validation_steps=cfg.VALIDATION_STEPS
+        )
 
-val = model.evaluate(val_generator, steps=10)
-print(val)
+        val = model.evaluate(val_generator, steps=10)
+        print(val)
+    finally:
+        train_generator.close()
+        val_generator.close()
@@ -8,29 +8,42 @@ import numpy as np
 import imgaug
 
 
+def stack_polygons(anns):
+    """Stack the vertices of the polygons of the annotations into a single (N, 2) float array;
+    return it with the number of vertices of each polygon"""
+    lengths = np.array([len(ann['poly']) for ann in anns], dtype=np.int64)
+    if len(anns) == 0:
+        return np.zeros((0, 2)), lengths
+    return np.concatenate([np.asarray(ann['poly'], dtype=np.float64).reshape(-1, 2) for ann in anns]), lengths
+
+
+def unstack_polygons(points, lengths):
+    """The list of the polygons (as lists of [x, y]) of a stacked vertices array"""
+    return [poly.tolist() for poly in np.split(points, np.cumsum(lengths)[:-1])] if len(lengths) > 0 else []
+
+
 def transform(aug, image, anns):
     image_shape = image.shape
     image = aug.augment_image(image)
-    new_anns = []
-    for ann in anns:
-        keypoints = [imgaug.Keypoint(p[0], p[1]) for p in ann['poly']]
-        keypoints = aug.augment_keypoints(
-            [imgaug.KeypointsOnImage(keypoints, shape=image_shape)])[0].keypoints
-        poly = [(min(max(0, p.x), image.shape[1] - 1), min(max(0, p.y), image.shape[0] - 1)) for p in keypoints]
-        new_ann = {'poly': poly, 'text': ann['text']}
-        new_anns.append(new_ann)
+    if len(anns) == 0:
+        return image, []
+
+    # the vertices of all the polygons go through the (deterministic) augmenter at once
+    points, lengths = stack_polygons(anns)
+    keypoints = imgaug.KeypointsOnImage.from_xy_array(points, shape=image_shape)
+    points = aug.augment_keypoints([keypoints])[0].to_xy_array().astype(np.float64)
+    points[:, 0] = np.clip(points[:, 0], 0, image.shape[1] - 1)
+    points[:, 1] = np.clip(points[:, 1], 0, image.shape[0] - 1)
+
+    new_anns = [{'poly': poly, 'text': ann['text']} for poly, ann in zip(unstack_polygons(points, lengths), anns)]
     return image, new_anns
 
 
 def split_regions(axis):
-    regions = []
-    min_axis_index = 0
-    for i in range(1, axis.shape[0]):
-        if axis[i] != axis[i - 1] + 1:
-            region = axis[min_axis_index:i]
-            min_axis_index = i
-            regions.append(region)
-    return regions
+    """Split a sorted array of indices into its runs of consecutive indices
+    (the last run is left out, as it always was)"""
+    starts = np.flatnonzero(np.diff(axis) != 1) + 1
+    return np.split(axis, starts)[:-1]
 
 
 def random_select(axis):
@@ -45,25 +58,40 @@ def region_wise_random_select(regions):
     selected_values = []
     for index in selected_index:
         axis = regions[index]
-        xx = int(np.random.choice(axis, size=1))
+        xx = int(np.random.choice(axis, size=1)[0])
         selected_values.append(xx)
     xmin = min(selected_values)
     xmax = max(selected_values)
     return xmin, xmax
 
 
+def covered(length, starts, ends):
+    """The 0/1 array of the indices of an axis covered by at least one of the [start, end) intervals"""
+    starts = np.clip(starts, 0, length)
+    ends = np.clip(ends, 0, length)
+    valid = ends > starts
+
+    changes = np.zeros(length + 1, dtype=np.int32)
+    np.add.at(changes, starts[valid], 1)
+    np.add.at(changes, ends[valid], -1)
+    return (np.cumsum(changes[:-1]) > 0).astype(np.int32)
+
+
 def crop(image, anns, max_tries=10, min_crop_side_ratio=0.1):
     h, w, _ = image.shape
-    h_array = np.zeros(h, dtype=np.int32)
-    w_array = np.zeros(w, dtype=np.int32)
-    for ann in anns:
-        points = np.round(ann['poly'], decimals=0).astype(np.int32)
-        minx = np.min(points[:, 0])
-        maxx = np.max(points[:, 0])
-        w_array[minx:maxx] = 1
-        miny = np.min(points[:, 1])
-        maxy = np.max(points[:, 1])
-        h_array[miny:maxy] = 1
+    if len(anns) == 0:
+        return image, anns
+
+    # the bounding boxes of all the polygons at once
+    points, lengths = stack_polygons(anns)
+    offsets = np.cumsum(lengths) - lengths
+    mins = np.minimum.reduceat(points, offsets, axis=0)
+    maxs = np.maximum.reduceat(points, offsets, axis=0)
+
+    rounded_mins = np.round(mins).astype(np.int32)
+    rounded_maxs = np.round(maxs).astype(np.int32)
+    w_array = covered(w, rounded_mins[:, 0], rounded_maxs[:, 0])
+    h_array = covered(h, rounded_mins[:, 1], rounded_maxs[:, 1])
     # ensure the cropped area not across a text
     h_axis = np.where(h_array == 0)[0]
     w_axis = np.where(w_array == 0)[0]
@@ -87,22 +115,21 @@ def crop(image, anns, max_tries=10, min_crop_side_ratio=0.1):
         if xmax - xmin < min_crop_side_ratio * w or ymax - ymin < min_crop_side_ratio * h:
             # area too small
             continue
-        new_anns = []
-        for ann in anns:
-            poly = np.array(ann['poly'])
-            if not (poly[:, 0].min() > xmax
-                    or poly[:, 0].max() < xmin
-                    or poly[:, 1].min() > ymax
-                    or poly[:, 1].max() < ymin):
-                poly[:, 0] -= xmin
-                poly[:, 0] = np.clip(poly[:, 0], 0., (xmax - xmin - 1) * 1.)
-                poly[:, 1] -= ymin
-                poly[:, 1] = np.clip(poly[:, 1], 0., (ymax - ymin - 1) * 1.)
-                new_ann = {'poly': poly.tolist(), 'text': ann['text']}
-                new_anns.append(new_ann)
-
-        if len(new_anns) > 0:
-            return image[ymin:ymax, xmin:xmax], new_anns
+
+        # the polygons that overlap the window, tested all at once
+        inside = ~((mins[:, 0] > xmax) | (maxs[:, 0] < xmin) | (mins[:, 1] > ymax) | (maxs[:, 1] < ymin))
+        if not inside.any():
+            continue
+
+        kept = np.repeat(inside, lengths)
+        window_points = points[kept] - [xmin, ymin]
+        window_points[:, 0] = np.clip(window_points[:, 0], 0., (xmax - xmin - 1) * 1.)
+        window_points[:, 1] = np.clip(window_points[:, 1], 0., (ymax - ymin - 1) * 1.)
+
+        new_anns = [{'poly': poly, 'text': ann['text']}
+                    for poly, ann in zip(unstack_polygons(window_points, lengths[inside]),
+                                         (ann for ann, keep in zip(anns, inside) if keep))]
+        return image[ymin:ymax, xmin:xmax], new_anns
 
     return image, anns
 
@@ -1,8 +1,9 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from text_detection import text_detection
+from text_detection import TextDetector, text_detection, text_detection_batch
 from model import DBNet
-from config import MODEL_PATH, DBConfig
+from config import MODEL_PATH, DBConfig, CORPUS_BATCH_SIZE, CORPUS_BUCKET_STEP, CORPUS_WINDOW_SIZE, \
+    POSTPROCESSING_THREADS, UNCLIP_THREADS, TILE_SIZE, TILE_OVERLAP, TILE_STITCH, TILE_PRESET, DETECTOR_PRESET
 
 # init flask app
 app = Flask(__name__)
@@ -13,7 +14,7 @@ def init_text_detector(model_path):
     print("Create TF DBNet")
     model = DBNet(cfg, model='inference')
     model.load_weights(model_path, by_name=True, skip_mismatch=True)
-    return model
+    return TextDetector(model, preset=DETECTOR_PRESET, unclip_threads=UNCLIP_THREADS)
 
 @app.route('/')
 def hello():
@@ -23,7 +24,12 @@ def hello():
 def segmentation():
     if request.method == 'POST':
         uploaded_file = request.files.get('file')
-        bb = text_detection(uploaded_file, text_detector)
+        bb = text_detection(uploaded_file, text_detector,
+                            tile_size=TILE_SIZE,
+                            tile_overlap=TILE_OVERLAP,
+                            tile_batch_size=CORPUS_BATCH_SIZE,
+                            stitch=TILE_STITCH,
+                            preset=TILE_PRESET if TILE_SIZE is not None else None)
         print(bb)
         return bb, 200
     else:
@@ -35,10 +41,17 @@ def segmentation_corpus():
     if request.method == 'POST':
         corpus = request.files.to_dict()    # convert in mutable dict, useful but not necessary
         print(corpus)
-        corpus_segmentation = []
-        for file in corpus.keys():
-            bb = text_detection(corpus[file], text_detector)
-            corpus_segmentation.append({file: bb})    # batch
+        file_names = list(corpus.keys())
+        corpus_bb = text_detection_batch([corpus[file] for file in file_names], text_detector,
+                                         batch_size=CORPUS_BATCH_SIZE,
+                                         bucket_step=CORPUS_BUCKET_STEP,
+                                         window_size=CORPUS_WINDOW_SIZE,
+                                         num_threads=POSTPROCESSING_THREADS,
+                                         tile_size=TILE_SIZE,
+                                         tile_overlap=TILE_OVERLAP,
+                                         stitch=TILE_STITCH,
+                                         preset=TILE_PRESET if TILE_SIZE is not None else None)
+        corpus_segmentation = [{file: bb} for file, bb in zip(file_names, corpus_bb)]
         return jsonify({'segmentation': corpus_segmentation}), 200
     else:
         return "sorry, bad request", 400
@@ -1,96 +1,92 @@
+import math
 import cv2
 import numpy as np
-import datetime
-import tensorflow as tf
-from shapely.geometry import Polygon
 import pyclipper
-
-# Mettere tutto in una classe
-
-def box_score_fast(bitmap, _box):
-    h, w = bitmap.shape[:2]
-    box = _box.copy()
-    xmin = np.clip(np.floor(box[:, 0].min()).astype(np.int), 0, w - 1)
-    xmax = np.clip(np.ceil(box[:, 0].max()).astype(np.int), 0, w - 1)
-    ymin = np.clip(np.floor(box[:, 1].min()).astype(np.int), 0, h - 1)
-    ymax = np.clip(np.ceil(box[:, 1].max()).astype(np.int), 0, h - 1)
-
-    mask = np.zeros((ymax - ymin + 1, xmax - xmin + 1), dtype=np.uint8)
-    box[:, 0] = box[:, 0] - xmin
-    box[:, 1] = box[:, 1] - ymin
-    cv2.fillPoly(mask, box.reshape(1, -1, 2).astype(np.int32), 1)
-    return cv2.mean(bitmap[ymin:ymax + 1, xmin:xmax + 1], mask)[0]
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 def unclip(box, unclip_ratio=1.5):
-    poly = Polygon(box)
-    distance = poly.area * unclip_ratio / poly.length
+    """Expand a polygon by a distance proportional to its area over its perimeter; return the expanded polygons"""
+    box = box.reshape(-1, 1, 2).astype(np.float32)
+    distance = cv2.contourArea(box) * unclip_ratio / cv2.arcLength(box, True)
     offset = pyclipper.PyclipperOffset()
-    offset.AddPath(box, pyclipper.JT_ROUND, pyclipper.ET_CLOSEDPOLYGON)
-    expanded = np.array(offset.Execute(distance))
-    return expanded
-
+    offset.AddPath(box.reshape(-1, 2).astype(np.int64).tolist(), pyclipper.JT_ROUND, pyclipper.ET_CLOSEDPOLYGON)
+    return [np.array(path) for path in offset.Execute(distance)]
 
-def get_mini_boxes(contour):
-    if not contour.size:
-        return [], 0
-    bounding_box = cv2.minAreaRect(contour)
-    points = sorted(list(cv2.boxPoints(bounding_box)), key=lambda x: x[0])
-
-    index_1, index_2, index_3, index_4 = 0, 1, 2, 3
-    if points[1][1] > points[0][1]:
-        index_1 = 0
-        index_4 = 1
-    else:
-        index_1 = 1
-        index_4 = 0
-    if points[3][1] > points[2][1]:
-        index_2 = 2
-        index_3 = 3
-    else:
-        index_2 = 3
-        index_3 = 2
 
-    box = [points[index_1], points[index_2],
-           points[index_3], points[index_4]]
-    return box, min(bounding_box[1])
+def polygons_from_bitmap(pred, bitmap, dest_width, dest_height, max_candidates=500, box_thresh=0.7,
+                         unclip_ratio=2.0, executor=None, num_threads=1):
+    """
+    Extract the text polygons from the probability map pred of a page and its binarization bitmap.
 
+    All the candidates are scored in one pass: the score of a candidate is the mean probability of its connected
+    component of the bitmap. The candidates with a high enough score are then unclipped on the num_threads threads
+    of executor (or in the calling thread, if executor is None).
 
-def polygons_from_bitmap(pred, bitmap, dest_width, dest_height, max_candidates=500, box_thresh=0.7):
+    :return: the list of the (N_i, 2) int arrays of the polygons, in the dest_width x dest_height coordinates,
+             and the array of their scores
+    """
     pred = pred[..., 0]
-    bitmap = bitmap[..., 0]
+    bitmap = bitmap[..., 0].astype(np.uint8)
     height, width = bitmap.shape
-    boxes = []
-    scores = []
-
-    contours, _ = cv2.findContours((bitmap * 255).astype(np.uint8), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
 
-    for contour in contours[:max_candidates]:
-        epsilon = 0.001 * cv2.arcLength(contour, True)
-        approx = cv2.approxPolyDP(contour, epsilon, True)
-        points = approx.reshape((-1, 2))
-        if points.shape[0] < 4:
+    # the mean probability of each connected component of the bitmap
+    num_labels, labels = cv2.connectedComponents(bitmap, connectivity=8)
+    foreground = bitmap > 0
+    foreground_labels = labels[foreground]
+    sizes = np.bincount(foreground_labels, minlength=num_labels)
+    label_scores = np.bincount(foreground_labels, weights=pred[foreground], minlength=num_labels) / np.maximum(sizes, 1)
+
+    contours, _ = cv2.findContours(bitmap, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    contours = contours[:max_candidates]
+    if len(contours) == 0:
+        return [], np.zeros(0)
+
+    # each external contour is the border of one component: read its label at its first point
+    first_points = np.array([contour[0, 0] for contour in contours])
+    scores = label_scores[labels[first_points[:, 1], first_points[:, 0]]]
+
+    candidates = []
+    for contour, score in zip(contours, scores):
+        if score < box_thresh:
             continue
-        score = box_score_fast(pred, points.reshape(-1, 2))
-        if box_thresh > score:
-            continue
-        if points.shape[0] > 2:
-            box = unclip(points, unclip_ratio=2.0)
-            if len(box) > 1:
+        epsilon = 0.001 * cv2.arcLength(contour, True)
+        points = cv2.approxPolyDP(contour, epsilon, True).reshape((-1, 2))
+        if points.shape[0] >= 4:
+            candidates.append((points, score))
+
+    def expand(candidates_chunk):
+        expanded_boxes = []
+        for points, score in candidates_chunk:
+            expanded = unclip(points, unclip_ratio=unclip_ratio)
+            if len(expanded) != 1:
                 continue
-        else:
-            continue
 
-        box = box.reshape(-1, 2)
-        _, sside = get_mini_boxes(box.reshape((-1, 1, 2)))
-        if sside < 5:
-            continue
+            box = expanded[0]
+            if min(cv2.minAreaRect(box.reshape((-1, 1, 2)).astype(np.float32))[1]) < 5:
+                continue
+            expanded_boxes.append((box, score))
+        return expanded_boxes
 
+    if executor is None:
+        expanded_chunks = [expand(candidates)]
+    else:
+        # one task for each thread, rather than one for each candidate
+        chunk_size = int(np.ceil(len(candidates) / num_threads))
+        chunks = [candidates[i:i + chunk_size] for i in range(0, len(candidates), max(chunk_size, 1))]
+        expanded_chunks = executor.map(expand, chunks)
+
+    boxes = []
+    box_scores = []
+    for box, score in (result for chunk in expanded_chunks for result in chunk):
+        box = box.astype(np.float64)
         box[:, 0] = np.clip(np.round(box[:, 0] / width * dest_width), 0, dest_width)
         box[:, 1] = np.clip(np.round(box[:, 1] / height * dest_height), 0, dest_height)
-        boxes.append(box.tolist())
-        scores.append(score)
-    return boxes, scores
+        boxes.append(box.astype(np.int64))
+        box_scores.append(score)
+
+    return boxes, np.array(box_scores)
 
 
 def resize_image_bigsize(img, big_size):
@@ -107,61 +103,301 @@ def resize_image_bigsize(img, big_size):
     return resized_img, new_width, new_height
 
 
-def text_detection(uploaded_file, text_detector):
-    print('db_segmentation function started')
-    start_time = datetime.datetime.now()
+def resize_image_smallsize(img, small_size):
+    height, width, _ = img.shape
+    if height < width:
+        new_height = small_size
+        new_width = int(math.ceil(new_height / height * width / 32) * 32)
+    else:
+        new_width = small_size
+        new_height = int(math.ceil(new_width / width * height / 32) * 32)
+    resized_img = cv2.resize(img, (new_width, new_height))
+    return resized_img, new_width, new_height
 
-    BOX_THRESH = 0.5
-    # mean = np.array([103.939, 116.779, 123.68])
-    mean = np.array([179.0, 183.0, 190.0])
 
-    # read file
-    print('read image')
-    print(type(uploaded_file))
+BOX_THRESH = 0.5
+BITMAP_THRESH = 0.3
+# MEAN = np.array([103.939, 116.779, 123.68])
+MEAN = np.array([179.0, 183.0, 190.0], dtype=np.float32)
+
+# the resolutions at which the pages go through the model: the long side resized to 2500 pixels (the server),
+# the short side resized to 736 pixels (the former inference script), or the page kept at its own resolution;
+# the sides are always rounded to multiples of 32, as the model requires
+RESOLUTION_PRESETS = {
+    "long_side_2500": (resize_image_bigsize, 2500),
+    "short_side_736": (resize_image_smallsize, 736),
+    "full": (resize_image_bigsize, None),
+}
+
+
+def read_image(uploaded_file):
+    """Decode an uploaded image file into a BGR uint8 image"""
     filestr = uploaded_file.read()
-    print('uploaded_file', uploaded_file)
     npimg = np.frombuffer(filestr, np.uint8)
-    image = cv2.imdecode(npimg, cv2.IMREAD_COLOR)
+    return cv2.imdecode(npimg, cv2.IMREAD_COLOR)
+
+
+class TextDetector:
+    """
+    The DBNet text detector: the model, with the preprocessing of the pages and the post-processing of their
+    probability maps, shared by the server and the scripts.
+
+    The candidate polygons of the pages are unclipped on a pool of unclip_threads threads, shared by all the pages
+    and created at the first use (0 unclips them in the thread that post-processes the page).
+    """
+
+    def __init__(self, model, preset="long_side_2500", mean=MEAN, box_thresh=BOX_THRESH,
+                 bitmap_thresh=BITMAP_THRESH, unclip_ratio=2.0, max_candidates=500, unclip_threads=4):
+        if preset not in RESOLUTION_PRESETS:
+            raise ValueError(f"Unknown resolution preset {preset}, expected one of {list(RESOLUTION_PRESETS)}")
+
+        self.model = model
+        self.preset = preset
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.box_thresh = box_thresh
+        self.bitmap_thresh = bitmap_thresh
+        self.unclip_ratio = unclip_ratio
+        self.max_candidates = max_candidates
+        self.unclip_threads = unclip_threads
+
+        self._unclip_executor = None
+        self._unclip_executor_lock = threading.Lock()
+
+    @property
+    def unclip_executor(self):
+        """The thread pool of the unclip, or None if unclip_threads is 0"""
+        if self.unclip_threads > 0 and self._unclip_executor is None:
+            with self._unclip_executor_lock:
+                if self._unclip_executor is None:
+                    self._unclip_executor = ThreadPoolExecutor(max_workers=self.unclip_threads)
+        return self._unclip_executor
+
+    def resize(self, image, preset=None):
+        """Resize a BGR uint8 image to a resolution preset (by default, the one of the detector);
+        return it with its resized width and height"""
+        resize_function, size = RESOLUTION_PRESETS[preset or self.preset]
+        return resize_function(image, size if size is not None else max(image.shape[:2]))
+
+    def normalize(self, image, out=None):
+        """Subtract the mean color from a resized uint8 image, in a single pass into a float32 array
+        (out, e.g. a slice of a batch, if passed)"""
+        if out is None:
+            out = np.empty(image.shape, dtype=np.float32)
+        return np.subtract(image, self.mean, out=out)
+
+    def prepare(self, image, preset=None):
+        """Resize an image for the model and subtract the mean color; return it with its resized width and height"""
+        image, resize_w, resize_h = self.resize(image, preset)
+        return self.normalize(image), resize_w, resize_h
+
+    def predict_on_batch(self, batch):
+        """The (N, H, W, 1) probability maps of a (N, H, W, 3) batch of prepared images"""
+        return np.asarray(self.model.predict_on_batch(batch))
+
+    def polygons(self, p, dest_width, dest_height):
+        """The text polygons of the probability map p of a resized image, in dest_width x dest_height coordinates,
+        and their scores"""
+        return polygons_from_bitmap(p, p > self.bitmap_thresh, dest_width, dest_height,
+                                    max_candidates=self.max_candidates,
+                                    box_thresh=self.box_thresh,
+                                    unclip_ratio=self.unclip_ratio,
+                                    executor=self.unclip_executor,
+                                    num_threads=self.unclip_threads)
+
+    def bounding_boxes(self, p, resize_w, resize_h, orig_w, orig_h):
+        """Extract the bounding boxes of the text lines from the probability map p of a resized image"""
+        aspect_ratio_w, aspect_ratio_h = orig_w / resize_w, orig_h / resize_h
+
+        boxes, scores = self.polygons(p, resize_w, resize_h)
+
+        if len(boxes) == 0:
+            return {'bounding_box': [], 'width': orig_w, 'height': orig_h}
+
+        # the rotated rectangle of each polygon, scaled to the original image (truncated to integer pixels)
+        rects = np.array([cv2.boxPoints(cv2.minAreaRect(box.astype(np.float32))) for box in boxes])
+        rects = rects.astype(np.int64) * np.array([aspect_ratio_w, aspect_ratio_h])
+        rects = rects.astype(np.int64)
+
+        # sort the rectangles by the coordinates (y, x) of their first point, and take their bounding boxes
+        rects = rects[np.lexsort((rects[:, 0, 0], rects[:, 0, 1]))]
+        top_left = rects.min(axis=1)
+        sizes = rects.max(axis=1) - top_left + 1
+
+        rects = [{'id': id, 'x': int(x), 'y': int(y), 'width': int(w), 'height': int(h)}
+                 for id, ((x, y), (w, h)) in enumerate(zip(top_left, sizes))]
+
+        return {'bounding_box': rects, 'width': orig_w, 'height': orig_h}
+
+    def detect(self, image, preset=None, tile_size=None, tile_overlap=128, tile_batch_size=4, stitch="max"):
+        """
+        Detect the text lines of a BGR uint8 image, resized to a resolution preset (by default, the one of the
+        detector). If tile_size is not None, the image goes through the model tile by tile (see tiled_prediction),
+        instead of all at once.
+        """
+        if tile_size is not None:
+            check_tile_settings(tile_size, tile_overlap, stitch)
+
+        orig_h, orig_w = image.shape[:2]
+        image, resize_w, resize_h = self.prepare(image, preset)
+
+        if tile_size is not None:
+            p = tiled_prediction(image, self, tile_size=tile_size, overlap=tile_overlap,
+                                 batch_size=tile_batch_size, stitch=stitch)
+        else:
+            p = self.predict_on_batch(image[np.newaxis])[0]
+
+        return self.bounding_boxes(p, resize_w, resize_h, orig_w, orig_h)
+
+
+TILE_STITCH_MODES = ("max", "blend")
+
 
-    orig_h, orig_w = image.shape[:2]
-    image, resize_w, resize_h = resize_image_bigsize(image, 2500)
-    aspect_ratio_w, aspect_ratio_h = orig_w / resize_w, orig_h / resize_h
+def check_tile_settings(tile_size, overlap, stitch):
+    """Raise a ValueError if the tiles cannot cover an image with these settings (see tiled_prediction)"""
+    if tile_size % 32 != 0:
+        raise ValueError(f"The tile size must be a multiple of 32, got {tile_size}")
+    if not 0 <= overlap < tile_size:
+        raise ValueError(f"The tile overlap must be in [0, {tile_size}), got {overlap}")
+    if stitch not in TILE_STITCH_MODES:
+        raise ValueError(f"Unknown stitch mode {stitch}, expected one of {list(TILE_STITCH_MODES)}")
 
-    image = image.astype(np.float32)
-    image -= mean
-    image_input = np.expand_dims(image, axis=0)
-    image_input_tensor = tf.convert_to_tensor(image_input)
 
-    p = text_detector.predict(image_input_tensor)[0]
+def tile_starts(length, tile_size, overlap):
+    """The start offsets of the overlapping tiles that cover an axis of the passed length"""
+    if length <= tile_size:
+        return [0]
 
-    bitmap = p > 0.3
-    boxes, scores = polygons_from_bitmap(p, bitmap, resize_w, resize_h, box_thresh=BOX_THRESH)
+    starts = list(range(0, length - tile_size, tile_size - overlap))
+    return starts + [length - tile_size]
 
-    rects = []
-    for b in boxes:
-        rect = cv2.minAreaRect(np.array(b))
-        box = cv2.boxPoints(rect)
-        box = np.int0(box)
-        rects.append(box.tolist())
 
-    bb = []
-    for i, box in enumerate(rects):
-        bb.append([])
-        for point in box:
-            bb[i].append([point[0]*aspect_ratio_w, point[1]*aspect_ratio_h])
+def tiled_prediction(image, text_detector, tile_size=1024, overlap=128, batch_size=4, stitch="max"):
+    """
+    Compute the probability map of a prepared image tile by tile, so that the memory used by the model
+    is bounded by the tile size rather than by the image size.
 
-    boxes_poly = []
-    for points in bb:
-        np_points = np.array(points, dtype=np.int)
-        boxes_poly.append(np_points.tolist())
+    The image is split into overlapping tiles of tile_size x tile_size pixels (multiples of 32, as the model requires),
+    that go through the model batch_size at a time. In the overlap regions the probabilities of the tiles
+    are merged by their maximum (stitch="max") or by a weighted mean that fades each tile out towards its borders
+    (stitch="blend").
 
-    boxes_poly_sorted = sorted(boxes_poly , key=lambda k: [k[0][1], k[0][0]])
+    :return: the (H, W, 1) probability map of the (H, W, 3) image
+    """
+    check_tile_settings(tile_size, overlap, stitch)
 
-    rects = []
-    for id, points in enumerate(boxes_poly_sorted):
-        np_points = np.array(points, dtype=np.int)
-        x, y, w, h = cv2.boundingRect(np_points)
-        rects.append({'id': id, 'x': x, 'y': y, 'width': w, 'height': h})
+    height, width = image.shape[:2]
+    tile_h, tile_w = min(tile_size, height), min(tile_size, width)
+    tiles = [(y, x) for y in tile_starts(height, tile_h, overlap) for x in tile_starts(width, tile_w, overlap)]
 
+    probabilities = np.zeros((height, width, 1), dtype=np.float32)
+    if stitch == "blend":
+        # the weight of a pixel grows linearly with its distance from the closest border of the tile, up to overlap
+        ramp_y = np.minimum(np.arange(tile_h) + 1, np.arange(tile_h)[::-1] + 1).clip(max=max(overlap, 1))
+        ramp_x = np.minimum(np.arange(tile_w) + 1, np.arange(tile_w)[::-1] + 1).clip(max=max(overlap, 1))
+        tile_weights = np.outer(ramp_y, ramp_x).astype(np.float32)[..., np.newaxis]
+        weights = np.zeros((height, width, 1), dtype=np.float32)
+
+    for batch_start in range(0, len(tiles), batch_size):
+        batch_tiles = tiles[batch_start:batch_start + batch_size]
+        batch = np.stack([image[y:y + tile_h, x:x + tile_w] for y, x in batch_tiles])
+        predictions = np.asarray(text_detector.predict_on_batch(batch))
+
+        for (y, x), p in zip(batch_tiles, predictions):
+            window = probabilities[y:y + tile_h, x:x + tile_w]
+            if stitch == "blend":
+                window += p * tile_weights
+                weights[y:y + tile_h, x:x + tile_w] += tile_weights
+            else:
+                np.maximum(window, p, out=window)
+
+    if stitch == "blend":
+        probabilities /= weights
+
+    return probabilities
+
+
+def text_detection(uploaded_file, text_detector, tile_size=None, tile_overlap=128, tile_batch_size=4,
+                   stitch="max", preset=None):
+    """
+    Detect the text lines of an uploaded page with a TextDetector (see TextDetector.detect).
+    """
+    print('db_segmentation function started')
+
+    # read file
+    print('read image')
+    print(type(uploaded_file))
+    image = read_image(uploaded_file)
+    print('uploaded_file', uploaded_file)
 
-    return {'bounding_box': rects, 'width': orig_w, 'height': orig_h}
+    return text_detector.detect(image, preset=preset, tile_size=tile_size, tile_overlap=tile_overlap,
+                                tile_batch_size=tile_batch_size, stitch=stitch)
+
+
+def text_detection_batch(uploaded_files, text_detector, batch_size=4, bucket_step=256, window_size=32,
+                         num_threads=4, tile_size=None, tile_overlap=128, stitch="max", preset=None):
+    """
+    Detect the text lines of several pages, batching the pages of similar size through the text detector.
+
+    The pages are processed in windows of window_size pages, so that the memory used does not grow with their number.
+    In each window, the resized pages are grouped by orientation and by their short side rounded up to bucket_step;
+    the pages of a group are padded to a common shape and go through the model batch_size at a time,
+    then the probability map of each page is cropped back to its own size.
+    The pages are resized to a resolution preset (by default, the one of the text detector) as uint8 images,
+    and their mean color is subtracted directly into the batch.
+    The decoding and resizing of the pages, and the post-processing of the maps, run on num_threads threads.
+    If tile_size is not None, each page goes through the model tile by tile instead (see text_detection).
+
+    :return: the list of the results of text_detection, in the same order as uploaded_files
+    """
+    if tile_size is not None:
+        return [text_detection(uploaded_file, text_detector, tile_size=tile_size, tile_overlap=tile_overlap,
+                               tile_batch_size=batch_size, stitch=stitch, preset=preset)
+                for uploaded_file in uploaded_files]
+
+    results = []
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for window_start in range(0, len(uploaded_files), window_size):
+            window_files = uploaded_files[window_start:window_start + window_size]
+
+            def read_and_resize(uploaded_file):
+                image = read_image(uploaded_file)
+                return image.shape[:2], text_detector.resize(image, preset)
+
+            pages = list(executor.map(read_and_resize, window_files))
+
+            # group the pages by orientation and (rounded up) short side
+            buckets = {}
+            for index, (_, (image, resize_w, resize_h)) in enumerate(pages):
+                key = (resize_h > resize_w, int(np.ceil(min(resize_h, resize_w) / bucket_step)))
+                buckets.setdefault(key, []).append(index)
+
+            window_results = [None] * len(pages)
+            for indices in buckets.values():
+                for batch_start in range(0, len(indices), batch_size):
+                    batch_indices = indices[batch_start:batch_start + batch_size]
+
+                    # pad the pages of the batch to a common shape (with zeros, i.e. the mean color)
+                    # that is a multiple of 32, as the model requires
+                    batch_h = max(pages[i][1][2] for i in batch_indices)
+                    batch_w = max(pages[i][1][1] for i in batch_indices)
+                    batch = np.zeros((len(batch_indices), batch_h, batch_w, 3), dtype=np.float32)
+                    for j, i in enumerate(batch_indices):
+                        image, resize_w, resize_h = pages[i][1]
+                        text_detector.normalize(image, out=batch[j, :resize_h, :resize_w])
+
+                    predictions = text_detector.predict_on_batch(batch)
+
+                    def post_process(j, i):
+                        (orig_h, orig_w), (_, resize_w, resize_h) = pages[i]
+                        p = predictions[j, :resize_h, :resize_w]
+                        return i, text_detector.bounding_boxes(p, resize_w, resize_h, orig_w, orig_h)
+
+                    for i, result in executor.map(post_process, range(len(batch_indices)), batch_indices):
+                        window_results[i] = result
+
+            # release the pages of the window before decoding the next ones
+            pages = None
+            results.extend(window_results)
+
+    return results